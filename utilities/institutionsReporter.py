@@ -24,6 +24,7 @@ import logging
 import operator
 from collections import OrderedDict, defaultdict
 from vdm.copies.fmqlCacher import FMQLDescribeResult, FMQLCacher
+from vdm.vistaResources import RESOURCES
 
 """
 Report the Institution information of a system including noting the primary institution.
@@ -67,7 +68,9 @@ def reportInstitutions(vistaCacher, reportBuilder, stateFilter=""):
         else:
             taxonomy = ""
         inactive = True if re.match('ZZ', iResult["name"]) or re.match(r'ZZ', iResult["official_va_name"]) or (iResult["inactive_facility_flag"] == "INACTIVE") else False
-        reportBuilder.reportInstitution(i, iResult.id, iResult["name"], iResult["official_va_name"], iResult["npi"], iResult["station_number"], iResult.uriLabel("state"), ft, visn, parent, taxonomy, iResult["status"], iResult["agency_code"], inactive)
+        # FOIA's institutions with the same station number (resources/FOIAInstitutions.csv)
+        foiaMatches = RESOURCES.institutionsByStation().get(iResult["station_number"], []) if iResult["station_number"] else None
+        reportBuilder.reportInstitution(i, iResult.id, iResult["name"], iResult["official_va_name"], iResult["npi"], iResult["station_number"], iResult.uriLabel("state"), ft, visn, parent, taxonomy, iResult["status"], iResult["agency_code"], inactive, foiaMatches)
            
     reportBuilder.flush("foiaInstitutions" + stateFilter)
         
@@ -80,7 +83,7 @@ class InstitutionCSVMaker:
     def facilityTypes(self, facilityTypes):
         pass
         
-    def reportInstitution(self, no, id, name, officialVAName, npi, stationNumber, state, facilityType, visn, parent, taxonomy, status, agency, inactive=False):
+    def reportInstitution(self, no, id, name, officialVAName, npi, stationNumber, state, facilityType, visn, parent, taxonomy, status, agency, inactive=False, foiaMatches=None):
         self.data += "%d,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % (no, id, name, inactive, agency, officialVAName, npi, stationNumber, state, facilityType, visn, parent, taxonomy)
         
     def flush(self, where):
@@ -118,13 +121,13 @@ class InstitutionHTMLMaker:
         self.__facilityTypes = facilityTypes
         self.__facilityTypes["__NOFT"] = "[Facility Type Unspecified]"
         
-    def reportInstitution(self, no, id, name, officialVAName, npi, stationNumber, state, facilityType, visn, parent, taxonomy, status, agency, inactive=False):
+    def reportInstitution(self, no, id, name, officialVAName, npi, stationNumber, state, facilityType, visn, parent, taxonomy, status, agency, inactive=False, foiaMatches=None):
         ft = "__NOFT" if not facilityType else facilityType
         if visn:
             self.visnRef[visn] += 1
         if parent:
             self.parentRef[parent] += 1
-        data = {"no": no, "id": id, "name": name, "officialVAName": officialVAName, "npi": npi, "stationNumber": stationNumber, "state": state, "visn": visn, "parent": parent, "taxonomy": taxonomy, "inactive": inactive, "facilityType": facilityType, "agency": agency, "status": status}
+        data = {"no": no, "id": id, "name": name, "officialVAName": officialVAName, "npi": npi, "stationNumber": stationNumber, "state": state, "visn": visn, "parent": parent, "taxonomy": taxonomy, "inactive": inactive, "facilityType": facilityType, "agency": agency, "status": status, "foiaMatches": foiaMatches}
         if inactive:
             self.inactives.append(data)
             return
@@ -143,9 +146,15 @@ class InstitutionHTMLMaker:
             noMU += str(self.visnRef[data["name"]])
         if data["name"] in self.parentRef:
             noMU += "/" + str(self.parentRef[data["name"]])
+        # FOIA's institutions with this station or * if FOIA has none
+        stationMU = data["stationNumber"]
+        if data["foiaMatches"]:
+            stationMU = "<span title='FOIA: %s'>%s</span>" % (", ".join(row["name"] + " (" + row["FOIAID"] + ")" for row in data["foiaMatches"]), stationMU)
+        elif data["foiaMatches"] is not None:
+            stationMU = "<span title='Not in FOIA'>%s*</span>" % stationMU
         # return ''.join([`num` for num in xrange(loop_count)])
         # also look into zip statement (want a lot more of that)
-        return "<tr id='%s'><td>%d</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>" % (data["name"], no, nameMU, data["id"], "<a href='#" + data["parent"] + "'>" + data["parent"] + "</a>" if data["parent"] else "", "<a href='#" + data["visn"] + "'>" + data["visn"] + "</a>" if data["visn"] else "", data["npi"], data["stationNumber"], data["state"], data["taxonomy"], data["agency"], noMU)        
+        return "<tr id='%s'><td>%d</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>" % (data["name"], no, nameMU, data["id"], "<a href='#" + data["parent"] + "'>" + data["parent"] + "</a>" if data["parent"] else "", "<a href='#" + data["visn"] + "'>" + data["visn"] + "</a>" if data["visn"] else "", data["npi"], stationMU, data["state"], data["taxonomy"], data["agency"], noMU)        
         
     def flush(self, where):
         reportFile = open(where, "w")
@@ -155,7 +164,7 @@ class InstitutionHTMLMaker:
         noActive = 0
         for ft in self.ftTable:
             noActive += len(self.ftTable[ft])
-        reportFile.write("<p>There are %d active and %d <a href='#inactive'>Inactive Facilities</a> - an <em>Inactive Facility</em> is one with its 'inactive facility flag' set OR a name that begins with 'ZZ'. The following lists the active facilities by facility type:</p>" % (noActive, len(self.inactives)))
+        reportFile.write("<p>There are %d active and %d <a href='#inactive'>Inactive Facilities</a> - an <em>Inactive Facility</em> is one with its 'inactive facility flag' set OR a name that begins with 'ZZ'. A station id marked * has no institution in FOIA (hover over others for FOIA's). The following lists the active facilities by facility type:</p>" % (noActive, len(self.inactives)))
         tocMU = "<ol>"
         for ft in ftsOrdered:
             tocMU += "<li><a href='#" + ft + "'>" + self.__facilityTypes[ft] + "</a> (" + ft + ") - " + str(len(self.ftTable[ft])) + "</li>"
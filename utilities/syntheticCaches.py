@@ -0,0 +1,300 @@
+#
+## VOLDEMORT (VDM) Synthetic Caches
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+Make FMQL caches for VistAs that don't exist - GOLD with some of its files and
+builds changed or a VistA many times the size of GOLD - so VDM can be run and
+timed entirely offline.
+
+A cache is read into memory as is (the JSON FMQL returned) and written back
+in the exact form FMQLCacher reads: SELECT TYPES BADTOO, DESCRIBE TYPE per file
+and DESCRIBE pages of Builds (9.6), Installs (9.7) and Packages (9.4) with the
+limit and cstop VDM asks for with that VistA's label.
+
+Make GOLDX10, ten times GOLD, with:
+
+$ PYTHONPATH=. python utilities/syntheticCaches.py -c Caches -s GOLD -t GOLDX10 -x 10
+
+-h, --help: this help text
+-c, --caches: caches location. Defaults to "Caches"
+-s, --source: VistA to scale or mutate. Defaults to "GOLD"
+-t, --target: label of the VistA to make
+-x, --scale: times bigger to make it. Defaults to 10
+-f, --files: number of files to change (after scaling). Defaults to 0
+-b, --builds: number of builds to change (after scaling). Defaults to 0
+
+TODO:
+- mutate packages
+- scale routines and RPCs (copies share the originals' names)
+"""
+
+import os
+import re
+import json
+import sys
+import random
+import getopt
+import logging
+from vdm.copies.fmqlCacher import FMQLCacher, FMQLFileId
+
+__all__ = ['describeQueries', 'readCache', 'writeCache', 'mutateCache', 'scaleCache']
+
+def describeQueries(vistaLabel):
+    """
+    (file, limit, cstop) of the DESCRIBE pages VDM reads for a VistA - as
+    VistaBuilds and VistaPackages set them. GOLD is paged differently.
+    """
+    gold = vistaLabel == "GOLD"
+    limit = 1000 if gold else 200
+    return [("9_6", limit, 10000), ("9_7", limit, 0), ("9_4", limit, 10 if gold else 10000)]
+
+def readCache(cachesLocation, vistaLabel):
+    """
+    A VistA's cache as {"types": SELECT TYPES reply, "schemas": {fmql id: DESCRIBE TYPE reply}, "entries": {file: [DESCRIBE results]}}
+    """
+    cacheLocation = os.path.join(cachesLocation, re.sub(r' ', '_', vistaLabel))
+    types = json.load(open(os.path.join(cacheLocation, "SELECT TYPES BADTOO.json")))
+    schemas = {}
+    for fileName in os.listdir(cacheLocation):
+        match = re.match(r'DESCRIBE TYPE ([\d_]+)\.json$', fileName)
+        if match:
+            schemas[match.group(1)] = json.load(open(os.path.join(cacheLocation, fileName)))
+    cacher = FMQLCacher(cachesLocation)
+    cacher.setVista(vistaLabel)
+    entries = {}
+    for file, limit, cstop in describeQueries(vistaLabel):
+        entries[file] = list(cacher.describeFileEntries(file, limit=limit, cstop=cstop))
+    return {"types": types, "schemas": schemas, "entries": entries}
+
+def writeCache(cachesLocation, vistaLabel, cache):
+    """
+    Write a cache (see readCache) for a VistA, paged as VDM will read it.
+    Replaces any cache the VistA has.
+    """
+    cacheLocation = os.path.join(cachesLocation, re.sub(r' ', '_', vistaLabel))
+    if not os.path.exists(cacheLocation):
+        os.makedirs(cacheLocation)
+    for fileName in os.listdir(cacheLocation):
+        os.remove(os.path.join(cacheLocation, fileName))
+    json.dump(cache["types"], open(os.path.join(cacheLocation, "SELECT TYPES BADTOO.json"), "w"))
+    for fmqlId, schema in cache["schemas"].iteritems():
+        json.dump(schema, open(os.path.join(cacheLocation, "DESCRIBE TYPE " + fmqlId + ".json"), "w"))
+    for file, limit, cstop in describeQueries(vistaLabel):
+        results = cache["entries"][file]
+        offset = 0
+        while True:
+            page = results[offset:offset + limit]
+            query = FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, offset)
+            json.dump({"count": str(len(page)), "results": page}, open(os.path.join(cacheLocation, query + ".json"), "w"))
+            # a full last page needs an empty one after it
+            if len(page) != limit:
+                break
+            offset += limit
+
+def mutateCache(cache, noFiles, noBuilds, seed=1):
+    """
+    A copy of a cache with noFiles files and noBuilds builds changed, as
+    sites change them. In turn, a file has a field renamed, a field dropped,
+    a local (class 3) field added, is removed or gets a local sibling file.
+    A build is uninstalled, de-installed or gets a local sibling build.
+    """
+    cache = json.loads(json.dumps(cache))
+    rand = random.Random(seed)
+    schemas = cache["schemas"]
+    fmqlIds = sorted(fmqlId for fmqlId, schema in schemas.iteritems() if "fields" in schema and len(schema["fields"]) > 1)
+    for i, fmqlId in enumerate(rand.sample(fmqlIds, min(noFiles, len(fmqlIds)))):
+        schema = schemas[fmqlId]
+        mutation = i % 5
+        if mutation == 0:
+            field = rand.choice(schema["fields"])
+            field["name"] = field.get("name", "") + " LOCAL"
+        elif mutation == 1:
+            schema["fields"].pop(rand.randrange(1, len(schema["fields"])))
+        elif mutation == 2:
+            schema["fields"].append({"number": "101%03d" % (i % 1000), "name": "LOCAL FIELD %d" % i, "type": "4"})
+        elif mutation == 3:
+            del schemas[fmqlId]
+            cache["types"]["results"] = [result for result in cache["types"]["results"] if FMQLFileId.of(result["number"]).fmql != fmqlId]
+        else:
+            number = "101%03d" % (i % 1000)
+            localSchema = json.loads(json.dumps(schema))
+            localSchema["number"] = number
+            localSchema["name"] = "LOCAL " + schema.get("name", number)
+            localSchema.pop("parent", None)
+            schemas[number] = localSchema
+            cache["types"]["results"].append({"number": number, "name": localSchema["name"]})
+    builds = cache["entries"]["9_6"]
+    installs = cache["entries"]["9_7"]
+    installTemplate = installs[0] if installs else None
+    for i, build in enumerate(rand.sample(builds, min(noBuilds, len(builds)))):
+        name = build["name"]["value"]
+        mutation = i % 3
+        if mutation == 0:
+            installs[:] = [install for install in installs if install["name"]["value"] != name]
+        elif mutation == 1 and installTemplate:
+            installs.append(_install(installTemplate, name, "De-Installed", 900000 + i))
+        else:
+            localBuild = json.loads(json.dumps(build))
+            localName = "ZZLOCAL*1.0*%d" % (i + 1)
+            localBuild["name"]["value"] = localName
+            localBuild["uri"] = {"type": "uri", "value": "9_6-%d" % (900000 + i), "label": "BUILD/" + localName}
+            builds.append(localBuild)
+            if installTemplate:
+                installs.append(_install(installTemplate, localName, "Install Completed", 900000 + i))
+    return cache
+
+# Copies of a file are numbered this far apart. Keeps copies out of the class 3
+# (101000-999999) and MSC (214XXXXX) ranges.
+COPY_FILE_OFFSET = 100000000
+# ... and of builds and installs (iens), apart by this
+COPY_IEN_OFFSET = 10000000
+
+def scaleCache(cache, factor):
+    """
+    A cache 'factor' times the size: 'factor' copies of every file (with its
+    fields and subfiles), build (with its cnodes) and install. Copies keep the 
+    distributions of the original - fields per file, files and required 
+    builds per build, installs per build, install times.
+    
+    Copy k (0 is the original) of file 2.01 is k*COPY_FILE_OFFSET + 2.01. Copy
+    k of XU*8.0*12 is XU*8.0*(12 + k*10000). Copies point to copies: a
+    copied subfile's parent, a copied build's files and required builds, a
+    copied install's build.
+    """
+    scaled = {"types": dict(cache["types"]), "schemas": {}, "entries": dict(cache["entries"])}
+    scaled["types"]["results"] = []
+    builds = []
+    installs = []
+    for k in range(factor):
+        for result in cache["types"]["results"]:
+            copy = dict(result)
+            copy["number"] = _copyFileNumber(result["number"], k)
+            if "name" in copy and k:
+                copy["name"] = "%s %d" % (copy["name"], k)
+            scaled["types"]["results"].append(copy)
+        for fmqlId, schema in cache["schemas"].iteritems():
+            copy = json.loads(json.dumps(schema))
+            if k:
+                if "number" in copy:
+                    copy["number"] = _copyFileNumber(copy["number"], k)
+                if "parent" in copy:
+                    copy["parent"] = _copyFileNumber(copy["parent"], k)
+                if "name" in copy:
+                    copy["name"] = "%s %d" % (copy["name"], k)
+                if "fmql" in copy and "TYPE" in copy["fmql"]:
+                    copy["fmql"]["TYPE"] = FMQLFileId.of(_copyFileNumber(FMQLFileId.of(fmqlId).dotted, k)).fmql
+            scaled["schemas"][FMQLFileId.of(_copyFileNumber(FMQLFileId.of(fmqlId).dotted, k)).fmql] = copy
+        for build in cache["entries"]["9_6"]:
+            builds.append(_copyBuild(build, k) if k else build)
+        for install in cache["entries"]["9_7"]:
+            installs.append(_copyInstall(install, k) if k else install)
+    scaled["entries"]["9_6"] = builds
+    scaled["entries"]["9_7"] = installs
+    return scaled
+
+def _copyFileNumber(number, k):
+    if not k:
+        return number
+    fileId = FMQLFileId.of(number)
+    # from the parsed parts - ".11" has no whole digits to skip
+    return str(fileId.whole + k * COPY_FILE_OFFSET) + ("." + fileId.fraction if fileId.fraction else "")
+
+def _copyBuildName(name, k):
+    match = re.match(r'(.+\*)(\d+)$', name)
+    if match:
+        return match.group(1) + str(int(match.group(2)) + k * 10000)
+    return "%s %d" % (name, k)
+
+def _copyIEN(uriValue, k):
+    file, ien = uriValue.split("-", 1)
+    return "%s-%d" % (file, int(ien) + k * COPY_IEN_OFFSET) if ien.isdigit() else uriValue
+
+def _copyBuild(build, k):
+    copy = json.loads(json.dumps(build))
+    name = _copyBuildName(build["name"]["value"], k)
+    copy["name"]["value"] = name
+    copy["uri"]["value"] = _copyIEN(copy["uri"]["value"], k)
+    copy["uri"]["label"] = "BUILD/" + name
+    for cnode in copy.get("file", {}).get("value", []):
+        if "file" in cnode:
+            cnode["file"]["value"] = "1-" + _copyFileNumber(cnode["file"]["value"][2:], k)
+        if "uri" in cnode:
+            cnode["uri"]["value"] = _copyIEN(cnode["uri"]["value"], k)
+    for cnode in copy.get("required_build", {}).get("value", []):
+        if "required_build" in cnode:
+            cnode["required_build"]["value"] = _copyBuildName(cnode["required_build"]["value"], k)
+    for cnode in copy.get("multiple_build", {}).get("value", []):
+        if "multiple_build" in cnode:
+            cnode["multiple_build"]["value"] = _copyIEN(cnode["multiple_build"]["value"], k)
+    return copy
+
+def _copyInstall(install, k):
+    copy = json.loads(json.dumps(install))
+    name = _copyBuildName(install["name"]["value"], k)
+    copy["name"]["value"] = name
+    copy["uri"]["value"] = _copyIEN(copy["uri"]["value"], k)
+    copy["uri"]["label"] = "INSTALL/" + name
+    return copy
+
+def _install(template, buildName, status, ien):
+    install = json.loads(json.dumps(template))
+    install["uri"] = {"type": "uri", "value": "9_7-%d" % ien, "label": "INSTALL/" + buildName}
+    install["name"]["value"] = buildName
+    install["status"]["value"] = status
+    return install
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:s:t:x:f:b:", ["help", "caches=", "source=", "target=", "scale=", "files=", "builds="])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__
+        sys.exit(2)
+    cachesLocation = "Caches"
+    source = "GOLD"
+    target = ""
+    factor = 10
+    noFiles = 0
+    noBuilds = 0
+    for o, a in opts:
+        if o in ["-c", "--caches"]:
+            cachesLocation = a
+        elif o in ["-s", "--source"]:
+            source = a
+        elif o in ["-t", "--target"]:
+            target = a
+        elif o in ["-x", "--scale"]:
+            factor = int(a)
+        elif o in ["-f", "--files"]:
+            noFiles = int(a)
+        elif o in ["-b", "--builds"]:
+            noBuilds = int(a)
+        elif o in ["-h", "--help"]:
+            print __doc__
+            sys.exit()
+    if not target or target == source:
+        print "Need a target VistA (not the source) - exiting"
+        sys.exit(2)
+    cache = scaleCache(readCache(cachesLocation, source), factor)
+    if noFiles or noBuilds:
+        cache = mutateCache(cache, noFiles, noBuilds)
+    writeCache(cachesLocation, target, cache)
+    print "Wrote %s - %d files, %d fields, %d builds, %d installs" % (target, len(cache["schemas"]), sum(len(schema.get("fields", [])) for schema in cache["schemas"].itervalues()), len(cache["entries"]["9_6"]), len(cache["entries"]["9_7"]))
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    GOLD with 100 files and 50 builds changed as "GOLDMUTATED"
+    """
+    gold = readCache("Caches", "GOLD")
+    writeCache("Caches", "GOLDMUTATED", mutateCache(gold, 100, 50))
+    print "Wrote GOLDMUTATED - %d files, %d builds" % (len(gold["schemas"]), len(gold["entries"]["9_6"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#
+## VOLDEMORT (VDM) Benchmark
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+Time VDM offline - GOLD (resources/GOLD.zip) against a synthetic VistA made
+from GOLD with some of its files and builds changed (see syntheticCaches).
+
+Times:
+- reading each cache (schema, builds, installs, packages) with FMQLCacher
+- making VistaSchema, VistaBuilds and VistaPackages for both
+- each comparer and, within it, writing its report
+and notes peak memory (maxrss). Digests are removed from the caches and 
+decoded replies from memory before each timing so every index counts and 
+every read decodes from scratch.
+
+Results go to benchmarkResults.json in the work directory. If a baseline
+results file exists, timings are shown against it and any more than 25%
+slower are flagged. A run with --baseline but no baseline file writes one.
+
+Timings only compare on the same machine and GOLD so the baseline isn't
+shipped. Make one on the machine that checks for regressions, from the
+commit to measure against, and keep it alongside the work directory:
+
+$ git checkout <reference commit>
+$ PYTHONPATH=. python utilities/vdmBenchmark.py -w Benchmark --baseline Benchmark/benchmarkBaseline.json --update
+$ git checkout -
+$ PYTHONPATH=. python utilities/vdmBenchmark.py -w Benchmark --baseline Benchmark/benchmarkBaseline.json
+
+Rerun with --update whenever the machine, GOLD or the settings (-f, -b, -n)
+change.
+
+-h, --help: this help text
+-w, --work: work directory for caches and reports. Defaults to "Benchmark"
+-z, --gold: GOLD zip. Defaults to vdm/resources/GOLD.zip
+-f, --files: number of files to change in the synthetic VistA. Defaults to 100
+-b, --builds: number of builds to change in the synthetic VistA. Defaults to 50
+-n, --repeat: times to run each step, keeping the fastest. Defaults to 3
+--baseline: baseline results file
+--update: (over)write the baseline with this run's results
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import getopt
+import shutil
+import logging
+import resource
+from datetime import datetime
+from zipfile import ZipFile
+from collections import OrderedDict
+from vdm.copies.fmqlCacher import FMQLCacher, REPLIES
+from vdm.copies.runProfile import PROFILE
+from vdm.vistaSchema import VistaSchema
+from vdm.vistaBuilds import VistaBuilds
+from vdm.vistaPackages import VistaPackages
+from vdm.vistaSchemaComparer import VistaSchemaComparer
+from vdm.vistaBuildsComparer import VistaBuildsComparer
+from vdm.vistaPackagesComparer import VistaPackagesComparer
+from syntheticCaches import readCache, writeCache, mutateCache, describeQueries
+
+OTHER_LABEL = "GOLDMUTATED"
+
+# slower than the baseline by more than this is a regression
+REGRESSION_RATIO = 1.25
+
+def makeCaches(workLocation, goldZip, noFiles, noBuilds):
+    """
+    GOLD from its zip and the synthetic VistA from GOLD. Returns the caches location.
+    """
+    cachesLocation = os.path.join(workLocation, "Caches")
+    if not os.path.exists(os.path.join(cachesLocation, "GOLD")):
+        if not os.path.isfile(goldZip):
+            raise Exception("No GOLD cache zip at %s - exiting" % goldZip)
+        ZipFile(goldZip).extractall(cachesLocation)
+    writeCache(cachesLocation, OTHER_LABEL, mutateCache(readCache(cachesLocation, "GOLD"), noFiles, noBuilds))
+    return cachesLocation
+
+def runBenchmark(cachesLocation, reportsLocation, repeat=3):
+    """
+    Returns {"timings": {step: seconds}, "peakMemoryKB": ..., "counters": {...}}
+    """
+    timings = OrderedDict()
+    def spanSeconds(span):
+        return PROFILE.snapshot()["spans"].get(span, {"seconds": 0})["seconds"]
+    def timeIt(step, fn, span=None):
+        """
+        Fastest of the repeats. With 'span', also returns the seconds the
+        fastest repeat spent in that PROFILE span.
+        """
+        best = None
+        bestSpan = 0
+        for i in range(repeat):
+            clearDigests(cachesLocation)
+            REPLIES.clear()
+            spanBefore = spanSeconds(span) if span else 0
+            start = time.time()
+            result = fn()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+                bestSpan = spanSeconds(span) - spanBefore if span else 0
+        timings[step] = best
+        logging.info("%s: %.3fs" % (step, best))
+        return (result, bestSpan) if span else result
+    def cacherOf(vistaLabel):
+        cacher = FMQLCacher(cachesLocation)
+        cacher.setVista(vistaLabel)
+        return cacher
+    def consume(iterator):
+        for item in iterator:
+            pass
+    PROFILE.reset()
+    vistas = {}
+    for vistaLabel in ["GOLD", OTHER_LABEL]:
+        timeIt("read %s schema" % vistaLabel, lambda: consume(cacherOf(vistaLabel).describeSchemaTypes()))
+        for file, limit, cstop in describeQueries(vistaLabel):
+            timeIt("read %s %s" % (vistaLabel, file), lambda: consume(cacherOf(vistaLabel).describeFileEntries(file, limit=limit, cstop=cstop)))
+        schema = timeIt("make %s VistaSchema" % vistaLabel, lambda: VistaSchema(vistaLabel, cacherOf(vistaLabel)))
+        builds = timeIt("make %s VistaBuilds" % vistaLabel, lambda: VistaBuilds(vistaLabel, cacherOf(vistaLabel)))
+        packages = timeIt("make %s VistaPackages" % vistaLabel, lambda: VistaPackages(vistaLabel, cacherOf(vistaLabel)))
+        vistas[vistaLabel] = (schema, builds, packages)
+    gold, other = vistas["GOLD"], vistas[OTHER_LABEL]
+    for step, comparer in [("schema", VistaSchemaComparer(gold[0], other[0], reportsLocation)), ("builds", VistaBuildsComparer(gold[1], other[1], reportsLocation)), ("packages", VistaPackagesComparer(gold[2], other[2], reportsLocation))]:
+        # the report's flush within the fastest compare
+        reportLocation, flushSeconds = timeIt("compare %s" % step, comparer.compare, "report.flush")
+        timings["report %s" % step] = flushSeconds
+    # KB on Linux (bytes on Mac OS X)
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"timings": timings, "peakMemoryKB": peakMemory, "counters": PROFILE.snapshot()["counters"]}
+
+def clearDigests(cachesLocation):
+    for vistaDir in os.listdir(cachesLocation):
+        cacheLocation = os.path.join(cachesLocation, vistaDir)
+        if not os.path.isdir(cacheLocation):
+            continue
+        for fileName in os.listdir(cacheLocation):
+            if re.match(r'DIGEST ', fileName):
+                os.remove(os.path.join(cacheLocation, fileName))
+
+def compareToBaseline(results, baseline):
+    """
+    Lines of step, baseline, now and ratio with regressions flagged
+    """
+    lines = []
+    for step, seconds in results["timings"].iteritems():
+        if step not in baseline["timings"]:
+            lines.append("%-36s %8s %8.3f" % (step, "-", seconds))
+            continue
+        before = baseline["timings"][step]
+        ratio = seconds / before if before else 1.0
+        lines.append("%-36s %8.3f %8.3f %6.2f%s" % (step, before, seconds, ratio, " REGRESSION" if ratio > REGRESSION_RATIO and seconds - before > 0.01 else ""))
+    memoryRatio = float(results["peakMemoryKB"]) / baseline["peakMemoryKB"] if baseline.get("peakMemoryKB") else 1.0
+    lines.append("%-36s %8d %8d %6.2f%s" % ("peak memory (KB)", baseline.get("peakMemoryKB", 0), results["peakMemoryKB"], memoryRatio, " REGRESSION" if memoryRatio > REGRESSION_RATIO else ""))
+    return lines
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hw:z:f:b:n:", ["help", "work=", "gold=", "files=", "builds=", "repeat=", "baseline=", "update"])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__
+        sys.exit(2)
+    workLocation = "Benchmark"
+    goldZip = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vdm", "resources", "GOLD.zip")
+    noFiles = 100
+    noBuilds = 50
+    repeat = 3
+    baselineFile = ""
+    update = False
+    for o, a in opts:
+        if o in ["-w", "--work"]:
+            workLocation = a
+        elif o in ["-z", "--gold"]:
+            goldZip = a
+        elif o in ["-f", "--files"]:
+            noFiles = int(a)
+        elif o in ["-b", "--builds"]:
+            noBuilds = int(a)
+        elif o in ["-n", "--repeat"]:
+            repeat = int(a)
+        elif o in ["--baseline"]:
+            baselineFile = a
+        elif o in ["--update"]:
+            update = True
+        elif o in ["-h", "--help"]:
+            print __doc__
+            sys.exit()
+    if not os.path.exists(workLocation):
+        os.makedirs(workLocation)
+    cachesLocation = makeCaches(workLocation, goldZip, noFiles, noBuilds)
+    results = runBenchmark(cachesLocation, os.path.join(workLocation, "Reports"), repeat)
+    results["settings"] = {"files": noFiles, "builds": noBuilds, "repeat": repeat}
+    results["when"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    resultsFile = os.path.join(workLocation, "benchmarkResults.json")
+    json.dump(results, open(resultsFile, "w"), indent=2)
+    print "Results written to %s" % os.path.abspath(resultsFile)
+    if baselineFile and os.path.isfile(baselineFile) and not update:
+        print "\n".join(compareToBaseline(results, json.load(open(baselineFile))))
+    elif baselineFile:
+        shutil.copy(resultsFile, baselineFile)
+        print "Baseline written to %s" % os.path.abspath(baselineFile)
+
+if __name__ == "__main__":
+    main()
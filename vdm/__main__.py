@@ -12,16 +12,28 @@ VOLDEMORT (VDM)
 -h, --help: this help text
 -v, --vista: name of VistA. Defaults to "CGVISTA", Caregraf's publicly hosted demo VistA
 -f, --fmqlep: FMQL endpoint. For example, "http://vista.caregraf.org/fmqlEP". If set, then no need for --host, --port, --access, --verify
---host: host of VistA
---port: port of VistA
+--host: host of VistA. Several endpoints (Broker listeners or mirrors) of the VistA can be comma separated, each with an optional port ie/ "xx.xx.xx.2:9202" or "xx.xx.xx.1,xx.xx.xx.2:9202". Queries are spread over them.
+--port: port of VistA (of hosts without one)
 --access: access for FMQL RPC
 --verify: verify for FMQL RPC
--r, --report: 'schema', 'builds', 'schemaBuilds'
+-r, --report: 'schema', 'builds', 'schemaBuilds' or 'fleet' (schema drift across every VistA in Caches - no VistA needed)
+--qps: most queries a second to send to the VistA (ex/ 5 for a production VistA in business hours)
+--inflight: most queries in flight at once
+--kbps: most reply kilobytes a second
+--adaptive: back off from these limits when the VistA's replies slow down. Needs --qps or --inflight
+--profile: write a JSON profile of the run (time spent connecting, querying, reading the cache, indexing, comparing, writing reports; bytes and queries) to this file
+--cprofile: run under cProfile, writing its stats (for pstats) to this file
 
 Example using a full FMQL RESTful endpoint ...
 $ python -m vdm -v CGVISTA -f http://vista.caregraf.org/fmqlEP -r schema
 or to use the FMQL RPC directly ...
 $ python -m vdm -v CGVISTA --host "xx.xx.xx" --port 9201 --access "XXX" --verify "YYY" -r schema
+or gently, for a production VistA ...
+$ python -m vdm -v CGVISTA --host "xx.xx.xx" --port 9201 --access "XXX" --verify "YYY" -r schema --qps 5 --inflight 4 --adaptive
+or for the schema of every cached VistA side by side ...
+$ python -m vdm -r fleet
+and to see where the time goes ...
+$ python -m vdm -v CGVISTA -f http://vista.caregraf.org/fmqlEP -r schema --profile schemaProfile.json
 
 The first time VDM runs against a VistA, the majority of time taken is downloading meta data. Subsequent runs of VDM for that VistA will be much faster as they'll run off a cache. 
 
@@ -40,7 +52,10 @@ from vdm.vistaSchemaComparer import VistaSchemaComparer
 from vdm.vistaBuilds import VistaBuilds
 from vdm.vistaBuildsComparer import VistaBuildsComparer
 from vdm.vistaOtherDiffer import VistaOtherDiffer
+from vdm.vistaSchemaFleet import fleetOfCaches
 from vdm.copies.fmqlCacher import FMQLCacher
+from vdm.copies.runProfile import PROFILE, cProfiled
+from vdm.copies.rateLimiter import RateLimiter
 import pkg_resources
 from shutil import copy
 from zipfile import ZipFile
@@ -80,6 +95,28 @@ def _runReport(reportType, goldCacher, otherCacher):
     else:
         print "No valid report type %s specified - exiting" % reportType
 
+def _runFleet():
+    fleet = fleetOfCaches("Caches")
+    reportLocation = fleet.report()
+    print "Fleet Report written to %s" % os.path.abspath(reportLocation)
+    print "Fleet index written to %s" % os.path.abspath(fleet.save("Reports/schemaFleet.json"))
+
+def _parseEndpoints(host, port):
+    """
+    Endpoints of --host ("xx.xx.xx.1,xx.xx.xx.2:9202") as (host, port) - those
+    without a port take --port. Raises ValueError naming a port that isn't
+    a number.
+    """
+    endpoints = []
+    for endpoint in host.split(","):
+        endpointHost, sep, endpointPort = endpoint.strip().partition(":")
+        if not sep:
+            endpointPort = port
+        if not re.match(r'-?\d+$', str(endpointPort)):
+            raise ValueError("Port '%s' of --host endpoint '%s' isn't a number" % (endpointPort, endpoint.strip()) if sep else "--port '%s' isn't a number" % endpointPort)
+        endpoints.append((endpointHost, int(endpointPort)))
+    return endpoints
+
 def main():
     """
     Invoked with python -m vdm
@@ -96,7 +133,7 @@ def main():
     logging.basicConfig(level=logging.INFO, format="%(message)s")
     _makeEnvir()
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hv:f:r:", ["help", "vista=", "fmqlep=", "report=", "host=", "port=", "access=", "verify="])
+        opts, args = getopt.getopt(sys.argv[1:], "hv:f:r:", ["help", "vista=", "fmqlep=", "report=", "host=", "port=", "access=", "verify=", "profile=", "cprofile=", "qps=", "inflight=", "kbps=", "adaptive"])
     except getopt.GetoptError, err:
         print str(err)
         print __doc__
@@ -110,6 +147,12 @@ def main():
     access = ""
     verify = ""
     report = ""
+    profileFile = ""
+    cProfileFile = ""
+    qps = None
+    maxInFlight = None
+    kbps = None
+    adaptive = False
     for o, a in opts:
         if o in ["-v", "--vista"]:
             vista = a
@@ -125,20 +168,60 @@ def main():
             verify = a
         elif o in ["-r", "--report"]:
             report = a
+        elif o in ["--profile"]:
+            profileFile = a
+        elif o in ["--cprofile"]:
+            cProfileFile = a
+        elif o in ["--qps"]:
+            qps = float(a)
+        elif o in ["--inflight"]:
+            maxInFlight = int(a)
+        elif o in ["--kbps"]:
+            kbps = float(a)
+        elif o in ["--adaptive"]:
+            adaptive = True
         elif o in ["-h", "--help"]:
             print __doc__
             sys.exit()
+    if adaptive and not (qps or maxInFlight):
+        print "--adaptive backs off from --qps or --inflight - give one or both"
+        print __doc__
+        sys.exit(2)
     if not report:
         sys.exit()
-    if vista == "CGVISTA":
-        print "Defaulting to Caregraf's demo VistA, 'CGVISTA'"
-        fmqlEP = "http://vista.caregraf.org/fmqlEP"
-    print "VDM - comparing %s against GOLD" % vista
-    goldCacher = FMQLCacher("Caches")
-    goldCacher.setVista("GOLD")
-    otherCacher = FMQLCacher("Caches")
-    otherCacher.setVista(vista, fmqlEP=fmqlEP, host=host, port=int(port), access=access, verify=verify)
-    _runReport(report, goldCacher, otherCacher)
+    if report == "fleet":
+        # every cached VistA - no VistA to set up
+        run, runArgs = _runFleet, ()
+    else:
+        if vista == "CGVISTA":
+            print "Defaulting to Caregraf's demo VistA, 'CGVISTA'"
+            fmqlEP = "http://vista.caregraf.org/fmqlEP"
+        print "VDM - comparing %s against GOLD" % vista
+        goldCacher = FMQLCacher("Caches")
+        goldCacher.setVista("GOLD")
+        otherCacher = FMQLCacher("Caches")
+        try:
+            endpoints = _parseEndpoints(host, port) if host else []
+        except ValueError as e:
+            print str(e)
+            print __doc__
+            sys.exit(2)
+        # one endpoint is a plain host and port; several are spread over
+        if len(endpoints) == 1:
+            host, port = endpoints[0]
+        elif endpoints:
+            host = endpoints
+        limiter = RateLimiter(qps, maxInFlight, kbps * 1024 if kbps else None, adaptive) if (qps or maxInFlight or kbps) else None
+        otherCacher.setVista(vista, fmqlEP=fmqlEP, host=host, port=int(port), access=access, verify=verify, limiter=limiter)
+        run, runArgs = _runReport, (report, goldCacher, otherCacher)
+    if cProfileFile:
+        cProfiled(cProfileFile, run, *runArgs)
+        print "cProfile stats written to %s" % os.path.abspath(cProfileFile)
+    else:
+        run(*runArgs)
+    if profileFile:
+        PROFILE.dump(profileFile)
+        print "Run profile written to %s" % os.path.abspath(profileFile)
     
 if __name__ == "__main__":
     main()
@@ -31,7 +31,9 @@ import StringIO
 import re
 import time
 import socket
+import string
 from random import randint
+from runProfile import PROFILE
 
 class RPCConnection(object):
 
@@ -82,14 +84,21 @@ class RPCConnection(object):
 
 		self.sock = None
 	
-	def invokeRPC(self, name, params):
+	@PROFILE.timed("rpc.invoke")
+	def invokeRPC(self, name, params, reconnect=True):
 		"""	
 		Invoke an RPC. If the connection is closed, try to reopen it once. If fail
 		again then raise an exception. This takes care of connection time outs
 		which happens with the CIA Broker. Note CIA Broker does support a Ping but
 		this approach avoids hogging connections when traffic is low.
+		
+		With reconnect False, an unconnected connection, a failed send or an
+		empty reply raises instead - a managed pool reconnects it in the
+		background rather than logging in again on the request path.
 		"""
 		if not self.sock:
+			if not reconnect:
+				raise Exception("Connection %d isn't connected" % self.poolId)
 			self.logger.logInfo("RPCConnection", "Connecting %d as Socket not initialized" % self.poolId)
 			self.connect()
 		# CIA closes socket in two ways. Elegantly after 2 minutes or so of idleness and abruptly leading to Errno 10053
@@ -100,9 +109,14 @@ class RPCConnection(object):
 			self.sock.send(request)
 			msg = self.readToEndMarker()
 		except socket.error as e:
+			if not reconnect:
+				raise
 			msg = ""
 		# remote end closed so reconnect and retry.
 		if not len(msg):
+			if not reconnect:
+				raise Exception("Empty reply on connection %d" % self.poolId)
+			PROFILE.count("rpc.reconnects")
 			self.logger.logInfo("RPCConnection", "Forced to reconnect connection %d after reply failed (%s))" % (self.poolId, str(e) if e else "empty reply"))
 			self.connect()
 			request = self.makeRequest(name, params)
@@ -110,6 +124,7 @@ class RPCConnection(object):
 			msg = self.readToEndMarker()
 		return msg
 
+	@PROFILE.timed("rpc.connect")
 	def connect(self):
 		"""
 		(Re)connect/activate the connection. Sets up basic pipe. The hand shake
@@ -121,25 +136,41 @@ class RPCConnection(object):
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.sock.connect((self.host, self.port))
 		self.logger.logInfo("RPCConnection", "Connecting to %s %d - Step1 for %d ..." % (self.host, self.port, self.poolId))
+
+	def close(self):
+		"""
+		Close the socket. The next RPC will connect again.
+		"""
+		if self.sock:
+			try:
+				self.sock.close()
+			except socket.error:
+				pass
+		self.sock = None
+
+	def isConnected(self):
+		return self.sock is not None
+		
+	# (ra, rb) -> translation table of CIPHER[ra] to CIPHER[rb]. Filled as used.
+	CIPHER_TABLES = {}
 		
 	def encrypt(cls, val):
+		"""
+		Each character of val found in cipher row ra becomes the character at
+		the same position in row rb. Others are left as is. ra and rb are sent
+		either side.
+		"""
 		ra = randint(0, 18)
 		rb = randint(0, 18)
 		while ((rb == ra) or (rb == 0)):
 			rb = randint(0, 18)
-		cra = RPCConnection.CIPHER[ra]
-		crb = RPCConnection.CIPHER[rb]
-		cval = chr(ra + 32)
-		for i in range(len(val)):
-			c = val[i]
-			index = cra.find(c)
-			if index == -1:
-				# no str(c)
-				cval += str(c)
-			else:
-				cval += str(crb[index])
-		cval += chr(rb + 32)
-		return cval.encode("utf-8")
+		try:
+			table = RPCConnection.CIPHER_TABLES[(ra, rb)]
+		except KeyError:
+			table = RPCConnection.CIPHER_TABLES[(ra, rb)] = string.maketrans(RPCConnection.CIPHER[ra], RPCConnection.CIPHER[rb])
+		if isinstance(val, unicode):
+			val = val.encode("utf-8")
+		return chr(ra + 32) + val.translate(table) + chr(rb + 32)
 		
 	def readToEndMarker(self):
 		"""
@@ -171,15 +202,20 @@ class RPCConnection(object):
 			msgChunks.append(msgChunk)
 		if len(msgChunks):
 			msg = "".join(msgChunks)
+		PROFILE.count("rpc.bytesReceived", len(msg))
 		self.logger.logInfo("RPCConnection", "Message of length %d received in %d chunks on connection %d" % (len(msg), noChunks, self.poolId))
 		return msg
 
 class VistARPCConnection(RPCConnection):
 
+	# RPC a client sends to tell the Broker it's still there
+	KEEPALIVE_RPC = "XWB IM HERE"
+
 	def __init__(self, host, port, access, verify, context, logger, poolId=-1):
 		# End Token for messages is chr(4)
 		RPCConnection.__init__(self, host, port, access, verify, context, logger, chr(4), poolId)
 
+	@PROFILE.timed("rpc.handshake")
 	def connect(self):
 		"""
 		How VistA Broker connects
@@ -216,54 +252,82 @@ class VistARPCConnection(RPCConnection):
 			raise Exception("VistARPCConnection", connectReply)
 		self.logger.logInfo("VistARPCConnection", "Handshake complete for connection %d" % self.poolId)
 
-	def makeRequest(self, name, params, isCommand=False):
-		""" 
-		Format a the RPC request to send to VISTA:
-		name = Name of RPC
-		params = comma delimit list of paramters
-		isCommand = reserved for internal use. If you really want to know, it's for connecting or disconnecting.
-		"""
+	# (name, isCommand) -> request up to its parameters. FMQL's one RPC is 
+	# there from the start; others are added as used.
+	REQUEST_PREFIXES = {}
+	
+	# L-PACK lengths ie/ 7 -> "007"
+	LPACK_LENGTHS = ["%03d" % i for i in range(1000)]
 
-		# Header saying that
-		# 1. We are doing NS broker '[XWB]'
-		# 2. We are running V 1
-		# 3. We are running Type 1
-		# 4. Envelope size is 3 (i.e. max message is 999; the longest number we can fit in 3 chars)
-		# 5. XWBPRT (whatever that is) is 0
+	@staticmethod
+	def makeRequestPrefix(name, isCommand=False):
+		"""
+		Header, command and name of a request and the start of its parameters
+
+		Header saying that
+		1. We are doing NS broker '[XWB]'
+		2. We are running V 1
+		3. We are running Type 1
+		4. Envelope size is 3 (i.e. max message is 999; the longest number we can fit in 3 chars)
+		5. XWBPRT (whatever that is) is 0
+		"""
 		protocoltoken = "[XWB]1130"
-		
 		if isCommand:   # Are we executing a command?
 			commandtoken = "4"
 		else:
 			commandtoken = "2" + chr(1) + "1"
-		
 		namespec = chr(len(name)) + name	# format name S-PACK
+		return protocoltoken + commandtoken + namespec + "5" # 5 means that what follows is Params to RPC
+
+	@staticmethod
+	def lpack(val):
+		"""
+		L-PACK: length (3 digits) and val
+		"""
+		val = str(val)
+		vlen = len(val)
+		return (VistARPCConnection.LPACK_LENGTHS[vlen] if vlen < 1000 else str(vlen)) + val
+
+	def makeRequest(self, name, params, isCommand=False):
+		""" 
+		Format a the RPC request to send to VISTA:
+		name = Name of RPC
+		params = comma delimit list of paramters
+		isCommand = reserved for internal use. If you really want to know, it's for connecting or disconnecting.
 		
-		paramsspecs = "5" # means that what follows is Params to RPC
+		This runs for every query of a cache fill so the start of a request is 
+		cached by name and the usual one (literal) parameter case is one 
+		concatenation.
+		"""
+		try:
+			prefix = VistARPCConnection.REQUEST_PREFIXES[(name, isCommand)]
+		except KeyError:
+			prefix = VistARPCConnection.REQUEST_PREFIXES[(name, isCommand)] = VistARPCConnection.makeRequestPrefix(name, isCommand)
 		
 		if not len(params):  # if no paramters do this and done
-			paramsspecs += "4" + "f"
-		else: # if there are paramters
-			for param in params:
-				if type(param) is not dict:
-					paramsspecs += "0" # Type of RPC: Literal
-					paramsspecs += str(len(param)).zfill(3) + str(param) # L-PACK
-					paramsspecs += "f"  # End
-				else: # we are in a dictionary
-					paramsspecs += "2" # Type of RPC: List
-					paramIndex = 1 # keep track of where to put the t's
-					for key,val in param.items():
-						if paramIndex > 1: paramsspecs += "t" # t is the delimiter b/n each key,val pair
-						paramsspecs += str(len(str(key))).zfill(3) + str(key) # L-PACK
-						paramsspecs += str(len(str(val))).zfill(3) + str(val) # L-PACK
-						paramIndex += 1
-					paramsspecs += "f" # close list
-
-		endtoken = chr(4)
-		return protocoltoken + commandtoken + namespec + paramsspecs + endtoken	 
+			return prefix + "4f\x04"
+
+		# Type of RPC: Literal (0), L-PACK, End (f), endtoken
+		if len(params) == 1 and type(params[0]) is not dict:
+			return prefix + "0" + VistARPCConnection.lpack(params[0]) + "f\x04"
+
+		pieces = [prefix]
+		for param in params:
+			if type(param) is not dict:
+				pieces.append("0" + VistARPCConnection.lpack(param) + "f")
+			else: # we are in a dictionary
+				# Type of RPC: List (2); t is the delimiter b/n each key,val pair
+				pieces.append("2" + "t".join(VistARPCConnection.lpack(key) + VistARPCConnection.lpack(val) for key, val in param.items()) + "f")
+		pieces.append("\x04") # endtoken
+		return "".join(pieces)
+
+VistARPCConnection.REQUEST_PREFIXES[("CG FMQL QP", False)] = VistARPCConnection.makeRequestPrefix("CG FMQL QP")
 		
 class CIARPCConnection(RPCConnection):
 
+	# No ping - CIA connections are reaped instead (see ManagedRPCConnectionPool)
+	KEEPALIVE_RPC = None
+
 	def __init__(self, host, port, access, verify, context, logger, poolId=-1):
 		"""
 		"CG FMQL QP USER" for FMQL, "CIAV VUECENTRIC" for VUECENTRIC is context
@@ -280,6 +344,7 @@ class CIARPCConnection(RPCConnection):
 		# Need for first request sent in connect
 		self.uid = "" 
 
+	@PROFILE.timed("rpc.handshake")
 	def connect(self):
 		"""
 		CIA form of CONNECT				
@@ -349,34 +414,28 @@ class CIARPCConnection(RPCConnection):
 		# 1 byte rtype
 		
 		# Assemble Parameters (only do string parameters. Add ARRAY in next phase)
-		paramsspecs = ""
+		pieces = [headerToken, EODToken, sequence, brtype]
 		for paramId, paramValue in params.iteritems():
-			paramsspecs += self.__byteIt(paramId) + chr(0) + self.__byteIt(paramValue)	
-
-		return headerToken + EODToken + sequence + brtype + paramsspecs + EODToken
+			pieces.append(self.__byteIt(paramId))
+			pieces.append(chr(0))
+			pieces.append(self.__byteIt(paramValue))
+		pieces.append(EODToken)
+		return "".join(pieces)
 		
-	# Return byte array of length and string val per the CIA Broker encoding scheme
+	# Return bytes of length and string val per the CIA Broker encoding scheme
 	def __byteIt(self, strVal):
 		slen = len(strVal)
 		# remainder if /16
-		low = slen % 16
+		low = slen & 15
 		# A right shift by n bits is defined as division by pow(2, n) [ie./ /16]
+		# High part goes big endian (highest order byte first)
 		slen = slen >> 4
-		bytes = bytearray()
-		highCount = 0
+		high = ""
 		while slen != 0:
-			bytes.append(slen & 0xFF) 
+			high = chr(slen & 0xFF) + high
 			slen = slen >> 8
-			highCount += 1
-		fbytes = bytearray()
 		# No bytes after this one in first four bits. Left over in second. If < 16, then only one byte overall.
-		fbytes.append((highCount << 4) + low)
-		# Reverse from last byte (highest order) to first (lowest)
-		# ie. big endian
-		for idx in reversed(xrange(0, len(bytes))):
-			fbytes.append(bytes[idx])
-		fbytes.extend(bytearray(strVal))
-		return fbytes
+		return chr((len(high) << 4) + low) + high + strVal
 		
 # ############################## RPCConnection Pool ###################
 
@@ -387,12 +446,17 @@ Future - look at:
 - context manager: http://jessenoller.com/2009/02/03/get-with-the-program-as-contextmanager-completely-different/
 """
 import Queue
+import atexit
+import weakref
+import threading
 class RPCConnectionPool:
 
 	# - for running in WSGI, set poolSize == number of threads expected in a process. 
 	# - brokerType is "VistA" or "CIA"
-	def __init__(self, brokerType, poolSize, host, port, access, verify, context, logger):	
+	# - limiter (optional) holds RPCs to a rate (see rateLimiter)
+	def __init__(self, brokerType, poolSize, host, port, access, verify, context, logger, limiter=None):	
 		self.logger = logger
+		self.limiter = limiter
 		# Queue is LIFO and thread safe. Means threads share a limited set
 		# of connections and will only use what their pace requires ie. if
 		# pool size is five, that doesn't mean five active connections. May
@@ -415,15 +479,22 @@ class RPCConnectionPool:
 		
 	def invokeRPC(self, name, params):
 	
+		if self.limiter:
+			start = self.limiter.acquire()
+
 		# Block until connection is available
 		connection = self.__connectionQueue.get()
 		  
+		reply = ""
 		try:
 			 reply = connection.invokeRPC(name, params)
 		except Exception as e:	 
 			 # Note: retry (reset connection) happens in RPCConnection. If get here then bigger problem.
 			 self.logger.logError("CONN POOL", "Basic connectivity problem. Connection was refused so RPC invocation failed.")
 			 raise e
+		finally:
+			if self.limiter:
+				self.limiter.release(start, len(reply))
 
 		self.__connectionQueue.put(connection)
 		  
@@ -441,6 +512,431 @@ class RPCConnectionPool:
 		for i in range(number):
 			self.__connectionQueue.put(connections[i])
 
+"""
+A pool that manages its connections instead of leaving them to connect on
+first use and reconnect when a reply comes back empty:
+- warmUp connects a number of connections in parallel, before they're needed
+- connections idle for 'keepalive' seconds are pinged (XWB IM HERE) in the
+background so the Broker doesn't drop them. One that fails its ping is
+replaced in the background.
+- connections idle for 'idleTimeout' are closed down to 'minSize'
+- an RPC that fails on a connection is retried on another, already connected
+one (or, if none are idle, one connected in the background). The failed
+connection logs in again in the background, not on the request path.
+- an RPC that finds no connection idle waits for one to be put back or for
+one connected in the background (if the pool has room). It only connects
+itself if the pool has no connections at all.
+Pool size (poolSize) is the most connections it will have. An optional
+limiter holds RPCs to a rate (see rateLimiter) - keepalives aren't limited.
+"""
+class ManagedRPCConnectionPool:
+
+	def __init__(self, brokerType, poolSize, host, port, access, verify, context, logger, minSize=0, keepalive=60, idleTimeout=300, limiter=None):
+		self.logger = logger
+		self.limiter = limiter
+		self.poolSize = poolSize
+		self.minSize = min(minSize, poolSize)
+		self.keepalive = keepalive
+		self.idleTimeout = idleTimeout
+		self.__brokerType = brokerType
+		self.__connectionArgs = (host, port, access, verify, context, logger)
+		self.__lock = threading.Condition()
+		# LIFO of (connection, last used, last pinged) - connected and not in use
+		self.__idle = []
+		# connected + connecting + in use
+		self.__noConnections = 0
+		self.__nextPoolId = 1
+		# background connects under way, RPCs waiting in __get and connects
+		# that have failed
+		self.__connecting = 0
+		self.__waiting = 0
+		self.__connectFailures = 0
+		self.__closed = False
+		self.__stopped = threading.Event()
+		if self.minSize:
+			self.warmUp(self.minSize)
+		self.__maintainer = threading.Thread(target=self.__maintain)
+		self.__maintainer.setDaemon(True)
+		self.__maintainer.start()
+		_OPEN_POOLS.add(self)
+
+	def invokeRPC(self, name, params):
+		"""
+		Invoke on an idle connection (waiting for one if none are idle - see
+		__get). If the RPC fails, the connection is replaced in the background
+		and the RPC is tried again on another. Connections never log in
+		again on the request path.
+		"""
+		if self.limiter:
+			start = self.limiter.acquire()
+			reply = ""
+			try:
+				reply = self.__invokeRPC(name, params)
+			finally:
+				self.limiter.release(start, len(reply))
+			return reply
+		return self.__invokeRPC(name, params)
+
+	def __invokeRPC(self, name, params):
+		"""
+		A Broker restart leaves every idle connection dead so retry as many
+		times as the pool has connections - a dead one fails at once. Once
+		none are idle, the retry waits for one connected in the background.
+		"""
+		for attempt in range(self.poolSize + 1):
+			connection = self.__get()
+			try:
+				reply = connection.invokeRPC(name, params, reconnect=False)
+			except Exception as e:
+				PROFILE.count("rpc.reconnects")
+				self.__replace(connection)
+				if attempt == self.poolSize:
+					raise
+				self.logger.logError("CONN POOL", "RPC failed on connection %d (%s) - replacing it and retrying" % (connection.poolId, str(e)))
+				continue
+			self.__put(connection)
+			return reply
+
+	def warmUp(self, number):
+		"""
+		Have 'number' connections idle and ready, connecting (handshake, login
+		and context) any more needed in parallel, as the pool's size allows.
+		Call before a burst of RPCs, say a cache fill.
+		"""
+		with self.__lock:
+			number = min(number - len(self.__idle), self.poolSize - self.__noConnections)
+		self.__connectMore(number)
+
+	def __connectMore(self, number):
+		"""Connect up to 'number' new connections in parallel and wait for them"""
+		with self.__lock:
+			number = min(number, self.poolSize - self.__noConnections)
+			if number <= 0:
+				return
+			self.__noConnections += number
+			self.__connecting += number
+		connectors = [threading.Thread(target=self.__connectNew) for i in range(number)]
+		for connector in connectors:
+			connector.start()
+		for connector in connectors:
+			connector.join()
+		self.logger.logInfo("CONN POOL", "Connected %d more connections" % number)
+
+	def close(self):
+		self.__stopped.set()
+		with self.__lock:
+			self.__closed = True
+			idle = self.__idle
+			self.__idle = []
+			self.__noConnections -= len(idle)
+			self.__lock.notifyAll()
+		for connection, lastUsed, lastPinged in idle:
+			connection.close()
+		if self.__maintainer is not threading.currentThread():
+			self.__maintainer.join(5)
+
+	def stats(self):
+		with self.__lock:
+			return {"connections": self.__noConnections, "idle": len(self.__idle)}
+
+	def __makeConnection(self):
+		with self.__lock:
+			poolId = self.__nextPoolId
+			self.__nextPoolId += 1
+		host, port, access, verify, context, logger = self.__connectionArgs
+		if self.__brokerType == "CIA":
+			return CIARPCConnection(host, port, access, verify, context, logger, poolId)
+		return VistARPCConnection(host, port, access, verify, context, logger, poolId)
+
+	def __connectNew(self):
+		"""
+		Connect a new connection (already counted as a connection and as
+		connecting) and make it idle
+		"""
+		connection = self.__makeConnection()
+		try:
+			connection.connect()
+		except Exception as e:
+			self.logger.logError("CONN POOL", "Failed to connect connection %d (%s)" % (connection.poolId, str(e)))
+			with self.__lock:
+				self.__noConnections -= 1
+				self.__connecting -= 1
+				self.__connectFailures += 1
+				self.__lock.notifyAll()
+			return
+		with self.__lock:
+			self.__connecting -= 1
+		self.__put(connection)
+
+	def __connectInBackground(self):
+		connector = threading.Thread(target=self.__connectNew)
+		connector.setDaemon(True)
+		connector.start()
+
+	def __get(self):
+		"""
+		An idle connection. If none are idle, wait for one to be put back or
+		for one connected in the background - started here if the pool has
+		room and waiters outnumber the connects under way. Once a connect
+		fails, no more are started while waiting (no storm of connects to a
+		VistA that is down).
+		
+		Only a pool with no connections at all connects on the request path
+		- there's nothing to wait for - so a VistA that can't be reached
+		raises from here.
+		"""
+		with self.__lock:
+			failures = self.__connectFailures
+			while True:
+				if self.__closed:
+					raise Exception("Connection pool is closed")
+				if self.__idle:
+					return self.__idle.pop()[0]
+				if self.__noConnections == 0:
+					self.__noConnections += 1
+					break
+				if self.__noConnections < self.poolSize and self.__connecting <= self.__waiting and self.__connectFailures == failures:
+					self.__noConnections += 1
+					self.__connecting += 1
+					self.__connectInBackground()
+				self.__waiting += 1
+				try:
+					self.__lock.wait()
+				finally:
+					self.__waiting -= 1
+		# empty pool: connect on the request path (warmUp avoids this)
+		connection = self.__makeConnection()
+		try:
+			connection.connect()
+		except:
+			self.__discard(connection)
+			raise
+		return connection
+
+	def __put(self, connection, lastUsed=None, lastPinged=0):
+		with self.__lock:
+			if self.__closed:
+				self.__noConnections -= 1
+				connection.close()
+				return
+			self.__idle.append((connection, lastUsed if lastUsed else time.time(), lastPinged))
+			self.__lock.notify()
+
+	def __discard(self, connection):
+		connection.close()
+		with self.__lock:
+			self.__noConnections -= 1
+			self.__lock.notifyAll()
+
+	def __replace(self, connection):
+		"""Close a failed connection and connect a replacement in the background"""
+		connection.close()
+		with self.__lock:
+			if not self.__closed:
+				self.__connecting += 1
+				self.__connectInBackground()
+				return
+		self.__discard(connection)
+
+	def __maintain(self):
+		"""
+		Background: ping connections idle for 'keepalive', close those idle 
+		for 'idleTimeout' (keeping minSize) and top up to minSize
+		"""
+		interval = max(1, min(self.keepalive or self.idleTimeout, self.idleTimeout or self.keepalive) / 2.0)
+		while not self.__stopped.wait(interval):
+			now = time.time()
+			toPing = []
+			toClose = []
+			with self.__lock:
+				if self.__closed:
+					return
+				kept = []
+				# oldest first (bottom of the LIFO). Pings don't count as use.
+				for connection, lastUsed, lastPinged in self.__idle:
+					if self.idleTimeout and now - lastUsed > self.idleTimeout and self.__noConnections - len(toClose) > self.minSize:
+						toClose.append(connection)
+					elif self.keepalive and now - max(lastUsed, lastPinged) > self.keepalive and connection.KEEPALIVE_RPC:
+						toPing.append((connection, lastUsed))
+					else:
+						kept.append((connection, lastUsed, lastPinged))
+				self.__idle = kept
+				self.__noConnections -= len(toClose)
+				topUp = self.minSize - self.__noConnections
+			for connection in toClose:
+				connection.close()
+			if toClose:
+				self.logger.logInfo("CONN POOL", "Reaped %d idle connections" % len(toClose))
+			for connection, lastUsed in toPing:
+				try:
+					reply = connection.invokeRPC(connection.KEEPALIVE_RPC, [], reconnect=False)
+				except Exception as e:
+					self.logger.logInfo("CONN POOL", "Keepalive failed on connection %d (%s) - replacing it" % (connection.poolId, str(e)))
+					self.__replace(connection)
+					continue
+				self.__put(connection, lastUsed, time.time())
+			if topUp > 0:
+				self.__connectMore(topUp)
+
+# Pools still open at exit are closed so their maintainers stop before the
+# interpreter tears down
+_OPEN_POOLS = weakref.WeakSet()
+
+def _closeOpenPools():
+	for pool in list(_OPEN_POOLS):
+		pool.close()
+
+atexit.register(_closeOpenPools)
+
+"""
+A pool over several endpoints (host, port) of one VistA - the Broker listeners
+or mirror nodes of a large site - so a cache fill uses all of them. Each
+endpoint has its own ManagedRPCConnectionPool.
+
+Each RPC goes to a healthy endpoint, picked by:
+- LEAST_OUTSTANDING: fewest RPCs in flight (ties to the lower latency)
+- LATENCY: lowest moving average of RPC time, once every endpoint has one
+
+An endpoint whose RPC fails (after its own pool's retry) has the RPC tried on
+the next endpoint. 'maxFailures' failures in a row mark an endpoint down for
+'downFor' seconds, doubling each time it fails again after coming back. If
+every endpoint is down, the one due back soonest is tried rather than failing
+outright.
+
+Pool size is per endpoint.
+"""
+class MultiEndpointRPCConnectionPool:
+
+	LEAST_OUTSTANDING = "LEAST_OUTSTANDING"
+	LATENCY = "LATENCY"
+
+	# weight of the latest RPC time in an endpoint's moving average
+	LATENCY_WEIGHT = 0.2
+
+	def __init__(self, brokerType, endpoints, poolSize, access, verify, context, logger, policy=LEAST_OUTSTANDING, maxFailures=3, downFor=30, **poolArgs):
+		"""
+		endpoints: [(host, port)]. poolArgs go to each endpoint's 
+		ManagedRPCConnectionPool (minSize, keepalive, idleTimeout, limiter).
+		A limiter is shared by all endpoints so limits the site as a whole.
+		"""
+		if not endpoints:
+			raise Exception("No endpoints for the connection pool")
+		if policy not in [MultiEndpointRPCConnectionPool.LEAST_OUTSTANDING, MultiEndpointRPCConnectionPool.LATENCY]:
+			raise Exception("Unknown endpoint policy %s" % policy)
+		self.logger = logger
+		self.poolSize = poolSize * len(endpoints)
+		self.policy = policy
+		self.maxFailures = maxFailures
+		self.downFor = downFor
+		self.__lock = threading.Lock()
+		self.__endpoints = []
+		for host, port in endpoints:
+			self.__endpoints.append({
+				"name": "%s:%s" % (host, port),
+				"pool": ManagedRPCConnectionPool(brokerType, poolSize, host, port, access, verify, context, logger, **poolArgs),
+				"outstanding": 0,
+				"latency": None,
+				"invoked": 0,
+				"failed": 0,
+				"failuresInARow": 0,
+				"downUntil": 0,
+				"downs": 0
+			})
+		self.logger.logInfo("CONN POOL", "Pooling %d endpoints (%s) by %s" % (len(endpoints), ", ".join(endpoint["name"] for endpoint in self.__endpoints), policy))
+
+	def invokeRPC(self, name, params):
+		tried = set()
+		lastException = None
+		while len(tried) < len(self.__endpoints):
+			endpoint = self.__pick(tried)
+			tried.add(endpoint["name"])
+			start = time.time()
+			try:
+				reply = endpoint["pool"].invokeRPC(name, params)
+			except Exception as e:
+				self.__failed(endpoint)
+				self.logger.logError("CONN POOL", "RPC failed on endpoint %s (%s)%s" % (endpoint["name"], str(e), " - failing over" if len(tried) < len(self.__endpoints) else ""))
+				lastException = e
+				continue
+			self.__succeeded(endpoint, time.time() - start)
+			return reply
+		raise lastException
+
+	def warmUp(self, number):
+		"""
+		Spread 'number' ready connections over the healthy endpoints
+		"""
+		now = time.time()
+		healthy = [endpoint for endpoint in self.__endpoints if endpoint["downUntil"] <= now] or self.__endpoints
+		perEndpoint = (number + len(healthy) - 1) // len(healthy)
+		connectors = [threading.Thread(target=endpoint["pool"].warmUp, args=(perEndpoint,)) for endpoint in healthy]
+		for connector in connectors:
+			connector.start()
+		for connector in connectors:
+			connector.join()
+
+	def close(self):
+		for endpoint in self.__endpoints:
+			endpoint["pool"].close()
+
+	def stats(self):
+		"""
+		Per endpoint: RPCs in flight, average RPC time, RPCs, failures, is it
+		up and its connections
+		"""
+		now = time.time()
+		with self.__lock:
+			return dict((endpoint["name"], {
+				"outstanding": endpoint["outstanding"],
+				"latency": endpoint["latency"],
+				"invoked": endpoint["invoked"],
+				"failed": endpoint["failed"],
+				"up": endpoint["downUntil"] <= now,
+				"connections": endpoint["pool"].stats()
+			}) for endpoint in self.__endpoints)
+
+	def __pick(self, tried):
+		"""
+		Best endpoint not yet tried by the policy, reserving it (outstanding)
+		"""
+		now = time.time()
+		with self.__lock:
+			candidates = [endpoint for endpoint in self.__endpoints if endpoint["name"] not in tried]
+			healthy = [endpoint for endpoint in candidates if endpoint["downUntil"] <= now]
+			if not healthy:
+				endpoint = min(candidates, key=lambda endpoint: endpoint["downUntil"])
+			elif self.policy == MultiEndpointRPCConnectionPool.LATENCY and all(endpoint["latency"] is not None for endpoint in healthy):
+				endpoint = min(healthy, key=lambda endpoint: (endpoint["latency"], endpoint["outstanding"]))
+			else:
+				# LATENCY falls back to this until each endpoint has a time
+				endpoint = min(healthy, key=lambda endpoint: (endpoint["outstanding"], endpoint["latency"] or 0))
+			endpoint["outstanding"] += 1
+			return endpoint
+
+	def __succeeded(self, endpoint, elapsed):
+		with self.__lock:
+			endpoint["outstanding"] -= 1
+			endpoint["invoked"] += 1
+			endpoint["latency"] = elapsed if endpoint["latency"] is None else (MultiEndpointRPCConnectionPool.LATENCY_WEIGHT * elapsed + (1 - MultiEndpointRPCConnectionPool.LATENCY_WEIGHT) * endpoint["latency"])
+			if endpoint["failuresInARow"] or endpoint["downs"]:
+				self.logger.logInfo("CONN POOL", "Endpoint %s is back" % endpoint["name"])
+			endpoint["failuresInARow"] = 0
+			endpoint["downs"] = 0
+
+	def __failed(self, endpoint):
+		with self.__lock:
+			endpoint["outstanding"] -= 1
+			endpoint["invoked"] += 1
+			endpoint["failed"] += 1
+			endpoint["failuresInARow"] += 1
+			# down after maxFailures in a row or at once if it fails on its return
+			if endpoint["failuresInARow"] >= self.maxFailures or endpoint["downs"]:
+				downFor = self.downFor * (2 ** min(endpoint["downs"], 5))
+				endpoint["downUntil"] = time.time() + downFor
+				endpoint["downs"] += 1
+				endpoint["failuresInARow"] = 0
+				self.logger.logError("CONN POOL", "Endpoint %s marked down for %d seconds" % (endpoint["name"], downFor))
+
 # ################################ Basic Test ###########################
 
 import threading
@@ -472,10 +968,30 @@ class RPCLogger:
 import getopt, sys
 import json
 import time
+
+def benchmarkEncoding(noRequests=50000):
+	"""
+	Requests encoded a second - no Broker needed. FMQL's queries, as a cache
+	fill sends them, for both Brokers and the cipher as used at login.
+	"""
+	logger = RPCLogger()
+	vistaConnection = VistARPCConnection("localhost", 9201, "", "", "CG FMQL QP USER", logger)
+	ciaConnection = CIARPCConnection("localhost", 9201, "", "", "CG FMQL QP USER", logger)
+	queries = [["OP:DESCRIBE^TYPE:9_6^LIMIT:200^OFFSET:%d^CSTOP:10000" % (i * 200)] for i in range(100)]
+	for label, encode in [("VistA request", lambda i: vistaConnection.makeRequest("CG FMQL QP", queries[i % 100])), ("CIA request", lambda i: ciaConnection.makeRequest("CG FMQL QP", queries[i % 100])), ("cipher", lambda i: vistaConnection.encrypt("ACCESS%d;VERIFY%d!" % (i % 100, i % 100)))]:
+		start = time.time()
+		for i in xrange(noRequests):
+			encode(i)
+		elapsed = time.time() - start
+		print "%-14s %10d a second (%d in %.3fs)" % (label, noRequests / elapsed if elapsed else 0, noRequests, elapsed)
+
 def main():
-	opts, args = getopt.getopt(sys.argv[1:], "")
+	opts, args = getopt.getopt(sys.argv[1:], "b")
+	if ("-b", "") in opts:
+		benchmarkEncoding()
+		return
 	if len(args) < 4:
-		print "Enter <host> <port> <access> <verify>"
+		print "Enter <host> <port> <access> <verify> or -b to benchmark encoding"
 		return
 		
 	# VERY BASIC:
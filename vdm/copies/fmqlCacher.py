@@ -24,6 +24,26 @@ TODO - Changes/Additions Planned:
 - /usr/share/vdm/cache and the equivalent on windows (will allow setting)
 - remove support for many Vistas at once ie/ many labels ie/ one Cacher per VistA
 - support Application Proxy mechanism once added to brokerRPC
+
+A fill (the schema or all of a file's entries) keeps a journal of its queries
+in the cache (see FMQLFillJournal). If it dies part way, the next run resumes
+it, only sending the queries not yet done.
+
+Many processes (and threads) can share a cache:
+- replies and digests are written to a temporary file and renamed into place
+so no reader sees a part written reply
+- a fill holds the VistA's cache lock (FMQLCacheLock - a locked file, LOCK, 
+in the VistA's cache). A process that waits on another's fill finds the 
+replies cached when it gets the lock and doesn't send them again.
+- identical queries sent at once in a process go to the VistA once 
+(FMQLSingleFlight)
+
+Replies are decoded with the fastest JSON codec installed (see jsonCodec).
+
+Decoded replies are kept in memory (REPLIES, an FMQLReplyLRU) so reading a
+reply again in a process - another VistaSchema of the same VistA, 
+VistaIdentity's queries - costs no read or decode. Replies are shared so
+treat them as read only; copy before changing.
 """
 
 import os
@@ -35,10 +55,18 @@ import Queue
 import time
 import json
 import sys
+import zlib
 import logging
-from brokerRPC import RPCConnectionPool        
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError: # Windows - only threads of a process are locked out
+    fcntl = None
+from brokerRPC import RPCConnectionPool, ManagedRPCConnectionPool, MultiEndpointRPCConnectionPool
+from runProfile import PROFILE
+from jsonCodec import CODEC
 
-__all__ = ['FMQLCacher']
+__all__ = ['FMQLCacher', 'FMQLSymbolTable', 'SYMBOLS', 'FMQLFileId', 'fileIdSortKey', 'FIRST_FILE_ID', 'FMQLFillJournal', 'FMQLCacheLock', 'FMQLSingleFlight', 'writeCacheFile', 'FMQLReplyLRU', 'REPLIES']
 
 class FMQLCacher:
     """
@@ -70,8 +98,15 @@ class FMQLCacher:
       - Elapsed Time to cache schema in 15 pieces: 134.057111025
       - Elapsed Time to cache schema in 20 pieces: 133.793686867 ie/ marginal
     For now, setting sweet spot to 15. Need to tweek for different boxes.
+    
+    host may be a list of endpoints of the one VistA - [(host, port)] or
+    [host] for hosts on 'port' - and then queries are spread over them (see
+    brokerRPC's MultiEndpointRPCConnectionPool). poolSize is then per endpoint.
+    
+    limiter (see rateLimiter) holds queries to a production VistA to a set
+    load.
     """
-    def setVista(self, vistaLabel, fmqlEP="", host="", port=-1, access="", verify="", poolSize=15):
+    def setVista(self, vistaLabel, fmqlEP="", host="", port=-1, access="", verify="", poolSize=15, endpointPolicy=MultiEndpointRPCConnectionPool.LEAST_OUTSTANDING, limiter=None):
         self.vistaLabel = vistaLabel
         try:
             self.__cacheLocation = self.__cachesLocation + "/" + re.sub(r' ', '_', vistaLabel)
@@ -80,33 +115,96 @@ class FMQLCacher:
         except:
             logging.critical(sys.exc_info()[0])
             raise
-        rpcCPool = RPCConnectionPool("VistA", poolSize, host, port, access, verify, "CG FMQL QP USER", RPCLogger()) if host else None
-        self.__poolSize = poolSize # if rpc then # threads == conn pool size
-        self.__fmqlIF = FMQLInterface(fmqlEP, rpcCPool) if (fmqlEP or rpcCPool) else None         
+        self.__cacheLock = FMQLCacheLock.of(self.__cacheLocation)
+        # Managed: connections are warmed up before a fill and kept alive
+        if isinstance(host, (list, tuple)):
+            endpoints = [endpoint if isinstance(endpoint, (list, tuple)) else (endpoint, port) for endpoint in host]
+            rpcCPool = MultiEndpointRPCConnectionPool("VistA", endpoints, poolSize, access, verify, "CG FMQL QP USER", RPCLogger(), endpointPolicy) if endpoints else None
+        else:
+            rpcCPool = ManagedRPCConnectionPool("VistA", poolSize, host, port, access, verify, "CG FMQL QP USER", RPCLogger()) if host else None
+        self.__poolSize = rpcCPool.poolSize if rpcCPool else poolSize # if rpc then # threads == conn pool size
+        self.__fmqlIF = FMQLInterface(fmqlEP, rpcCPool, limiter) if (fmqlEP or rpcCPool) else None         
     
     def clearCache(self, vistaLabel):
         pass
         
+    def cacheDigest(self, digestName, digest):
+        """
+        Store a digest (ex/ counts) calculated while indexing cached replies 
+        alongside those replies. A (re)fill of the cache drops all digests.
+        """
+        writeCacheFile(self.__cacheLocation + "/DIGEST " + digestName + ".json", json.dumps(digest))
+        
+    def cachedDigest(self, digestName):
+        """Returns None if the digest isn't in the Cache"""
+        queryFile = self.__cacheLocation + "/DIGEST " + digestName + ".json"
+        if not os.path.isfile(queryFile):
+            return None
+        return json.load(open(queryFile, "r"))
+        
+    def __clearDigests(self):
+        for fileName in os.listdir(self.__cacheLocation):
+            if re.match(r'DIGEST ', fileName):
+                os.remove(self.__cacheLocation + "/" + fileName)
+        
     def query(self, query):
         """
         Invoke any query. If not in cache then dispatch it and cache
         the reply. 
         
         Simple, blocking invocation. No generator, iterator or threading
-        efficiencies.
+        efficiencies. Threads that miss on the same query at once share one
+        dispatch (and one decoded reply).
         """
         queryFile = self.__cacheLocation + "/" + query + ".json"
         if os.path.isfile(queryFile):
-            reply = json.load(open(queryFile, "r"))
+            reply = self.__readCached(queryFile)
             return reply
+        return SINGLEFLIGHT.do(queryFile, lambda: self.__queryAndCache(query, queryFile))
+        
+    def __queryAndCache(self, query, queryFile):
+        # cached by another thread or process since the miss
+        if os.path.isfile(queryFile):
+            return self.__readCached(queryFile)
+        PROFILE.count("cache.misses")
         reply = self.__fmqlIF.query(query)
-        jreply = json.loads(reply)
-        jcache = open(self.__cacheLocation + "/" + query + ".json", "w")
-        json.dump(jreply, jcache)
-        jcache.close()
+        # decoding checks the reply - it's cached as it came
+        jreply = SYMBOLS.loads(reply)
+        with PROFILE.span("cache.write"):
+            writeCacheFile(queryFile, reply)
         # logging.info("Cached " + query)
         return jreply
                     
+    def __readCached(self, queryFile, expected=None):
+        """
+        Read and decode a cached reply - timed and counted separately as
+        "cache.read" and "cache.decode" - unless it's in memory (REPLIES)
+        
+        expected: (size, crc32) the reply should have
+        """
+        queryFile = os.path.abspath(queryFile)
+        fileStat = os.stat(queryFile)
+        if expected and fileStat.st_size != expected[0]:
+            raise Exception("Cached %s isn't the size its manifest says - remove the manifest to recheck the cache" % queryFile)
+        # a rewritten (refilled) reply won't match
+        stamp = (fileStat.st_mtime, fileStat.st_size)
+        reply = REPLIES.get(queryFile, stamp)
+        if reply is not None:
+            PROFILE.count("cache.memoryHits")
+            return reply
+        with PROFILE.span("cache.read"):
+            cacheFile = open(queryFile, "r")
+            data = cacheFile.read()
+            cacheFile.close()
+        if expected and zlib.crc32(data) & 0xffffffff != expected[1]:
+            raise Exception("Cached %s doesn't match the checksum its manifest has - remove the manifest to recheck the cache" % queryFile)
+        PROFILE.count("cache.hits")
+        PROFILE.count("cache.bytesRead", len(data))
+        with PROFILE.span("cache.decode"):
+            reply = SYMBOLS.loads(data)
+        REPLIES.put(queryFile, stamp, len(data), reply)
+        return reply
+                    
     def describeSchemaTypes(self):
         """
         Generator, returns one type at a time. Takes "count" from 
@@ -120,34 +218,88 @@ class FMQLCacher:
         - make iteration more explicit with an FMQLSchemaIterator class.
         All this should move out of the Cacher class.
         - flatten field and file description ie/ remove "value"
+        
+        Driven by the schema's manifest (see __makeSchemaManifest) - one read
+        says the schema is cached and which types it has. A cache without one
+        is checked file by file (__isSchemaCached) and given one.
         """
-        if not self.__isSchemaCached():
-            self.__cacheSchema()
-        queryFile = self.__cacheLocation + "/SELECT TYPES BADTOO.json"
-        selectTypesReply = json.load(open(queryFile))
+        manifest = self.__schemaManifest()
+        if manifest is None:
+            with self.__cacheLock:
+                # another process may have filled it while this one waited
+                manifest = self.__schemaManifest()
+                if manifest is None:
+                    if not self.__isSchemaCached():
+                        self.__cacheSchema()
+                    manifest = self.__makeSchemaManifest()
+        for typeEntry in manifest["types"]:
+            fmqlId = typeEntry["id"]
+            queryFile = self.__cacheLocation + "/DESCRIBE TYPE " + fmqlId + ".json"
+            try:
+                reply = self.__readCached(queryFile, (typeEntry["size"], typeEntry["crc"]))
+            except (IOError, OSError):
+                raise Exception("Expected Schema for %s to be in Cache but it wasn't - exiting" % typeEntry["number"])
+            # a copy as the cached reply is shared
+            jreply = dict(reply)
+            if "fmql" not in jreply: # omission for errors
+                jreply["fmql"] = {"TYPE": fmqlId}
+            if "count" in typeEntry:
+                jreply["count"] = typeEntry["count"]
+            yield jreply
+            
+    SCHEMA_MANIFEST = "MANIFEST SCHEMA.json"
+            
+    def __schemaManifest(self):
+        """
+        The schema's manifest or None if there isn't one or a fill of the
+        schema is under way
+        """
+        manifestFile = self.__cacheLocation + "/" + FMQLCacher.SCHEMA_MANIFEST
+        if not os.path.isfile(manifestFile) or os.path.isfile(self.__journalFile("SCHEMA")):
+            return None
+        try:
+            return json.load(open(manifestFile))
+        except ValueError:
+            logging.info("Ignoring unreadable %s" % manifestFile)
+            return None
+            
+    def __makeSchemaManifest(self):
+        """
+        Once the schema is cached, list its types (in SELECT TYPES order) with
+        their counts and the size and checksum (crc32) of their replies:
+        
+          {"types": [{"id": "2", "number": "2", "count": "10", "size": 30921, "crc": 1273...}, ...]}
+        """
+        selectTypesReply = CODEC.load(open(self.__cacheLocation + "/SELECT TYPES BADTOO.json"))
+        types = []
         for result in selectTypesReply["results"]:
-            if float(result["number"]) < 1.1: 
+            fileId = FMQLFileId.of(result["number"])
+            if fileId < FIRST_FILE_ID: 
                 continue # TODO: once FOIA up, include under 1.1
-            fmqlId = re.sub(r'\.', '_', result["number"])
-            queryFile = self.__cacheLocation + "/DESCRIBE TYPE " + fmqlId + ".json"
+            queryFile = self.__cacheLocation + "/DESCRIBE TYPE " + fileId.fmql + ".json"
             if not os.path.isfile(queryFile):
                 raise Exception("Expected Schema for %s to be in Cache but it wasn't - exiting" % result["number"])
-            jreply = json.load(open(queryFile))
-            if "fmql" not in jreply: # omission for errors
-                jreply["fmql"] = {"TYPE": fmqlId}
+            data = open(queryFile, "r").read()
+            typeEntry = {"id": fileId.fmql, "number": result["number"], "size": len(data), "crc": zlib.crc32(data) & 0xffffffff}
             if "count" in result:
-                jreply["count"] = result["count"]
-            yield jreply
+                typeEntry["count"] = result["count"]
+            types.append(typeEntry)
+        manifest = {"types": types}
+        writeCacheFile(self.__cacheLocation + "/" + FMQLCacher.SCHEMA_MANIFEST, json.dumps(manifest))
+        return manifest
             
     def __isSchemaCached(self):
         queryFile = self.__cacheLocation + "/SELECT TYPES BADTOO.json"
         if not os.path.isfile(queryFile):
             return False
-        selectTypesReply = json.load(open(queryFile))
+        if os.path.isfile(self.__journalFile("SCHEMA")):
+            return False
+        selectTypesReply = CODEC.load(open(queryFile))
         for result in selectTypesReply["results"]:
-            if float(result["number"]) < 1.1: 
+            fileId = FMQLFileId.of(result["number"])
+            if fileId < FIRST_FILE_ID: 
                 continue # TODO - ignore under 1.1
-            queryFile = self.__cacheLocation + "/DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]) + ".json"
+            queryFile = self.__cacheLocation + "/DESCRIBE TYPE " + fileId.fmql + ".json"
             if not os.path.isfile(queryFile):
                 return False
         return True   
@@ -155,24 +307,52 @@ class FMQLCacher:
     # BAD JSON FIX: have it check if in cache as may not be? Return a list?     
         
     # Elapsed Time to cache schema in 50 pieces: 136.819022894
+    @PROFILE.timed("cache.fillSchema")
     def __cacheSchema(self):
         start = time.time()
-        reply = self.query("SELECT TYPES BADTOO")
+        self.__clearDigests()
+        manifestFile = self.__cacheLocation + "/" + FMQLCacher.SCHEMA_MANIFEST
+        if os.path.isfile(manifestFile):
+            os.remove(manifestFile)
+        journal = FMQLFillJournal(self.__journalFile("SCHEMA"))
+        if journal.resumed:
+            queries = journal.pending()
+        else:
+            reply = self.query("SELECT TYPES BADTOO")
+            # if float(result["number"]) < 1.1: 
+            #    continue
+            queries = ["DESCRIBE TYPE " + FMQLFileId.of(result["number"]).fmql for result in reply["results"]]
+            journal.begin(queries)
+        self.__fill(queries, journal)
+        # logging.info("Elapsed Time to cache schema in %d pieces: %s" % (self.__poolSize, time.time() - start))        
+        
+    def __journalFile(self, fillName):
+        return self.__cacheLocation + "/JOURNAL " + fillName + ".json"
+        
+    def __fill(self, queries, journal):
+        """
+        Send queries with a thread per connection, caching their replies and
+        noting each in the fill's journal. The journal goes once all are done.
+        """
+        if journal.resumed:
+            logging.info("Resuming fill (%s) - %d of %d queries left" % (os.path.basename(journal.journalFile), len(queries), len(journal)))
+        if queries:
+            self.__fmqlIF.warmUp(min(len(queries), self.__poolSize))
         queriesQueue = Queue.Queue()
-        for i in range(self.__poolSize):
+        for i in range(min(len(queries), self.__poolSize)):
             fmqlIF = self.__fmqlIF # TODO: shared makes no speed difference (make sure)
-            t = ThreadedQueriesCacher(fmqlIF, queriesQueue, self.__cacheLocation)
+            t = ThreadedQueriesCacher(fmqlIF, queriesQueue, self.__cacheLocation, journal)
             t.setDaemon(True)
             t.start()
-        # logging.info("Caching %d types at a time" % self.__poolSize)
-        for result in reply["results"]:
-            # if float(result["number"]) < 1.1: 
-            #    continue
-            queriesQueue.put("DESCRIBE TYPE " + re.sub(r'\.', '_', result["number"]))
+        for query in queries:
+            queriesQueue.put(query)
         queriesQueue.join()
-        # logging.info("Elapsed Time to cache schema in %d pieces: %s" % (self.__poolSize, time.time() - start))        
+        failed = journal.finish()
+        if failed:
+            logging.error("%d queries of the fill failed (%s) - run again to retry them" % (len(failed), ", ".join(failed[:5])))
         
     DESCRIBE_TEMPL = "DESCRIBE %s CSTOP %s LIMIT %d OFFSET %d"
+    DESCRIBE_FILL_TEMPL = "DESCRIBE %s CSTOP %s LIMIT %d"
         
     def describeFileEntries(self, file, limit=200, cstop=100):
         """
@@ -188,7 +368,10 @@ class FMQLCacher:
         - right now, if one fails (ie/ no cache of errored json) then will exception. Perhaps try again or more elegantly exit.
         """
         if not self.__isDescribeCached(file, limit, cstop):
-            self.__cacheDescribe(file, limit, cstop)
+            with self.__cacheLock:
+                # another process may have filled it while this one waited
+                if not self.__isDescribeCached(file, limit, cstop):
+                    self.__cacheDescribe(file, limit, cstop)
         offset = 0
         # Ensure all wanted are in Cache. If not, recache EVERYTHING!
         while True:
@@ -196,7 +379,7 @@ class FMQLCacher:
             queryFile = self.__cacheLocation + "/" + loquery + ".json"
             if not os.path.isfile(queryFile):
                 raise Exception("Expected result of %s to be in Cache but it wasn't - exiting" % loquery)
-            reply = json.load(open(queryFile, "r"))
+            reply = self.__readCached(queryFile)
             # logging.info("Reading - %s (%d results) - from cache" % (loquery, int(reply["count"])))
             for result in reply["results"]:
                 yield result
@@ -206,6 +389,8 @@ class FMQLCacher:
                     
     def __isDescribeCached(self, file, limit, cstop):
         """TODO: good for all but boundary condition where last reply has limit entries and then there's no new reply. Need to record properly in serialized reply"""
+        if os.path.isfile(self.__journalFile(FMQLCacher.DESCRIBE_FILL_TEMPL % (file, cstop, limit))):
+            return False
         offset = 0
         queryFile = ""
         while True:
@@ -215,35 +400,433 @@ class FMQLCacher:
             if not os.path.isfile(queryFile):
                 if not lastQueryFile:
                     return False
-                reply = json.load(open(lastQueryFile, "r"))
+                reply = CODEC.load(open(lastQueryFile, "r"))
                 if int(reply["count"]) != limit:
                     return True
                 break
             offset += limit
         return False
             
+    @PROFILE.timed("cache.fillDescribe")
     def __cacheDescribe(self, file, limit, cstop):
-        """Assumes all or nothing ie/ missing even one, will get all again"""
+        """
+        Assumes all or nothing ie/ missing even one, will get all again - 
+        unless a fill was interrupted, when its journal says what's left. The
+        journal keeps the pages of the first try even if the count changed.
+        """
         start = time.time()
-        # Never cache COUNT. Go direct.
-        reply = self.__fmqlIF.query("COUNT " + file)
-        total = int(json.loads(reply)["count"])
-        goes = total/limit + 1
-        # logging.info("Caching complete file %s in %d pieces" % (file, goes))
-        queriesQueue = Queue.Queue()
-        offset = 0
-        noQueries = total/limit + 1
-        noThreads = noQueries if noQueries < self.__poolSize else self.__poolSize
-        for i in range(goes):
-            fmqlIF = self.__fmqlIF # TODO: shared makes no speed difference (make sure)
-            t = ThreadedQueriesCacher(fmqlIF, queriesQueue, self.__cacheLocation)
-            t.setDaemon(True)
-            t.start()
-        for i in range(goes):
-            queriesQueue.put(FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, offset))
-            offset += limit
-        queriesQueue.join()
-        # logging.info("Elapsed Time to cache file %s in %d pieces: %s" % (file, noThreads, time.time() - start))
+        self.__clearDigests()
+        journal = FMQLFillJournal(self.__journalFile(FMQLCacher.DESCRIBE_FILL_TEMPL % (file, cstop, limit)))
+        if journal.resumed:
+            queries = journal.pending()
+        else:
+            # Never cache COUNT. Go direct.
+            reply = self.__fmqlIF.query("COUNT " + file)
+            total = int(CODEC.loads(reply)["count"])
+            goes = total/limit + 1
+            # logging.info("Caching complete file %s in %d pieces" % (file, goes))
+            queries = [FMQLCacher.DESCRIBE_TEMPL % (file, cstop, limit, i * limit) for i in range(goes)]
+            journal.begin(queries, total=total)
+        self.__fill(queries, journal)
+        # logging.info("Elapsed Time to cache file %s in %d pieces: %s" % (file, len(queries), time.time() - start))
+                    
+def writeCacheFile(cacheFile, data):
+    """
+    Write to a temporary file and rename it into place - readers (in this or
+    other processes) see the whole file or none of it.
+    """
+    tmpFile = "%s.tmp.%d.%d" % (cacheFile, os.getpid(), threading.current_thread().ident)
+    jcache = open(tmpFile, "w")
+    try:
+        jcache.write(data)
+    finally:
+        jcache.close()
+    try:
+        os.rename(tmpFile, cacheFile)
+    except OSError:
+        # Windows won't rename over a file
+        if not os.path.isfile(cacheFile):
+            raise
+        os.remove(cacheFile)
+        os.rename(tmpFile, cacheFile)
+
+class FMQLCacheLock(object):
+    """
+    Lock of a VistA's cache, held while filling it. Excludes other processes
+    (an exclusive lock on the file LOCK in the cache) and other threads. 
+    Reentrant - a thread holding it can take it again.
+    
+    Get with FMQLCacheLock.of(cacheLocation) - one per cache in a process.
+    """
+    def __init__(self, cacheLocation):
+        self.lockFile = os.path.join(cacheLocation, "LOCK")
+        self.__threadLock = threading.RLock()
+        self.__depth = 0
+        self.__lockf = None
+        
+    @staticmethod
+    def of(cacheLocation):
+        key = os.path.abspath(cacheLocation)
+        with _CACHELOCKS_LOCK:
+            if key not in _CACHELOCKS:
+                _CACHELOCKS[key] = FMQLCacheLock(cacheLocation)
+            return _CACHELOCKS[key]
+        
+    def __enter__(self):
+        self.__threadLock.acquire()
+        self.__depth += 1
+        if self.__depth == 1 and fcntl:
+            self.__lockf = open(self.lockFile, "a")
+            start = time.time()
+            try:
+                fcntl.flock(self.__lockf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                logging.info("Waiting for another process filling %s" % os.path.dirname(self.lockFile))
+                fcntl.flock(self.__lockf.fileno(), fcntl.LOCK_EX)
+                PROFILE.addSpan("cache.lockWait", time.time() - start)
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__depth -= 1
+        if self.__depth == 0 and self.__lockf:
+            fcntl.flock(self.__lockf.fileno(), fcntl.LOCK_UN)
+            self.__lockf.close()
+            self.__lockf = None
+        self.__threadLock.release()
+        return False
+        
+_CACHELOCKS = {}
+_CACHELOCKS_LOCK = threading.Lock()
+        
+class FMQLSingleFlight(object):
+    """
+    Identical calls (same key) made at once by many threads run once - the
+    first runs it, the rest wait for and share its result (or exception).
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+        
+    def do(self, key, fn):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = {"done": threading.Event()}
+        if not leader:
+            call["done"].wait()
+            PROFILE.count("cache.sharedQueries")
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call["done"].set()
+        return call["result"]
+        
+"""
+Shared by all Cachers in a process
+"""
+SINGLEFLIGHT = FMQLSingleFlight()
+
+class FMQLReplyLRU(object):
+    """
+    Decoded replies, least recently used dropped first once the (JSON) bytes
+    of those kept go over maxBytes. Decoded, a reply takes a few times its
+    JSON's size.
+    
+    Replies are kept against a stamp of their file (modified time and size);
+    one asked for with another stamp is a miss.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict() # key -> (stamp, bytes, reply)
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        
+    def get(self, key, stamp):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or entry[0] != stamp:
+                if entry:
+                    self.__bytes -= entry[1]
+                self.__misses += 1
+                return None
+            # back in as the most recently used
+            self.__entries[key] = entry
+            self.__hits += 1
+            return entry[2]
+            
+    def put(self, key, stamp, noBytes, reply):
+        if noBytes > self.maxBytes:
+            return
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry:
+                self.__bytes -= entry[1]
+            self.__entries[key] = (stamp, noBytes, reply)
+            self.__bytes += noBytes
+            while self.__bytes > self.maxBytes:
+                oldKey, oldEntry = self.__entries.popitem(last=False)
+                self.__bytes -= oldEntry[1]
+                self.__evictions += 1
+                
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+            
+    def stats(self):
+        with self.__lock:
+            return {"hits": self.__hits, "misses": self.__misses, "evictions": self.__evictions, "entries": len(self.__entries), "bytes": self.__bytes, "maxBytes": self.maxBytes}
+            
+    def __len__(self):
+        return len(self.__entries)
+        
+"""
+Shared by all Cachers (and so all VistAs) in a process - 128MB of JSON
+"""
+REPLIES = FMQLReplyLRU(128 * 1024 * 1024)
+
+class FMQLFillJournal(object):
+    """
+    Durable record of a fill's queries - which are pending, in flight, done
+    or failed - so a fill that dies part way can be resumed.
+
+    A file of JSON lines in the cache: the fill's plan (its queries and any
+    notes like the file's count) and then a line each time a query starts,
+    is done (its reply is in the cache) or fails. Each line is flushed and
+    synced as it's written. A last line cut short by a crash is ignored.
+
+    On resume, queries in flight or failed when the fill stopped are pending
+    again. The journal is removed once a fill has done all of its queries.
+    """
+    PENDING = "PENDING"
+    INFLIGHT = "INFLIGHT"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+    def __init__(self, journalFile):
+        self.journalFile = journalFile
+        self.plan = None
+        self.resumed = False
+        self.__states = {}
+        self.__queries = []
+        self.__lock = threading.Lock()
+        self.__journal = None
+        # a line cut short is ended before the next is written
+        self.__lineCut = False
+        if os.path.isfile(journalFile):
+            self.__replay()
+
+    def begin(self, queries, **notes):
+        """Start the journal of a new fill"""
+        self.__queries = list(queries)
+        self.__states = dict((query, FMQLFillJournal.PENDING) for query in self.__queries)
+        self.plan = notes
+        self.__write({"plan": notes, "queries": self.__queries})
+
+    def pending(self):
+        """Queries not done, in plan order"""
+        return [query for query in self.__queries if self.__states[query] != FMQLFillJournal.DONE]
+
+    def started(self, query):
+        self.__note(query, FMQLFillJournal.INFLIGHT)
+
+    def done(self, query):
+        self.__note(query, FMQLFillJournal.DONE)
+
+    def failed(self, query, error=""):
+        self.__note(query, FMQLFillJournal.FAILED, error)
+
+    def finish(self):
+        """
+        Returns the queries that failed. If none did, the journal is removed.
+        """
+        with self.__lock:
+            if self.__journal:
+                self.__journal.close()
+                self.__journal = None
+            failed = [query for query in self.__queries if self.__states[query] == FMQLFillJournal.FAILED]
+            if not failed and not [query for query in self.__queries if self.__states[query] != FMQLFillJournal.DONE]:
+                os.remove(self.journalFile)
+            return failed
+
+    def counts(self):
+        """{state: number of queries}"""
+        counts = {}
+        for state in self.__states.itervalues():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def __len__(self):
+        return len(self.__queries)
+
+    def __note(self, query, state, error=""):
+        with self.__lock:
+            self.__states[query] = state
+            self.__write({"query": query, "state": state, "error": error} if error else {"query": query, "state": state}, False)
+
+    def __write(self, record, lock=True):
+        if lock:
+            self.__lock.acquire()
+        try:
+            if not self.__journal:
+                self.__journal = open(self.journalFile, "a")
+                if self.__lineCut:
+                    self.__journal.write("\n")
+            self.__journal.write(json.dumps(record) + "\n")
+            self.__journal.flush()
+            os.fsync(self.__journal.fileno())
+        finally:
+            if lock:
+                self.__lock.release()
+
+    def __replay(self):
+        for line in open(self.journalFile):
+            self.__lineCut = not line.endswith("\n")
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.info("Ignoring a partly written line in %s" % self.journalFile)
+                continue
+            if "plan" in record:
+                self.plan = record["plan"]
+                self.__queries = record["queries"]
+                self.__states = dict((query, FMQLFillJournal.PENDING) for query in self.__queries)
+            elif record.get("query") in self.__states:
+                self.__states[record["query"]] = record["state"]
+        # Was there a journal of this fill already
+        self.resumed = self.plan is not None
+        # in flight when the fill stopped: pending again
+        for query, state in self.__states.iteritems():
+            if state == FMQLFillJournal.INFLIGHT:
+                self.__states[query] = FMQLFillJournal.PENDING
+                    
+class FMQLSymbolTable(object):
+    """
+    Values like field names, type codes, file numbers and build names repeat 
+    across the files of one VistA and across the VistAs loaded together for
+    a comparison. Replies decoded through one table share one copy of each
+    such value. 
+    
+    As equal values are the same object, indexers and comparers can use
+    identity (is) instead of equality for values that come from decoded 
+    replies or that they intern themselves.
+    
+    Only strings up to MAX_LENGTH are interned - descriptions and the like
+    are rarely shared.
+    """
+    MAX_LENGTH = 128
+    
+    def __init__(self):
+        self.__symbols = {}
+        
+    def intern(self, value):
+        # setdefault is atomic so threads can share the table
+        return self.__symbols.setdefault(value, value)
+        
+    def internPairs(self, pairs):
+        """object_pairs_hook for json decoding"""
+        symbols = self.__symbols
+        maxLength = self.MAX_LENGTH
+        return dict((symbols.setdefault(key, key), symbols.setdefault(value, value) if isinstance(value, basestring) and len(value) <= maxLength else value) for key, value in pairs)
+        
+    def load(self, fp):
+        return CODEC.load(fp, object_pairs_hook=self.internPairs)
+        
+    def loads(self, s):
+        return CODEC.loads(s, object_pairs_hook=self.internPairs)
+        
+    def __len__(self):
+        return len(self.__symbols)
+        
+"""
+Shared by all Cachers (and so all VistAs) in a process
+"""
+SYMBOLS = FMQLSymbolTable()
+
+class FMQLFileId(object):
+    """
+    A FileMan file (or field) number, parsed once. Ids arrive as "9.64", "19620.1",
+    ".001" or in FMQL's "9_64" form and used to be re-parsed with float() and
+    re.sub wherever they were sorted, range checked or turned from one form to
+    the other.
+    
+    Exact - the whole and fractional parts are kept as an integer and a digit
+    string (trailing zeros dropped) so 9.6 < 9.64 < 9.7 without float rounding.
+    
+    Get with FMQLFileId.of(id) - one instance per id string in a process.
+    """
+    __slots__ = ("dotted", "fmql", "whole", "fraction", "sortKey")
+    
+    def __init__(self, id):
+        self.dotted = SYMBOLS.intern(id.replace("_", "."))
+        self.fmql = SYMBOLS.intern(self.dotted.replace(".", "_"))
+        whole, _, fraction = self.dotted.partition(".")
+        self.whole = int(whole) if whole else 0
+        self.fraction = fraction.rstrip("0")
+        # Digit strings without trailing zeros order as the fractions they are
+        self.sortKey = (self.whole, self.fraction)
+        
+    @staticmethod
+    def of(id):
+        try:
+            return _FILEIDS[id]
+        except KeyError:
+            return _FILEIDS.setdefault(id, FMQLFileId(id))
+            
+    def __lt__(self, other):
+        return self.sortKey < other.sortKey
+        
+    def __le__(self, other):
+        return self.sortKey <= other.sortKey
+        
+    def __gt__(self, other):
+        return self.sortKey > other.sortKey
+        
+    def __ge__(self, other):
+        return self.sortKey >= other.sortKey
+
+    # Equal as they order ie/ "9.64", "9_64" and "9.640" are one id
+    def __eq__(self, other):
+        if not isinstance(other, FMQLFileId):
+            return NotImplemented
+        return self.sortKey == other.sortKey
+
+    def __ne__(self, other):
+        if not isinstance(other, FMQLFileId):
+            return NotImplemented
+        return self.sortKey != other.sortKey
+
+    def __hash__(self):
+        return hash(self.sortKey)
+
+    def __str__(self):
+        return str(self.dotted)
+        
+    def __repr__(self):
+        return "FMQLFileId(%s)" % self.dotted
+        
+_FILEIDS = {}
+
+def fileIdSortKey(id):
+    """For sorted(..., key=fileIdSortKey) of file or field ids"""
+    return FMQLFileId.of(id).sortKey
+    
+"""
+FOIA GOLD doesn't have the files under 1.1 (TODO: once FOIA up, include under 1.1)
+"""
+FIRST_FILE_ID = FMQLFileId.of("1.1")
                     
 class FMQLDescribeResult(object):
     """
@@ -309,7 +892,15 @@ class FMQLDescribeResult(object):
         """
         return self.__noSpecificValues(self.__result)
         
-    def __noSpecificValues(self, dr):
+    def tallySpecificValues(self, tally):
+        """
+        As noSpecificValues but also adds the count of each field to 'tally'
+        (a dictionary). Fields in cnodes are qualified by their cnode field
+        ie/ "file/send_full_or_partial_dd".
+        """
+        return self.__noSpecificValues(self.__result, tally)
+        
+    def __noSpecificValues(self, dr, tally=None, prefix=""):
         no = 0
         for field, value in dr.items():
             if field == "uri": # CNodes - no need
@@ -317,9 +908,11 @@ class FMQLDescribeResult(object):
             if value["type"] == "cnodes":
                 if "stopped" not in value:
                     for cnode in value["value"]:
-                        no += self.__noSpecificValues(cnode)
+                        no += self.__noSpecificValues(cnode, tally, prefix + field + "/")
                 continue
             no += 1
+            if tally is not None:
+                tally[prefix + field] = tally.get(prefix + field, 0) + 1
         return no
         
     def cnodes(self, cnodeField):
@@ -374,29 +967,46 @@ class ThreadedQueriesCacher(threading.Thread):
       - pool manages the overall task queue ie/ queriesQueue ie/ ala tie in to rpc pool
     - check out Twisted as an alternative
     """
-    def __init__(self, fmqlIF, queriesQueue, cacheLocation):
+    def __init__(self, fmqlIF, queriesQueue, cacheLocation, journal=None):
         threading.Thread.__init__(self)
         self.__fmqlIF = fmqlIF
         self.__queriesQueue = queriesQueue
         self.__cacheLocation = cacheLocation
+        self.__journal = journal
         
     def run(self):
+        """
+        A failed query or cache write is journaled as FAILED. Either way the
+        query is marked done in the queue so a fill's join can't hang.
+        """
         while True:
             query = self.__queriesQueue.get()
-            reply = self.__fmqlIF.query(query)
-            # Making sure no corruption - could still return a reply with "error"
-            try: 
-                jreply = json.loads(reply)
-            except:
-                logging.error("Failed to retrieve %s" % query)
-            else:
-                jcache = open(self.__cacheLocation + "/" + query + ".json", "w")
-                jcache.write(reply)
-                jcache.close()
-                logging.info("Caching data from query %s" % query)
+            try:
+                self.__cacheQuery(query)
+            except Exception as e:
+                logging.error("Failed to retrieve or cache %s - %s" % (query, str(e)))
+                if self.__journal:
+                    try:
+                        self.__journal.failed(query, str(e))
+                    except Exception as je:
+                        logging.error("... and couldn't journal the failure - %s" % str(je))
+            finally:
                 # Monitoring progress with self.__queriesQueue.qsize():
                 # - Problem with pool == 20 or so. Get 0 for last ones and then a hang.
-            self.__queriesQueue.task_done()
+                self.__queriesQueue.task_done()
+
+    def __cacheQuery(self, query):
+        if self.__journal:
+            self.__journal.started(query)
+        reply = self.__fmqlIF.query(query)
+        # Making sure no corruption - could still return a reply with "error"
+        CODEC.loads(reply)
+        with PROFILE.span("cache.write"):
+            writeCacheFile(self.__cacheLocation + "/" + query + ".json", reply)
+        PROFILE.count("cache.bytesWritten", len(reply))
+        if self.__journal:
+            self.__journal.done(query)
+        logging.info("Caching data from query %s" % query)
             
 class FMQLInterface(object):
     """
@@ -411,18 +1021,40 @@ class FMQLInterface(object):
     the RPC pool size at any one time.
     
     Note: copy of fmqlc utility. 
+    
+    An optional limiter (rateLimiter) holds queries to a set rate and number
+    in flight.
     """
-    def __init__(self, fmqlEP=None, rpcCPool=None):
+    def __init__(self, fmqlEP=None, rpcCPool=None, limiter=None):
         self.fmqlEP = fmqlEP
         self.rpcCPool = rpcCPool
+        self.limiter = limiter
         if not (fmqlEP or rpcCPool):
             raise Exception("Must specific either an RPC CPool or an FMQL EP")
     
+    def warmUp(self, number):
+        """
+        Connect RPC connections ahead of a burst of queries (if the pool can)
+        """
+        if self.rpcCPool and hasattr(self.rpcCPool, "warmUp"):
+            self.rpcCPool.warmUp(number)
+    
+    @PROFILE.timed("fmql.query")
     def query(self, query):
-        if self.rpcCPool:
-            reply = self.rpcCPool.invokeRPC("CG FMQL QP", [self.__queryToRPCForm(query)])
-            return reply
-        return urllib2.urlopen(self.fmqlEP + "?" + urllib.urlencode({"fmql": query})).read()
+        PROFILE.count("fmql.queries")
+        if self.limiter:
+            start = self.limiter.acquire()
+        reply = ""
+        try:
+            if self.rpcCPool:
+                reply = self.rpcCPool.invokeRPC("CG FMQL QP", [self.__queryToRPCForm(query)])
+            else:
+                reply = urllib2.urlopen(self.fmqlEP + "?" + urllib.urlencode({"fmql": query})).read()
+        finally:
+            if self.limiter:
+                self.limiter.release(start, len(reply))
+        PROFILE.count("fmql.bytesReceived", len(reply))
+        return reply
     
     QUERYFORMS = { # TODO: enforce mandatory
         "COUNT": ["COUNT", [("TYPE", "COUNT ([\d\_]+)")]],
@@ -0,0 +1,143 @@
+#
+## JSON Codec
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+Module for the JSON codec that FMQL replies are decoded (and encoded) with -
+the fastest installed of:
+- ujson: fastest but has no object_pairs_hook so replies to be interned are
+walked after decoding
+- simplejson (with its C speedups)
+- json (the standard library's)
+
+Set VDM_JSON_CODEC (ujson, simplejson or json) to pick one.
+
+All take and give the same JSON so caches written with one are read by the
+others.
+
+  from jsonCodec import CODEC
+  reply = CODEC.loads(data)
+
+Run the module with a cache directory or a zip of one (defaults to GOLD) to
+see each installed codec's decode throughput:
+
+  $ python jsonCodec.py ../resources/GOLD.zip
+"""
+
+import os
+import json
+import logging
+
+__all__ = ['JSONCodec', 'CODEC', 'availableCodecs']
+
+class JSONCodec(object):
+    """
+    loads and dumps of one JSON module.
+
+    pairsHook is True if loads can take an object_pairs_hook.
+    """
+    def __init__(self, name, module, pairsHook):
+        self.name = name
+        self.pairsHook = pairsHook
+        self.__loads = module.loads
+        self.__dumps = module.dumps
+
+    def loads(self, s, object_pairs_hook=None):
+        """
+        Decode. object_pairs_hook is applied after decoding if the module
+        can't take it.
+        """
+        if object_pairs_hook is None:
+            return self.__loads(s)
+        if self.pairsHook:
+            return self.__loads(s, object_pairs_hook=object_pairs_hook)
+        return _rehook(self.__loads(s), object_pairs_hook)
+
+    def load(self, fp, object_pairs_hook=None):
+        return self.loads(fp.read(), object_pairs_hook)
+
+    def dumps(self, obj):
+        return self.__dumps(obj)
+
+    def __str__(self):
+        return "JSON codec %s" % self.name
+
+def _rehook(obj, object_pairs_hook):
+    """
+    Rebuild decoded dicts with object_pairs_hook as json would have, inner
+    objects first
+    """
+    if isinstance(obj, dict):
+        return object_pairs_hook([(key, _rehook(value, object_pairs_hook)) for key, value in obj.iteritems()])
+    if isinstance(obj, list):
+        return [_rehook(value, object_pairs_hook) for value in obj]
+    return obj
+
+def availableCodecs():
+    """
+    Installed codecs, fastest first
+    """
+    codecs = []
+    try:
+        import ujson
+        codecs.append(JSONCodec("ujson", ujson, False))
+    except ImportError:
+        pass
+    try:
+        import simplejson
+        codecs.append(JSONCodec("simplejson", simplejson, True))
+    except ImportError:
+        pass
+    codecs.append(JSONCodec("json", json, True))
+    return codecs
+
+def _pickCodec():
+    codecs = availableCodecs()
+    wanted = os.environ.get("VDM_JSON_CODEC")
+    if wanted:
+        for codec in codecs:
+            if codec.name == wanted:
+                return codec
+        logging.info("JSON codec %s isn't installed - using %s" % (wanted, codecs[0].name))
+    return codecs[0]
+
+# The process's codec
+CODEC = _pickCodec()
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    Decode throughput (MB a second) of each installed codec over the replies
+    of a cache - plain and with FMQLCacher's interning
+    """
+    import sys
+    import time
+    from zipfile import ZipFile
+    from fmqlCacher import FMQLSymbolTable
+    location = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "GOLD.zip")
+    if location.endswith(".zip"):
+        zipFile = ZipFile(location)
+        replies = [zipFile.read(name) for name in zipFile.namelist() if name.endswith(".json")]
+    else:
+        replies = []
+        for path, dirs, files in os.walk(location):
+            replies.extend(open(os.path.join(path, name)).read() for name in files if name.endswith(".json"))
+    noBytes = sum(len(reply) for reply in replies)
+    print "%d replies, %.1f MB from %s" % (len(replies), noBytes / 1048576.0, location)
+    for codec in availableCodecs():
+        for label, hook in [("plain", None), ("interned", "intern")]:
+            symbols = FMQLSymbolTable()
+            pairsHook = symbols.internPairs if hook else None
+            start = time.time()
+            for reply in replies:
+                codec.loads(reply, pairsHook)
+            elapsed = time.time() - start
+            print "%-10s %-8s %8.1f MB/s (%.2fs)" % (codec.name, label, noBytes / 1048576.0 / elapsed if elapsed else 0, elapsed)
+
+if __name__ == "__main__":
+    demo()
@@ -0,0 +1,198 @@
+#
+## Rate Limiter
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+Module for holding queries to a VistA to a set load - queries a second,
+queries in flight at once and bytes a second. A cache fill otherwise sends as
+fast as its threads (15) can go which a production VistA's clinical users will
+feel.
+
+Queries a second and bytes a second are token buckets: tokens refill at the
+rate up to a burst and a query waits until there's one for it. Bytes are only
+known once a reply is in so a reply's bytes are charged after it and the next
+query waits out any debt.
+
+With feedback (adaptive) on, reply times are tracked (moving average). When
+the average goes over the target - given or twice the best average seen - the
+limits are halved (down to a tenth). While under it, they creep back up. A
+busy VistA slows its fill down.
+
+  limiter = RateLimiter(qps=5, maxInFlight=4, bytesPerSecond=500000, adaptive=True)
+  start = limiter.acquire()
+  reply = ... query ...
+  limiter.release(start, len(reply))
+
+Waits are timed as "rate.wait" in the run's PROFILE.
+
+TODO:
+- per VistA limits from a configuration file
+"""
+
+import time
+import logging
+import threading
+from runProfile import PROFILE
+
+__all__ = ['RateLimiter', 'TokenBucket']
+
+class TokenBucket(object):
+    """
+    Tokens refill at 'rate' a second up to 'burst'. Thread safe.
+    """
+    def __init__(self, rate, burst=None):
+        self.__lock = threading.Lock()
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(1.0, self.rate)
+        self.__tokens = self.burst
+        self.__last = time.time()
+
+    def setRate(self, rate):
+        with self.__lock:
+            self.__refill()
+            self.rate = float(rate)
+
+    def reserve(self, amount=1):
+        """
+        Take amount tokens, going into debt if there aren't enough. Returns
+        the seconds to wait before using them.
+        """
+        with self.__lock:
+            self.__refill()
+            self.__tokens -= amount
+            return -self.__tokens / self.rate if self.__tokens < 0 else 0
+
+    def debt(self):
+        """
+        Seconds until the bucket is out of debt (0 if it isn't in debt)
+        """
+        with self.__lock:
+            self.__refill()
+            return -self.__tokens / self.rate if self.__tokens < 0 else 0
+
+    def __refill(self):
+        now = time.time()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+class RateLimiter(object):
+    """
+    Queries a second, queries in flight and bytes a second, any or all, with
+    optional latency feedback. See the module description.
+    """
+
+    # weight of the latest reply time in the moving average
+    LATENCY_WEIGHT = 0.2
+    # don't adjust for feedback more often than this (seconds)
+    ADJUST_EVERY = 1.0
+    # limits are never cut below this share of those set
+    MIN_SCALE = 0.1
+
+    def __init__(self, qps=None, maxInFlight=None, bytesPerSecond=None, adaptive=False, targetLatency=None):
+        if adaptive and not (qps or maxInFlight):
+            raise Exception("Adaptive rate limiting needs a queries a second or in flight limit to adjust")
+        self.qps = qps
+        self.maxInFlight = maxInFlight
+        self.bytesPerSecond = bytesPerSecond
+        self.adaptive = adaptive
+        self.targetLatency = targetLatency
+        self.__queries = TokenBucket(qps) if qps else None
+        # a second's worth of bytes can go at once
+        self.__bytes = TokenBucket(bytesPerSecond) if bytesPerSecond else None
+        self.__inFlightLock = threading.Condition()
+        self.__inFlight = 0
+        self.__inFlightLimit = maxInFlight
+        self.__feedbackLock = threading.Lock()
+        self.__scale = 1.0
+        self.__latency = None
+        self.__bestLatency = None
+        self.__lastAdjust = time.time()
+
+    def acquire(self):
+        """
+        Wait until a query may go. Returns its start time (for release)
+        """
+        start = time.time()
+        if self.__inFlightLimit:
+            with self.__inFlightLock:
+                while self.__inFlight >= self.__inFlightLimit:
+                    self.__inFlightLock.wait()
+                self.__inFlight += 1
+        wait = self.__queries.reserve() if self.__queries else 0
+        if self.__bytes:
+            wait = max(wait, self.__bytes.debt())
+        if wait:
+            time.sleep(wait)
+        now = time.time()
+        if now - start > 0.001:
+            PROFILE.addSpan("rate.wait", now - start)
+        return now
+
+    def release(self, start, noBytes=0):
+        """
+        A query that went at 'start' is done and its reply was noBytes long
+        """
+        if self.__inFlightLimit:
+            with self.__inFlightLock:
+                self.__inFlight -= 1
+                self.__inFlightLock.notify()
+        if self.__bytes and noBytes:
+            self.__bytes.reserve(noBytes)
+        if self.adaptive:
+            self.__feedback(time.time() - start)
+
+    def stats(self):
+        return {"scale": self.__scale, "latency": self.__latency, "bestLatency": self.__bestLatency, "inFlight": self.__inFlight, "inFlightLimit": self.__inFlightLimit, "qps": self.__queries.rate if self.__queries else None}
+
+    def __feedback(self, latency):
+        with self.__feedbackLock:
+            self.__latency = latency if self.__latency is None else (RateLimiter.LATENCY_WEIGHT * latency + (1 - RateLimiter.LATENCY_WEIGHT) * self.__latency)
+            if self.__bestLatency is None or self.__latency < self.__bestLatency:
+                self.__bestLatency = self.__latency
+            now = time.time()
+            if now - self.__lastAdjust < RateLimiter.ADJUST_EVERY:
+                return
+            self.__lastAdjust = now
+            targetLatency = self.targetLatency if self.targetLatency else 2 * self.__bestLatency
+            if self.__latency > targetLatency and self.__scale > RateLimiter.MIN_SCALE:
+                scale = max(RateLimiter.MIN_SCALE, self.__scale / 2)
+                logging.info("Rate limiter: replies taking %.3fs (target %.3fs) - backing off to %d%% of the limits" % (self.__latency, targetLatency, scale * 100))
+            elif self.__latency <= targetLatency and self.__scale < 1.0:
+                scale = min(1.0, self.__scale + 0.1)
+            else:
+                return
+            self.__scale = scale
+        if self.__queries:
+            self.__queries.setRate(self.qps * scale)
+        if self.maxInFlight:
+            with self.__inFlightLock:
+                self.__inFlightLimit = max(1, int(round(self.maxInFlight * scale)))
+                self.__inFlightLock.notifyAll()
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    Ten threads sending 50 pretend queries at 20 a second, 4 at a time
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    limiter = RateLimiter(qps=20, maxInFlight=4, adaptive=True)
+    def sender():
+        for i in range(5):
+            start = limiter.acquire()
+            time.sleep(0.05)
+            limiter.release(start, 1000)
+    start = time.time()
+    senders = [threading.Thread(target=sender) for i in range(10)]
+    for s in senders:
+        s.start()
+    for s in senders:
+        s.join()
+    print "50 queries in %.2fs - %s" % (time.time() - start, limiter.stats())
+
+if __name__ == "__main__":
+    demo()
@@ -0,0 +1,145 @@
+#
+## Run Profile
+#
+# (c) 2012 Caregraf
+#
+# Apache License Version 2.0, January 2004
+#
+
+"""
+Module for timing and counting the stages of a run - RPC connect and handshake,
+query round trips, cache reads and decodes, indexing, comparing and writing
+reports.
+
+Stages are timed as named spans and totalled per name (number, total, max
+seconds). Counters total bytes, queries, cache hits and the like. The profile
+of a run is a JSON document:
+
+  {"spans": {"fmql.query": {"count": 20, "seconds": 3.1, "max": 0.4}, ...},
+   "counters": {"cache.hits": 120, ...}, "elapsed": 12.6}
+
+Names are dotted - the first piece is the layer (rpc, fmql, cache, index,
+compare, report). Spans and counters are thread safe as the Cacher fills
+with a pool of threads.
+
+cProfile can also be wrapped around a call (cProfiled) for a function level
+profile.
+
+TODO:
+- nest spans per VistA ie/ GOLD's index.schema vs the other's
+"""
+
+import time
+import json
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+__all__ = ['RunProfile', 'PROFILE', 'cProfiled']
+
+class RunProfile(object):
+    """
+    Spans and counters of a run. Use the process's PROFILE.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__start = time.time()
+            self.__spans = {}
+            self.__counters = {}
+
+    @contextmanager
+    def span(self, name):
+        """
+        with PROFILE.span("cache.read"):
+            ...
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addSpan(name, time.time() - start)
+
+    def timed(self, name):
+        """
+        Decorator - the span of every call of a function or method
+        """
+        def decorator(fn):
+            @wraps(fn)
+            def timedFn(*args, **kwargs):
+                start = time.time()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.addSpan(name, time.time() - start)
+            return timedFn
+        return decorator
+
+    def addSpan(self, name, seconds):
+        with self.__lock:
+            span = self.__spans.get(name)
+            if span is None:
+                self.__spans[name] = {"count": 1, "seconds": seconds, "max": seconds}
+                return
+            span["count"] += 1
+            span["seconds"] += seconds
+            if seconds > span["max"]:
+                span["max"] = seconds
+
+    def count(self, name, amount=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def counter(self, name):
+        return self.__counters.get(name, 0)
+
+    def snapshot(self):
+        """
+        The profile so far (copy) - see module description
+        """
+        with self.__lock:
+            return {"spans": dict((name, dict(span)) for name, span in self.__spans.iteritems()), "counters": dict(self.__counters), "elapsed": time.time() - self.__start}
+
+    def dump(self, where):
+        """
+        Write the profile so far as JSON
+        """
+        profileFile = open(where, "w")
+        json.dump(self.snapshot(), profileFile, indent=2, sort_keys=True)
+        profileFile.close()
+
+# The process's profile - all modules time and count into this
+PROFILE = RunProfile()
+
+def cProfiled(statsFile, fn, *args, **kwargs):
+    """
+    Invoke fn under cProfile, writing its stats to statsFile (read with pstats)
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        profiler.dump_stats(statsFile)
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    Profile reading CGVISTA's builds from the Cache
+    """
+    import logging
+    from fmqlCacher import FMQLCacher
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    cacher = FMQLCacher("Caches")
+    cacher.setVista("CGVISTA", "http://vista.caregraf.org/fmqlEP")
+    with PROFILE.span("demo.builds"):
+        for entry in cacher.describeFileEntries("9_6", limit=200, cstop=10000):
+            pass
+    print json.dumps(PROFILE.snapshot(), indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    demo()
@@ -18,8 +18,12 @@ import sys
 from datetime import timedelta, datetime 
 import logging
 import operator
+import heapq
+from bisect import bisect_left, bisect_right
 from collections import OrderedDict, defaultdict
-from copies.fmqlCacher import FMQLDescribeResult
+from copies.fmqlCacher import FMQLDescribeResult, SYMBOLS, FMQLFileId, FIRST_FILE_ID
+from vistaRecords import BuildRecord, BuildFileRecord, InstallRecord
+from copies.runProfile import PROFILE
 
 __all__ = ['VistaBuilds']
 
@@ -51,12 +55,17 @@ class VistaBuilds(object):
     def __str__(self):
         return "Builds of %s" % self.vistaLabel
         
-    def getNoSpecificValues(self):
+    def getNoSpecificValues(self, tabulate=False):
         """
         How many datapoints are available <=> number of fields in indexed entries
         
-        TODO: expand for tabulation - show file/field=# 
+        With 'tabulate', returns the counts by file and field ie/ 
+        {"9_6": {"name": 2000, "file/send_full_or_partial_dd": 400 ...}, "9_7": {...}}
+        
+        Counted once when the Cache is first indexed and then kept in the Cache.
         """
+        if tabulate:
+            return self.__noSpecificValuesByFile
         return self.__noSpecificValues
         
     def listPackages(self):
@@ -68,17 +77,56 @@ class VistaBuilds(object):
     def getBuildsOfPackage(self, packageName):
         return self.__buildsByPackageName[packageName]
                                           
-    def listBuilds(self, installedOnly=True):
+    def listBuilds(self, installedOnly=True, asOf=None):
         """
         Returns list of build names in Build file order if all builds requested and
         in active/installed order if ask for 'installedOnly'
+        
+        'asOf' (an FMQL date/time ex/ "2011-03-01T00:00:00") gives the builds
+        installed at that time, in the order of their last install before it.
         """
+        if asOf:
+            return self.listBuildsInstalledAsOf(asOf)
         if installedOnly:
             return list(self.__buildAboutsInstalled)
         return list(self.__buildAbouts)
         
+    def getInstallTimeline(self):
+        """
+        Installs and de-installs in time order ie/ [(time, build name, "INSTALLED" or "DE_INSTALLED")]
+        
+        Only completed installs and de-installs are effects. Installs without
+        a time aren't on the timeline. 
+        """
+        return list(self.__timeline)
+        
+    def listBuildsInstalledBetween(self, start, end):
+        """
+        Builds whose install completed between start and end (inclusive) in
+        install order. A date only end (ex/ "2011-03-31") includes that day.
+        
+        Bisects the timeline - log time plus the number of installs returned.
+        """
+        if len(end) == 10:
+            end += "T24:00:00"
+        first = bisect_left(self.__timelineTimes, start)
+        last = bisect_right(self.__timelineTimes, end)
+        return [name for time, name, effect in self.__timeline[first:last] if effect == "INSTALLED"]
+        
+    def listBuildsInstalledAsOf(self, date):
+        """
+        Builds installed as of a date, in the order of their last install. 
+        
+        Every install is an interval, from its time to the time of the build's 
+        next install or de-install. The intervals open at 'date' come from an
+        InstallIntervals index - log time plus the number of builds returned.
+        """
+        return self.__installIntervals.openAt(date)
+        
     def describeBuild(self, buildName):
         """
+        Returns a BuildRecord which reads like the flattened FMQL description.
+        
         Fields of interest:
         - vse:ien
         - [type] "SINGLE PACKAGE", "MULTI-PACKAGE", "GLOBAL PACKAGE"
@@ -93,19 +141,30 @@ class VistaBuilds(object):
     def getFiles(self, installedOnly=True):
         """
         All files created/updated in the build system with list of builds effecting them
+        ie/ {file id: [build names]}. Installed builds are in install order, all builds
+        in Build file order.
+        
+        Indexed along with the builds - returns that index (don't change it).
                 
         Precise Query: DESCRIBE 9_64 IN %s CSTOP 1000
         """
-        fls = defaultdict(list)
-        for buildName, buildFiles in self.__buildFiles.items():
-            if installedOnly and buildName not in self.__buildAboutsInstalled:
-                continue
-            for buildFile in buildFiles:
-                # TODO: remove once FOIA GOLD has this stuff (will go from Cache too)
-                if float(buildFile["vse:file_id"]) < 1.1:
-                    continue
-                fls[buildFile["vse:file_id"]].append(buildName)
-        return fls
+        return self.__installedFileBuilds if installedOnly else self.__fileBuilds
+        
+    def describeFileBuilds(self, fileId, installedOnly=True):
+        """
+        Builds effecting a file, ordered as in getFiles, with how each effects it
+        ie/ [(build name, install order (None if not installed), build file)] where
+        the build file (see describeBuildFiles) has the action flags - 
+        send_full_or_partial_dd, update_the_data_dictionary, data_comes_with_file ...
+        """
+        buildNames = self.getFiles(installedOnly).get(fileId, [])
+        fileBuilds = []
+        for buildName in buildNames:
+            for buildFile in self.__buildFiles[buildName]:
+                if buildFile["vse:file_id"] == fileId:
+                    fileBuilds.append((buildName, self.__installOrder.get(buildName), buildFile))
+                    break
+        return fileBuilds
                 
     def describeBuildFiles(self, buildName):
         """
@@ -113,6 +172,7 @@ class VistaBuilds(object):
         
         Fields:
         vse:file_id (from 'file')
+        vse:file_number (vse:file_id parsed - FMQLFileId)
         data_comes_with_file
         send_full_or_partial_dd
         update_the_data_dictionary
@@ -133,8 +193,23 @@ class VistaBuilds(object):
         """
         return [] if buildName not in self.__buildGlobals else self.__buildGlobals[buildName]
                         
-    def getRoutines(self):
-        pass
+    def getRoutines(self, installedOnly=True):
+        """
+        Routines sent or deleted by builds with the builds that name them ie/
+        {routine: [build names]}. Installed builds are in install order (last
+        is the last to touch the routine); all builds are in Build file order.
+        
+        Indexed along with the builds - returns that index (don't change it).
+        """
+        return self.__installedRoutineBuilds if installedOnly else self.__routineBuilds
+        
+    def getLastBuildOfRoutine(self, routineName):
+        """
+        The installed build that last touched a routine (None if no installed
+        build names it)
+        """
+        builds = self.__installedRoutineBuilds.get(routineName)
+        return builds[-1] if builds else None
         
     def describeBuildRoutines(self, buildName):
         """
@@ -160,8 +235,19 @@ class VistaBuilds(object):
         """
         pass
         
-    def getRPCs(self):
-        pass
+    def getRPCs(self, installedOnly=True):
+        """
+        RPCs sent or deleted by builds with the builds that name them ie/
+        {rpc: [build names]}. Order as for getRoutines.
+        """
+        return self.__installedRPCBuilds if installedOnly else self.__rpcBuilds
+        
+    def getLastBuildOfRPC(self, rpcName):
+        """
+        The installed build that last touched an RPC (None if none did)
+        """
+        builds = self.__installedRPCBuilds.get(rpcName)
+        return builds[-1] if builds else None
         
     def describeBuildRPCs(self, buildName):
         """
@@ -191,6 +277,7 @@ class VistaBuilds(object):
         
     __ALL_LIMIT = 200
                 
+    @PROFILE.timed("index.builds")
     def __indexNCleanBuilds(self):
         """
         Index and clean builds - will force caching if not already in cache
@@ -201,7 +288,11 @@ class VistaBuilds(object):
         """
         logging.info("%s: Builds - building Builds Index ..." % self.vistaLabel)
         start = datetime.now()
-        self.__noSpecificValues = 0
+        # Datapoint counts are kept in the Cache - only count if not there
+        self.__noSpecificValuesByFile = self.__fmqlCacher.cachedDigest("NOSPECIFICVALUES 9_6 9_7")
+        countValues = self.__noSpecificValuesByFile is None
+        if countValues:
+            self.__noSpecificValuesByFile = {"9_6": {}, "9_7": {}}
         # TODO: move to dict of dicts. Dynamic naming.
         self.__buildAbouts = OrderedDict()
         self.__buildFiles = {}
@@ -210,36 +301,47 @@ class VistaBuilds(object):
         self.__buildGlobals = {}
         self.__buildRoutines = {} # from build components
         self.__buildRPCs = {} # from build components
+        self.__routineBuilds = {} # routine -> builds, in build order
+        self.__rpcBuilds = {} # rpc -> builds, in build order
+        self.__fileBuilds = {} # file id -> builds, in build order
         self.__buildsByPackageName = defaultdict()
         self.__packages = {}
         limit = 1000 if self.vistaLabel == "GOLD" else VistaBuilds.__ALL_LIMIT
         for i, buildResult in enumerate(self.__fmqlCacher.describeFileEntries("9_6", limit=limit, cstop=10000)):
             # logging.info("... build result %d" % i)
             dr = FMQLDescribeResult(buildResult)
-            self.__noSpecificValues += dr.noSpecificValues()
+            if countValues:
+                dr.tallySpecificValues(self.__noSpecificValuesByFile["9_6"])
             name = buildResult["name"]["value"]
             if name in self.__buildAbouts:
                 raise Exception("Two builds in this VistA have the same name %s - breaks assumptions" % name)
             # Don't show FMQL itself
             if re.match(r'CGFMQL', name):
                 continue
-            self.__buildAbouts[name] = dr.cstopped(flatten=True)
+            self.__buildAbouts[name] = BuildRecord(dr.cstopped(flatten=True))
             if "package_file_link" in buildResult:
-                packageName = buildResult["package_file_link"]["label"].split("/")[1]
+                packageName = SYMBOLS.intern(buildResult["package_file_link"]["label"].split("/")[1])
                 self.__buildAbouts[name]["vse:package_name"] = packageName
                 # VAVISTA/FMQL bug? {u'fmId': u'1', u'fmType': u'7', u'type': u'uri', u'value': u'9_4-RADIOLOGY/NUCLEAR MEDICINE', u'label': u'PACKAGE/RADIOLOGY_NUCLEAR MEDICINE'}
                 packageId = buildResult["package_file_link"]["value"] if not re.search(r'[A-Za-z]', buildResult["package_file_link"]["value"]) else "9_4-10000"
                 self.__buildAbouts[name]["vse:package"] = packageId
                 self.__buildsByPackageName[packageName] = name
                 self.__packages[packageId] = packageName
-            self.__buildAbouts[name]["vse:ien"] = buildResult["uri"]["value"].split("-")[1]
+            self.__buildAbouts[name]["vse:ien"] = SYMBOLS.intern(buildResult["uri"]["value"].split("-")[1])
             self.__buildAbouts[name]["vse:status"] = "NEVER_INSTALLED" # overridden below
             if "file" in dr.cnodeFields():
                 # catch missing 'file'. TBD: do verify version?
-                self.__buildFiles[name] = [cnode for cnode in dr.cnodes("file") if "file" in cnode]
+                self.__buildFiles[name] = [BuildFileRecord(cnode) for cnode in dr.cnodes("file") if "file" in cnode]
                 # turn 1- form into straight file id. Note dd_number is optional
                 for fileAbout in self.__buildFiles[name]:
-                    fileAbout["vse:file_id"] = fileAbout["file"][2:]
+                    fileAbout["vse:file_id"] = SYMBOLS.intern(fileAbout["file"][2:])
+                    fileAbout["vse:file_number"] = FMQLFileId.of(fileAbout["vse:file_id"])
+                    # TODO: remove once FOIA GOLD has this stuff (will go from Cache too)
+                    if fileAbout["vse:file_number"] < FIRST_FILE_ID:
+                        continue
+                    if fileAbout["vse:file_id"] not in self.__fileBuilds:
+                        self.__fileBuilds[fileAbout["vse:file_id"]] = []
+                    self.__fileBuilds[fileAbout["vse:file_id"]].append(name)
             if "global" in dr.cnodeFields():
                 self.__buildGlobals[name] = [cnode for cnode in dr.cnodes("global") if "global" in cnode]
             if "multiple_build" in dr.cnodeFields():                
@@ -257,8 +359,10 @@ class VistaBuilds(object):
                         continue
                     if bc["build_component"] == "1-8994":
                         self.__buildRPCs[name] = bc["entries"] 
+                        self.__indexEntries(self.__rpcBuilds, name, bc["entries"])
                     if bc["build_component"] == "1-9.8":
                         self.__buildRoutines[name] = bc["entries"]
+                        self.__indexEntries(self.__routineBuilds, name, bc["entries"])
                     continue
         logging.info("%s: Indexing, cleaning (with caching) %d builds took %s" % (self.vistaLabel, len(self.__buildAbouts), datetime.now()-start))
         self.__installAbouts = OrderedDict()
@@ -269,15 +373,19 @@ class VistaBuilds(object):
                 logging.error("No 'status' in install %s" % installResult["uri"]["value"])
                 continue
             ir = FMQLDescribeResult(installResult)
-            self.__noSpecificValues += ir.noSpecificValues()            
+            if countValues:
+                ir.tallySpecificValues(self.__noSpecificValuesByFile["9_7"])
             name = installResult["name"]["value"]
             # Don't show FMQL itself
             if re.match(r'CGFMQL', name):
                 continue
             if name not in self.__installAbouts:
                 self.__installAbouts[name] = []
-            self.__installAbouts[name].append(ir.cstopped(flatten=True)) 
+            self.__installAbouts[name].append(InstallRecord(ir.cstopped(flatten=True)))
             noInstalls += 1
+        if countValues:
+            self.__fmqlCacher.cacheDigest("NOSPECIFICVALUES 9_6 9_7", self.__noSpecificValuesByFile)
+        self.__noSpecificValues = sum(sum(fieldCounts.values()) for fieldCounts in self.__noSpecificValuesByFile.values())
             
         # Finally let's go through these installs (in order), all have status
         # and note various aspects of the build like if still installed, last install
@@ -305,9 +413,135 @@ class VistaBuilds(object):
                         del self.__buildAboutsInstalled[name]
                     else:
                         logging.error("De-installing an uninstalled build: %s" % installInfo["uri"])
+        self.__indexInstallTimeline()
+        self.__installOrder = dict((name, i) for i, name in enumerate(self.__buildAboutsInstalled))
+        self.__installedFileBuilds = self.__installedView(self.__fileBuilds)
+        self.__installedRoutineBuilds = self.__installedView(self.__routineBuilds)
+        self.__installedRPCBuilds = self.__installedView(self.__rpcBuilds)
 
         logging.info("%s: Indexing, cleaning (with caching) %d builds, %d installs took %s" % (self.vistaLabel, len(self.__buildAbouts), noInstalls, datetime.now()-start))    
+        
+    def __indexEntries(self, index, buildName, entries):
+        """Note a build against each entry (routine, rpc) it names"""
+        for entry in entries:
+            if "entries" not in entry:
+                continue
+            entryName = SYMBOLS.intern(entry["entries"])
+            if entryName not in index:
+                index[entryName] = []
+            index[entryName].append(buildName)
+            
+    def __installedView(self, index):
+        """
+        Reverse index (x -> builds in build order) of installed builds only,
+        in install order. Entries no installed build names are dropped.
+        """
+        installOrder = self.__installOrder
+        installedIndex = {}
+        for key, buildNames in index.iteritems():
+            installed = [buildName for buildName in buildNames if buildName in installOrder]
+            if installed:
+                installedIndex[key] = sorted(installed, key=installOrder.__getitem__)
+        return installedIndex
+        
+    def __indexInstallTimeline(self):
+        """
+        Sorted timeline of install effects and the intervals in which builds
+        were installed. FMQL date/times (2011-03-01T10:22:00) sort as strings.
+        
+        De-installs have no time of their own (see TODO above). One without
+        an install start time ends its build's interval where it began ie/ the
+        build drops from all "as of" views. An install without a time is
+        skipped - it leaves an open interval open rather than ending it.
+        """
+        events = []
+        for name, installInfos in self.__installAbouts.items():
+            if name not in self.__buildAbouts:
+                continue
+            for installInfo in installInfos:
+                if installInfo["status"] == "Install Completed":
+                    time = installInfo.get("install_complete_time", installInfo.get("install_start_time", ""))
+                    effect = "INSTALLED"
+                elif installInfo["status"] == "De-Installed":
+                    time = installInfo.get("install_start_time", "")
+                    effect = "DE_INSTALLED"
+                else:
+                    continue
+                events.append((time, name, effect))
+        # stable: same time stays in install file order
+        self.__timeline = sorted([event for event in events if event[0]], key=operator.itemgetter(0))
+        self.__timelineTimes = [event[0] for event in self.__timeline]
+        intervals = []
+        openIntervals = {}
+        for time, name, effect in events:
+            if effect == "INSTALLED" and not time:
+                continue
+            if name in openIntervals:
+                interval = openIntervals.pop(name)
+                start = interval[0]
+                # untimed de-install ends the interval where it started
+                intervals.append((start, time if time else start, name))
+            if effect == "INSTALLED":
+                openIntervals[name] = (time, name)
+        intervals.extend((start, None, name) for name, (start, name) in openIntervals.items())
+        intervals.sort(key=operator.itemgetter(0))
+        self.__installIntervals = InstallIntervals(intervals)
                         
+class InstallIntervals(object):
+    """
+    Segment tree of install intervals for "as of" queries. 
+    
+    The distinct start and end times cut time into slots, and every interval
+    is stored in the O(log n) tree nodes that cover its slots. The intervals
+    open at a time are those in the nodes from the time's slot (a leaf) up to
+    the root. Each node keeps its intervals in start order so merging those 
+    of the leaf-to-root nodes gives install order - log n plus the number 
+    open.
+    
+    An interval that ends where it starts (an untimed de-install) covers no
+    slot and is never open.
+    """
+    
+    def __init__(self, intervals):
+        """
+        intervals: [(start, end or None if still open, build name)] sorted by start
+        """
+        self.__names = [name for start, end, name in intervals]
+        self.__times = sorted(set([start for start, end, name in intervals] + [end for start, end, name in intervals if end is not None]))
+        self.__size = 1
+        while self.__size < len(self.__times):
+            self.__size *= 2
+        # nodes[1] is the root, nodes[size + slot] a slot's leaf
+        self.__nodes = [[] for i in range(2 * self.__size)]
+        # intervals by index which, as they're sorted, is start order
+        for i, (start, end, name) in enumerate(intervals):
+            first = bisect_left(self.__times, start) + self.__size
+            last = (bisect_left(self.__times, end) if end is not None else len(self.__times)) + self.__size
+            while first < last:
+                if first & 1:
+                    self.__nodes[first].append(i)
+                    first += 1
+                if last & 1:
+                    last -= 1
+                    self.__nodes[last].append(i)
+                first //= 2
+                last //= 2
+            
+    def openAt(self, time):
+        """
+        Names of the builds with an interval open at 'time' in start order
+        """
+        slot = bisect_right(self.__times, time) - 1
+        if slot < 0:
+            return []
+        node = slot + self.__size
+        covering = []
+        while node:
+            if self.__nodes[node]:
+                covering.append(self.__nodes[node])
+            node //= 2
+        return [self.__names[i] for i in heapq.merge(*covering)]
+        
 # ######################## Module Demo ##########################
                        
 def demo():
@@ -20,7 +20,9 @@ import cgi
 from datetime import datetime 
 from collections import defaultdict
 from vistaBuilds import VistaBuilds
+from vistaBuildsGraph import VistaBuildsGraph
 from vdmU import HTMLREPORTHEAD, HTMLREPORTTAIL, WARNING_BLURB
+from copies.runProfile import PROFILE
 
 __all__ = ['VistaBuildsComparer']
 
@@ -54,6 +56,7 @@ class VistaBuildsComparer(object):
             except:
                 raise Exception("Bad location for Comparison Reports: %s ... exiting" % reportsLocation)
         
+    @PROFILE.timed("compare.builds")
     def compare(self, format="HTML"):
     
         if format == "HTML":
@@ -116,6 +119,21 @@ class VistaBuildsComparer(object):
         self.__buildOneOnlyReport(reportBuilder, self.__bBuilds, baseOnlyBuilds, True)
         self.__buildOneOnlyReport(reportBuilder, self.__oBuilds, otherOnlyBuilds, False)
         
+        self.__buildMissingPrerequisitesReport(reportBuilder, baseBuilds, otherBuilds)
+        
+    def __buildMissingPrerequisitesReport(self, reportBuilder, baseBuilds, otherBuilds):
+        """
+        Builds that Other's installed builds need (directly or through the
+        builds they need) but that Other doesn't have installed. Those in Base
+        are highlighted.
+        """
+        missing = VistaBuildsGraph(self.__oBuilds).missingPrerequisites(otherBuilds)
+        baseBuilds = set(baseBuilds)
+        reportBuilder.startMissingPrerequisites(len(missing), len([buildName for buildName in missing if buildName in baseBuilds]))
+        for no, buildName in enumerate(sorted(missing, key=lambda x: (x not in baseBuilds, x)), start=1):
+            reportBuilder.missingPrerequisite(no, buildName, buildName in baseBuilds, missing[buildName])
+        reportBuilder.endMissingPrerequisites()
+        
     def __buildOneOnlyReport(self, reportBuilder, builds, buildsNamesToShow, base=True):
         reportBuilder.startOneOnly(len(buildsNamesToShow), base)
         # Want builds in install order
@@ -185,7 +203,23 @@ class VBHTMLReportBuilder:
             self.__baseOnlyItems = self.__oneOnlyItems
         else:
             self.__otherOnlyItems = self.__oneOnlyItems
+            
+    def startMissingPrerequisites(self, missingCount, inBaseCount):
+        BLURB = "%d builds are needed by builds installed in %s but aren't installed there themselves. %d of these are installed in %s (highlighted). A build is needed if it is required by or part of (a multiple) an installed build or of any build that build needs in turn. 'Needed by' lists the builds that name it directly." % (missingCount, self.__oVistaLabel, inBaseCount, self.__bVistaLabel)
+        self.__missingPrerequisitesItems = ["<div class='report' id='missingPrerequisites'><h2>Prerequisites missing from %s</h2><p>%s</p>" % (self.__oVistaLabel, BLURB)]
+        self.__missingPrerequisitesItems.append("<table><tr><th>#</th><th>Name</th><th>Needed by</th></tr>")
+        
+    def missingPrerequisite(self, no, name, inBase, neededBy):
+        nameMU = "<span class='highlight'>%s</span>" % name if inBase else name
+        # Link to base only entries if in base
+        if inBase:
+            nameMU = "<a href='#%s'>%s</a>" % (name, nameMU)
+        self.__missingPrerequisitesItems.append("<tr><td>%d</td><td>%s</td><td>%s</td></tr>" % (no, nameMU, ", ".join(neededBy)))
+        
+    def endMissingPrerequisites(self):
+        self.__missingPrerequisitesItems.append("</table></div>")
                                        
+    @PROFILE.timed("report.flush")
     def flush(self):
     
         reportHead = (HTMLREPORTHEAD % ("Build Comparison Report << VOLDEMORT", " VOLDEMORT Build Comparison Report"))
@@ -194,13 +228,14 @@ class VBHTMLReportBuilder:
         
         warning = "<p><strong>Warning:</strong> %s</p>" % WARNING_BLURB if WARNING_BLURB else ""        
         # TODO: use bVistaLabel etc names
-        nav = "<p>Jump to: <a href='#otherOnly'>%s Only</a> | <a href='#baseOnly'>%s Only</a></p>" % (self.__oVistaLabel, self.__bVistaLabel)
+        nav = "<p>Jump to: <a href='#otherOnly'>%s Only</a> | <a href='#baseOnly'>%s Only</a> | <a href='#missingPrerequisites'>Missing Prerequisites</a></p>" % (self.__oVistaLabel, self.__bVistaLabel)
         
         reportTail = HTMLREPORTTAIL % datetime.now().strftime("%b %d %Y %I:%M%p")
                         
         reportItems = [reportHead, blurb, warning, self.__countsETCMU, nav]
         reportItems.extend(self.__otherOnlyItems)
         reportItems.extend(self.__baseOnlyItems)
+        reportItems.extend(self.__missingPrerequisitesItems)
         reportItems.append(reportTail)
                 
         reportFileName = self.__reportLocation + "/" + "builds%s_vs_%s.html" % (re.sub(r' ', '_', self.__bVistaLabel), re.sub(r' ', '_', self.__oVistaLabel))
@@ -227,6 +262,7 @@ class VBFormattedTextReportBuilder:
         print "{:<24}{:^6}".format("In Other:", otherTotal)
         print "{:<24}{:^6}".format("Only In Other:", otherOnly)
         
+    @PROFILE.timed("report.flush")
     def flush(self):
         # allow sys.stdout as out
         reportFileName = self.__reportLocation + "/" + "builds%s_vs_%s.txt" % (re.sub(r' ', '_', self.__bVistaLabel), re.sub(r' ', '_', self.__oVistaLabel))
@@ -0,0 +1,305 @@
+#
+## VOLDEMORT (VDM) VistA Comparer
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+Module for the dependencies between a VistA's builds - what a build requires
+(Build (9.6)/Required Build (9.611)) and the builds it bundles (Build (9.6)/
+Multiple Build (9.63)).
+
+VistaBuilds gives these per build as cnodes. Here they become a graph that
+answers "does X need Y?" and "what does this VistA lack to support the builds
+it has installed?" without walking build after build.
+
+Builds are numbered and edges kept as adjacency arrays. Strongly connected
+components (required builds can loop) are found once and the transitive
+closure of a build, kept as a bitset (long), is worked out the first time
+it's asked for and then remembered.
+
+TODO:
+- note 'action' of a required build (ex/ "DON'T INSTALL, LEAVE GLOBAL")
+- graph of GOLD and other together ie/ which GOLD build brings in a missing one
+"""
+
+import re
+import logging
+from datetime import datetime
+from copies.runProfile import PROFILE
+
+__all__ = ['VistaBuildsGraph']
+
+class VistaBuildsGraph(object):
+    """
+    Dependency graph of the builds of a VistA. A build depends on its
+    required builds and on the builds it contains (multiple builds). Builds
+    named as required but not in the VistA's build file are in the graph
+    too - "external" builds.
+    """
+
+    def __init__(self, vistaBuilds):
+        self.vistaLabel = vistaBuilds.vistaLabel
+        self.__vistaBuilds = vistaBuilds
+        self.__makeGraph()
+
+    def __str__(self):
+        return "Build Graph of %s" % self.vistaLabel
+
+    def listBuilds(self, externalOnly=False):
+        """
+        All builds in the graph. 'externalOnly' for those only named as
+        requirements.
+        """
+        if externalOnly:
+            return [self.__names[i] for i in sorted(self.__external)]
+        return list(self.__names)
+
+    def isExternal(self, buildName):
+        return self.__index[buildName] in self.__external
+
+    def describeDependencies(self, buildName):
+        """
+        Direct dependencies ie/ {"required": [...], "multiple": [...]}
+        """
+        i = self.__index[buildName]
+        return {"required": [self.__names[j] for j in self.__required[i]], "multiple": [self.__names[j] for j in self.__multiples[i]]}
+
+    def dependents(self, buildName):
+        """
+        Builds that directly require or contain this one
+        """
+        return [self.__names[j] for j in self.__dependents[self.__index[buildName]]]
+
+    def requires(self, buildName, prerequisiteName):
+        """
+        Does a build need another, directly or transitively?
+        """
+        if buildName not in self.__index or prerequisiteName not in self.__index:
+            return False
+        return True if self.__closure(self.__index[buildName]) & (1 << self.__index[prerequisiteName]) else False
+
+    def prerequisites(self, buildName):
+        """
+        Every build a build needs, directly or transitively, in topological
+        order (needed before needing)
+        """
+        return self.__namesOfBits(self.__closure(self.__index[buildName]))
+
+    def topologicalOrder(self):
+        """
+        All builds with every build after the builds it needs. Builds in a
+        dependency loop come together in no particular order.
+        """
+        return [self.__names[i] for component in self.__components for i in component]
+
+    def missingPrerequisites(self, presentBuilds, buildNames=None):
+        """
+        Builds needed by 'buildNames' (default: 'presentBuilds') that aren't
+        in 'presentBuilds'. Pass a VistA's installed builds to see what it
+        lacks.
+
+        Returns {missing build: [builds that need it directly]} where the
+        builds needing it are from 'buildNames' or are missing themselves 
+        ie/ the chain back to buildNames.
+        """
+        buildNames = presentBuilds if buildNames is None else buildNames
+        presentBits = 0
+        for buildName in presentBuilds:
+            if buildName in self.__index:
+                presentBits |= 1 << self.__index[buildName]
+        neededBits = 0
+        askingBits = 0
+        for buildName in buildNames:
+            if buildName not in self.__index:
+                continue
+            askingBits |= 1 << self.__index[buildName]
+            neededBits |= self.__closure(self.__index[buildName])
+        missingBits = neededBits & ~presentBits
+        chainBits = missingBits | askingBits
+        missing = {}
+        for missingName in self.__namesOfBits(missingBits):
+            missing[missingName] = [self.__names[j] for j in self.__dependents[self.__index[missingName]] if chainBits & (1 << j)]
+        return missing
+
+    def __namesOfBits(self, bits):
+        names = []
+        while bits:
+            low = bits & -bits
+            names.append(self.__names[low.bit_length() - 1])
+            bits ^= low
+        # bit order is build order - want topological
+        order = self.__topologicalPosition
+        return sorted(names, key=lambda name: order[self.__index[name]])
+
+    def __closure(self, i):
+        """
+        Bitset of everything build i needs - computed for its component (and
+        the components it needs) on first ask
+        """
+        component = self.__componentOf[i]
+        if self.__componentClosures[component] is None:
+            self.__closeComponent(component)
+        closure = self.__componentClosures[component]
+        # a build only needs itself if it's in a loop
+        if len(self.__components[component]) == 1 and i not in self.__edges[i]:
+            closure &= ~(1 << i)
+        return closure
+
+    def __closeComponent(self, root):
+        """
+        Components needed come earlier in topological order so close them
+        first. Iterative as chains of patches run deep.
+        """
+        closures = self.__componentClosures
+        stack = [root]
+        while stack:
+            component = stack[-1]
+            if closures[component] is not None:
+                stack.pop()
+                continue
+            pending = [c for c in self.__componentEdges[component] if closures[c] is None]
+            if pending:
+                stack.extend(pending)
+                continue
+            bits = 0
+            for i in self.__components[component]:
+                bits |= 1 << i
+            for c in self.__componentEdges[component]:
+                bits |= closures[c]
+            closures[component] = bits
+            stack.pop()
+
+    def __node(self, buildName):
+        if buildName not in self.__index:
+            self.__index[buildName] = len(self.__names)
+            self.__names.append(buildName)
+            self.__required.append([])
+            self.__multiples.append([])
+        return self.__index[buildName]
+
+    @PROFILE.timed("index.buildsGraph")
+    def __makeGraph(self):
+        logging.info("%s: Build Graph - building Build Graph ..." % self.vistaLabel)
+        start = datetime.now()
+        vistaBuilds = self.__vistaBuilds
+        self.__names = []
+        self.__index = {}
+        self.__required = []
+        self.__multiples = []
+        buildNames = vistaBuilds.listBuilds(False)
+        buildsByIEN = {}
+        for buildName in buildNames:
+            self.__node(buildName)
+            buildAbout = vistaBuilds.describeBuild(buildName)
+            if "vse:ien" in buildAbout:
+                buildsByIEN[buildAbout["vse:ien"]] = buildName
+        for buildName in buildNames:
+            i = self.__index[buildName]
+            for requiredAbout in vistaBuilds.describeBuildRequired(buildName):
+                required = self.__resolve(requiredAbout["required_build"], buildsByIEN)
+                self.__required[i].append(self.__node(required))
+            for multipleAbout in vistaBuilds.describeBuildMultiples(buildName):
+                multiple = self.__resolve(multipleAbout["multiple_build"], buildsByIEN)
+                self.__multiples[i].append(self.__node(multiple))
+        self.__external = set(range(len(buildNames), len(self.__names)))
+        self.__edges = [set(self.__required[i]).union(self.__multiples[i]) for i in range(len(self.__names))]
+        self.__dependents = [[] for i in range(len(self.__names))]
+        for i, edges in enumerate(self.__edges):
+            for j in edges:
+                self.__dependents[j].append(i)
+        self.__makeComponents()
+        logging.info("%s: ... building %d builds (%d external), %d dependencies took %s" % (self.vistaLabel, len(self.__names), len(self.__external), sum(len(edges) for edges in self.__edges), datetime.now()-start))
+
+    def __resolve(self, value, buildsByIEN):
+        """Required build is free text (a name); multiple build points to 9.6"""
+        match = re.match(r'9_6-(\d+)$', value)
+        if match and match.group(1) in buildsByIEN:
+            return buildsByIEN[match.group(1)]
+        return value
+
+    def __makeComponents(self):
+        """
+        Tarjan's strongly connected components (iterative). Components come
+        out needed before needing ie/ in topological order.
+        """
+        edges = [list(e) for e in self.__edges]
+        noNodes = len(edges)
+        index = [-1] * noNodes
+        lowLink = [0] * noNodes
+        onStack = [False] * noNodes
+        stack = []
+        components = []
+        counter = 0
+        for root in range(noNodes):
+            if index[root] != -1:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, edgeNo = work.pop()
+                if edgeNo == 0:
+                    index[node] = lowLink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    onStack[node] = True
+                recurse = False
+                while edgeNo < len(edges[node]):
+                    successor = edges[node][edgeNo]
+                    edgeNo += 1
+                    if index[successor] == -1:
+                        work.append((node, edgeNo))
+                        work.append((successor, 0))
+                        recurse = True
+                        break
+                    if onStack[successor]:
+                        lowLink[node] = min(lowLink[node], index[successor])
+                if recurse:
+                    continue
+                if lowLink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+                if work:
+                    parent = work[-1][0]
+                    lowLink[parent] = min(lowLink[parent], lowLink[node])
+        self.__components = components
+        self.__componentOf = [0] * noNodes
+        self.__topologicalPosition = [0] * noNodes
+        position = 0
+        for c, component in enumerate(components):
+            for i in component:
+                self.__componentOf[i] = c
+                self.__topologicalPosition[i] = position
+                position += 1
+        self.__componentEdges = [set(self.__componentOf[j] for i in component for j in self.__edges[i]).difference([c]) for c, component in enumerate(components)]
+        self.__componentClosures = [None] * len(components)
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    What builds does CGVISTA lack for the builds it has installed? Which of
+    these are in GOLD?
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    from copies.fmqlCacher import FMQLCacher
+    from vistaBuilds import VistaBuilds
+    gCacher = FMQLCacher("Caches")
+    gCacher.setVista("GOLD")
+    oCacher = FMQLCacher("Caches")
+    oCacher.setVista("CGVISTA", "http://vista.caregraf.org/fmqlEP")
+    gBuilds = set(VistaBuilds("GOLD", gCacher).listBuilds(True))
+    oBuilds = VistaBuilds("CGVISTA", oCacher)
+    graph = VistaBuildsGraph(oBuilds)
+    missing = graph.missingPrerequisites(oBuilds.listBuilds(True))
+    for i, buildName in enumerate(sorted(missing), 1):
+        print "%d: %s%s - needed by %s" % (i, buildName, " (GOLD)" if buildName in gBuilds else "", ", ".join(missing[buildName][0:5]))
+
+if __name__ == "__main__":
+    demo()
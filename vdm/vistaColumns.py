@@ -0,0 +1,282 @@
+#
+## VOLDEMORT (VDM) VistA Comparer
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+Module for exporting a VistA's schema, builds and packages as columnar tables
+for analytics across many VistAs ex/ fields per package across a dozen sites.
+
+Tables:
+- files: one row per file (and subfile) of the schema
+- fields: one row per field
+- builds: one row per build, with its install order if installed
+- build_files: one row per file sent by a build
+- installs: the install timeline
+- packages and package_prefixes (prefixes and excluded prefixes)
+
+A VistA's tables go into one NumPy .npz (a zip of .npy arrays, deflated) so
+NumPy or pandas read a table in one go and site-wide questions become
+vectorized operations. The .npy format is simple enough to write directly
+so exporting doesn't need NumPy - only loading (loadTables) does.
+
+Columns are named <table>.<column> ex/ "fields.name". Numbers are int64
+(-1 where there's no value), flags are bool. Strings are dictionary encoded
+as in Arrow: an int32 codes column (-1 for no value) and its unicode
+dictionary, "<table>.<column>.dictionary". Codes of a column such as
+"fields.type" are cheap to group by.
+
+  from vistaColumns import exportVista
+  exportVista("Columns/GOLD.npz", schema, builds, packages)
+
+  >>> tables = loadTables("Columns/GOLD.npz")
+  >>> pandas.DataFrame(tables["fields"])
+
+TODO:
+- Parquet once the analysts' side settles on it
+"""
+
+import os
+import struct
+import logging
+from zipfile import ZipFile, ZIP_DEFLATED
+from collections import OrderedDict
+
+__all__ = ['ColumnTable', 'schemaTables', 'buildsTables', 'packagesTables', 'writeTables', 'exportVista', 'loadTables']
+
+class ColumnTable(object):
+    """
+    Rows of a table kept as columns. A column is "int", "bool" or "str".
+
+      table = ColumnTable("installs", [("time", "str"), ("build", "str")])
+      table.addRow("2011-03-01T10:22:00", "XU*8.0*10")
+    """
+    KINDS = ("int", "bool", "str")
+
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = OrderedDict()
+        for column, kind in columns:
+            if kind not in ColumnTable.KINDS:
+                raise Exception("Column %s of %s has unknown kind %s" % (column, name, kind))
+            self.columns[column] = (kind, [])
+        self.__noRows = 0
+
+    def addRow(self, *values):
+        if len(values) != len(self.columns):
+            raise Exception("Row of %s has %d values, not %d" % (self.name, len(values), len(self.columns)))
+        for (kind, cells), value in zip(self.columns.itervalues(), values):
+            cells.append(value)
+        self.__noRows += 1
+
+    def __len__(self):
+        return self.__noRows
+
+    def __str__(self):
+        return "Table %s of %d rows" % (self.name, self.__noRows)
+
+def schemaTables(vistaSchema):
+    """
+    files and fields of a VistaSchema. Files are in file number order, fields
+    in their file's order.
+    """
+    files = ColumnTable("files", [("file_id", "str"), ("parent", "str"), ("top", "str"), ("name", "str"), ("location", "str"), ("count", "int"), ("no_fields", "int"), ("deprecated", "bool"), ("corrupt", "bool"), ("corrupt_fields", "bool"), ("class3", "bool"), ("class3_station", "str"), ("package", "str")])
+    fields = ColumnTable("fields", [("file_id", "str"), ("number", "str"), ("name", "str"), ("type", "str"), ("flags", "str"), ("location", "str"), ("deprecated", "bool"), ("corrupt", "bool"), ("computed", "bool"), ("indexed", "bool"), ("class3", "bool"), ("class3_station", "str")])
+    for fileId in vistaSchema.sortFiles(vistaSchema.files() + vistaSchema.filesWithAttr("corruption")):
+        sch = vistaSchema.getSchema(fileId)
+        schFields = [] if "corruption" in sch else sch["fields"]
+        count = sch.get("count", "-")
+        files.addRow(fileId, sch.get("parent"), sch["parents"][0] if sch.get("parents") else fileId, sch.get("name"), sch.get("location"), int(count) if count and count.isdigit() else -1, len(schFields), "deprecated" in sch, "corruption" in sch, "corruptFields" in sch, "class3" in sch, _station(sch.get("class3")), sch.get("package"))
+        for field in schFields:
+            fields.addRow(fileId, field["number"], field.get("name"), field.get("type"), field.get("flags"), field.get("location"), "deprecated" in field, "corruption" in field, "computation" in field or "computation001" in field, "index" in field, "class3" in field, _station(field.get("class3")))
+    return [files, fields]
+
+def _station(class3):
+    """
+    Station of a class 3 file or field - class3 is (id, station name) or None
+    """
+    return class3[1] if class3 else None
+
+def buildsTables(vistaBuilds):
+    """
+    builds (in Build file order), build_files and installs of a VistaBuilds
+    """
+    installOrder = dict((buildName, i) for i, buildName in enumerate(vistaBuilds.listBuilds(True)))
+    builds = ColumnTable("builds", [("name", "str"), ("ien", "int"), ("package", "str"), ("type", "str"), ("track_package_nationally", "str"), ("date_distributed", "str"), ("status", "str"), ("installed", "bool"), ("install_order", "int")])
+    buildFiles = ColumnTable("build_files", [("build", "str"), ("file_id", "str"), ("send_full_or_partial_dd", "str"), ("update_the_data_dictionary", "str"), ("data_comes_with_file", "str"), ("sites_data", "str"), ("installed", "bool")])
+    for buildName in vistaBuilds.listBuilds(False):
+        build = vistaBuilds.describeBuild(buildName)
+        ien = build.get("vse:ien", "")
+        builds.addRow(buildName, int(ien) if ien.isdigit() else -1, build.get("vse:package_name"), build.get("type"), build.get("track_package_nationally"), build.get("date_distributed"), build.get("vse:status"), buildName in installOrder, installOrder.get(buildName, -1))
+        for buildFile in vistaBuilds.describeBuildFiles(buildName):
+            buildFiles.addRow(buildName, buildFile.get("vse:file_id"), buildFile.get("send_full_or_partial_dd"), buildFile.get("update_the_data_dictionary"), buildFile.get("data_comes_with_file"), buildFile.get("sites_data"), buildName in installOrder)
+    installs = ColumnTable("installs", [("time", "str"), ("build", "str"), ("effect", "str")])
+    for time, buildName, effect in vistaBuilds.getInstallTimeline():
+        installs.addRow(time, buildName, effect)
+    return [builds, buildFiles, installs]
+
+def packagesTables(vistaPackages):
+    """
+    packages (in Package file order) and package_prefixes of a VistaPackages.
+    A prefix is a package's main prefix, an additional one or one excluded
+    from it.
+    """
+    packages = ColumnTable("packages", [("name", "str"), ("ien", "int"), ("prefix", "str"), ("class", "str"), ("current_version", "str")])
+    for packageName in vistaPackages.listPackages():
+        package = vistaPackages.describePackage(packageName)
+        ien = package.get("vse:ien", "")
+        packages.addRow(packageName, int(ien) if ien.isdigit() else -1, package.get("prefix"), package.get("class"), package.get("current_version"))
+    prefixes = ColumnTable("package_prefixes", [("prefix", "str"), ("package", "str"), ("main", "bool"), ("excluded", "bool")])
+    for prefix in sorted(vistaPackages.getPrefixes()):
+        for packageName, main in vistaPackages.getPrefixes()[prefix]:
+            prefixes.addRow(prefix, packageName, main, False)
+    for prefix in sorted(vistaPackages.getExcludedPrefixes()):
+        for packageName in vistaPackages.getExcludedPrefixes()[prefix]:
+            prefixes.addRow(prefix, packageName, False, True)
+    return [packages, prefixes]
+
+def writeTables(npzFile, tables, vistaLabel=""):
+    """
+    Write tables into one .npz. Along with the tables' columns go "meta.vista"
+    (the VistA's label) and "meta.tables" (the table names).
+    """
+    arrays = OrderedDict()
+    arrays["meta.vista"] = ("<U", _unicodes([vistaLabel]))
+    arrays["meta.tables"] = ("<U", _unicodes([table.name for table in tables]))
+    for table in tables:
+        for column, (kind, cells) in table.columns.iteritems():
+            name = "%s.%s" % (table.name, column)
+            if kind == "int":
+                arrays[name] = ("<i8", [-1 if cell is None else int(cell) for cell in cells])
+            elif kind == "bool":
+                arrays[name] = ("|b1", [bool(cell) for cell in cells])
+            else:
+                codes, dictionary = _dictionaryEncode(cells)
+                arrays[name] = ("<i4", codes)
+                arrays[name + ".dictionary"] = ("<U", dictionary)
+    if os.path.dirname(npzFile) and not os.path.isdir(os.path.dirname(npzFile)):
+        os.makedirs(os.path.dirname(npzFile))
+    tmpFile = npzFile + ".tmp"
+    with ZipFile(tmpFile, "w", ZIP_DEFLATED) as zipFile:
+        for name, (descr, values) in arrays.iteritems():
+            zipFile.writestr(name + ".npy", _npy(descr, values))
+    if os.path.exists(npzFile):
+        os.remove(npzFile)
+    os.rename(tmpFile, npzFile)
+
+def _unicodes(values):
+    return [value.decode("utf-8") if isinstance(value, str) else value for value in values]
+
+def _dictionaryEncode(cells):
+    """
+    Codes (index in dictionary or -1 for None) and dictionary in the order
+    values first appear
+    """
+    dictionary = []
+    codeOf = {}
+    codes = []
+    for cell in _unicodes(cells):
+        if cell is None:
+            codes.append(-1)
+            continue
+        code = codeOf.get(cell)
+        if code is None:
+            code = codeOf[cell] = len(dictionary)
+            dictionary.append(cell)
+        codes.append(code)
+    return codes, dictionary
+
+# .npy (format 1.0) header - magic, version, header length and a dict padded
+# so the data starts on a 64 byte boundary
+NPY_MAGIC = "\x93NUMPY\x01\x00"
+NPY_ALIGN = 64
+
+def _npy(descr, values):
+    """
+    A one dimensional .npy array of values. descr "<U" is unicode (utf-32) as
+    wide as the widest value.
+    """
+    if descr == "<U":
+        width = max([len(value) for value in values] + [1])
+        descr = "<U%d" % width
+        data = "".join((value + u"\0" * (width - len(value))).encode("utf-32-le") for value in values)
+    elif descr == "|b1":
+        data = "".join("\x01" if value else "\x00" for value in values)
+    else:
+        data = struct.pack("<%d%s" % (len(values), "q" if descr == "<i8" else "i"), *values)
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, len(values))
+    padding = NPY_ALIGN - (len(NPY_MAGIC) + 2 + len(header) + 1) % NPY_ALIGN
+    header += " " * (padding % NPY_ALIGN) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header + data
+
+def exportVista(npzFile, vistaSchema=None, vistaBuilds=None, vistaPackages=None):
+    """
+    Export the tables of any or all of a VistA's schema, builds and packages
+    into one .npz. Returns the tables written.
+    """
+    tables = []
+    vistaLabel = ""
+    for vistaPart, tablesOf in [(vistaSchema, schemaTables), (vistaBuilds, buildsTables), (vistaPackages, packagesTables)]:
+        if vistaPart is None:
+            continue
+        vistaLabel = vistaPart.vistaLabel
+        tables.extend(tablesOf(vistaPart))
+    if not tables:
+        raise Exception("Nothing to export - need a schema, builds or packages")
+    writeTables(npzFile, tables, vistaLabel)
+    logging.info("%s: exported %s to %s" % (vistaLabel, ", ".join("%s (%d)" % (table.name, len(table)) for table in tables), npzFile))
+    return tables
+
+def loadTables(npzFile, decode=True):
+    """
+    Read an export back with NumPy ie/ {table: {column: array}}, tables and
+    columns in export order. With 'decode', string columns are object arrays
+    of their values (None for no value) - otherwise they're left as codes
+    with their dictionary under "<column>.dictionary".
+
+    Needs NumPy (the export doesn't)
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("Loading columnar tables needs NumPy")
+    arrays = numpy.load(npzFile)
+    tables = OrderedDict()
+    for tableName in arrays["meta.tables"]:
+        tables[tableName] = OrderedDict()
+    for name in arrays.files:
+        tableName, column = name.split(".", 1)
+        if tableName not in tables or column.endswith(".dictionary"):
+            continue
+        values = arrays[name]
+        dictionaryName = name + ".dictionary"
+        if dictionaryName in arrays.files:
+            if decode:
+                dictionary = numpy.append(arrays[dictionaryName].astype(object), None)
+                values = dictionary[values] # -1 picks the None
+            else:
+                tables[tableName][column + ".dictionary"] = arrays[dictionaryName]
+        tables[tableName][column] = values
+    return tables
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    Export GOLD (from Caches) into Columns/GOLD.npz
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    from copies.fmqlCacher import FMQLCacher
+    from vistaSchema import VistaSchema
+    from vistaBuilds import VistaBuilds
+    from vistaPackages import VistaPackages
+    cacher = FMQLCacher("Caches")
+    cacher.setVista("GOLD")
+    tables = exportVista(os.path.join("Columns", "GOLD.npz"), VistaSchema("GOLD", cacher), VistaBuilds("GOLD", cacher), VistaPackages("GOLD", cacher))
+    for table in tables:
+        print str(table)
+
+if __name__ == "__main__":
+    demo()
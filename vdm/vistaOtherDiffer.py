@@ -36,7 +36,9 @@ from datetime import datetime
 from collections import defaultdict
 from vistaBuilds import VistaBuilds
 from vistaSchema import VistaSchema
+from copies.fmqlCacher import FMQLFileId, fileIdSortKey
 from vdmU import HTMLREPORTHEAD, HTMLREPORTTAIL, WARNING_BLURB
+from copies.runProfile import PROFILE
 
 __all__ = ['VistaOtherDiffer']
 __version__ = ".3"
@@ -88,7 +90,7 @@ class VistaOtherDiffer:
         bothFiles = self.__oSchema.sortFiles(set(self.__bSchema.listFiles(True)).intersection(self.__oSchema.listFiles(True)))
         self.__bothDiffFiles = {}
         for fmqlFileId in bothFiles:
-            fileId = re.sub(r'\_', '.', fmqlFileId)
+            fileId = FMQLFileId.of(fmqlFileId).dotted
             bsch = self.__bSchema.getSchema(fmqlFileId)
             bFieldIds = self.__bSchema.getFieldIds(fmqlFileId)
             osch = self.__oSchema.getSchema(fmqlFileId)
@@ -112,6 +114,7 @@ class VistaOtherDiffer:
         # 2. top files only in other
         self.__otherOnlyFiles = self.__oSchema.dotFiles(set(self.__oSchema.listFiles(True)).difference(self.__bSchema.listFiles(True)))
                 
+    @PROFILE.timed("compare.schemaBuilds")
     def report(self, format="HTML"):
     
         if format == "HTML":
@@ -149,15 +152,15 @@ class VistaOtherDiffer:
         reportBuilder.counts(otherOnlyBuilds=len(self.__otherOnlyBuilds), otherOnlyBuildsWithFiles=len(otherOnlyBuildsWithFiles), buildNotSchFiles=len(buildNotSchFiles), schemaNotBuildFiles=len(schemaNotBuildFiles), bothSchBuildFiles=len(bothSchBuildFiles))
         
         reportBuilder.startInBoth(len(bothSchBuildFiles))
-        files = sorted(bothSchBuildFiles, key=lambda x: float(x))
+        files = sorted(bothSchBuildFiles, key=fileIdSortKey)
         for no, file in enumerate(files, 1):
-            reportBuilder.both(no, file, self.__oSchema.getFileName(re.sub(r'\.', '_', str(file))), otherOnlyBuildFiles[file])
+            reportBuilder.both(no, file, self.__oSchema.getFileName(FMQLFileId.of(file).fmql), otherOnlyBuildFiles[file])
         reportBuilder.endInBoth()
         
         reportBuilder.startInSchemaOnly(len(schemaNotBuildFiles))
-        files = sorted(schemaNotBuildFiles, key=lambda x: float(x))
+        files = sorted(schemaNotBuildFiles, key=fileIdSortKey)
         for no, file in enumerate(files, 1):
-            reportBuilder.inSchemaOnly(no, file, self.__oSchema.getFileName(re.sub(r'\.', '_', str(file))))
+            reportBuilder.inSchemaOnly(no, file, self.__oSchema.getFileName(FMQLFileId.of(file).fmql))
         reportBuilder.endInSchemaOnly()
         
         return self.__reportsLocation      
@@ -204,6 +207,7 @@ class VODHTMLReportBuilder:
     def endInSchemaOnly(self):
         self.__inSchemaOnlyItems.append("</div>")      
     
+    @PROFILE.timed("report.flush")
     def flush(self):
         reportHead = (HTMLREPORTHEAD % ("Schema/Builds Report << VOLDEMORT", " VOLDEMORT Schema Builds Report"))
         blurb = "<p>The unique builds in %s which changed the Schema.</p>" % (self.__oVistaLabel)
@@ -14,9 +14,10 @@ import sys
 from datetime import timedelta, datetime 
 import logging
 from collections import OrderedDict, defaultdict
-from copies.fmqlCacher import FMQLDescribeResult
+from copies.fmqlCacher import FMQLDescribeResult, SYMBOLS
+from copies.runProfile import PROFILE
 
-__all__ = ['VistaPackages']
+__all__ = ['VistaPackages', 'NamespaceTrie']
 
 class VistaPackages(object):
     """
@@ -104,6 +105,9 @@ class VistaPackages(object):
         Ex/ Patient (2/DPT) assigned to REGISTRATION as "DPT" is prefix in
         additional_prefixes of the Registration Package.
         
+        Returns the packages of the longest prefix of the array (^DPT( or DPT)
+        that isn't excluded - see NamespaceTrie.
+        
         TODO: move to static configuration for files AS Package prefixes
         only work for routines.
         
@@ -111,14 +115,14 @@ class VistaPackages(object):
         is for Routines but doesn't work completely for Files. 
         Ex/ Vitals (120.5) is ^GMR but prefix for Vitals Package is GMRV.
         """
-        candidates = []
-        for prefix in self.__prefixes:
-            if len(prefix) < len(fileArray):
-                continue
-            if re.match(prefix, fileArray):
-                candidates.append(self.__prefixes[prefix])
-        # TODO: apply Excludes too
-        return candidates
+        return self.__namespaces.packagesOf(fileArray)
+        
+    def assignPackages(self, names):
+        """
+        Packages of many routines, globals or file arrays in one pass ie/
+        {name: [package names]}. Names no package claims map to [].
+        """
+        return self.__namespaces.assign(names)
         
     def getPrefixes(self):
         """
@@ -161,6 +165,7 @@ class VistaPackages(object):
     __ALL_LIMIT = 200
     __CSTOP = 10000
         
+    @PROFILE.timed("index.packages")
     def __indexNCleanPackages(self):
         """
         Index and clean packages - will force caching if not already in cache
@@ -192,7 +197,7 @@ class VistaPackages(object):
                 # turn 1- form into straight file id. Note dd_number is optional
                 for fileAbout in self.__packageFiles[name]:
                     # TODO: file name - want to 
-                    fileAbout["vse:file_id"] = fileAbout["file"][2:]
+                    fileAbout["vse:file_id"] = SYMBOLS.intern(fileAbout["file"][2:])
             if "version" in dr.cnodeFields():
                 self.__packageVersions[name] = [cnode for cnode in dr.cnodes("version") if "version" in cnode]
                 last = self.__packageVersions[name][-1]
@@ -215,9 +220,74 @@ class VistaPackages(object):
                 for excluded in [cnode["excluded_name_space"] for cnode in dr.cnodes("excluded_name_space") if "excluded_name_space" in cnode]:
                     # can have > 1 PKG ex/ "ZZ" in ONCOLOGY and TOOLKIT
                     self.__excludedPrefixes[excluded].append(name)
+        self.__namespaces = NamespaceTrie(self.__prefixes, self.__excludedPrefixes)
                 
         logging.info("%s: Indexing, cleaning (with caching) %d packages took %s" % (self.vistaLabel, len(self.__packageAbouts), datetime.now()-start))
         
+class NamespaceTrie(object):
+    """
+    Packages' namespaces (main prefix, additional prefixes) and excluded 
+    namespaces as a trie, keyed a character at a time. 
+    
+    A name belongs to the packages of its longest matching prefix unless a 
+    longer excluded namespace of one of those packages matches too. Ex/ PSZA
+    isn't in PHARMACY (PS) if PHARMACY excludes PSZ. A prefix claimed by more
+    than one package (XPD in KERNEL and KIDS) gives all of them.
+    
+    Lookup walks at most as many nodes as the longest prefix has characters
+    whatever the number of packages.
+    """
+    
+    # key of a node's own packages - not a namespace character
+    __PACKAGES = None
+    
+    def __init__(self, prefixes, excludedPrefixes):
+        """
+        prefixes: {prefix: [(package name, is main prefix)]}
+        excludedPrefixes: {prefix: [package name]}
+        """
+        self.__root = {}
+        for prefix, packages in prefixes.iteritems():
+            node = self.__node(prefix)
+            node[self.__PACKAGES][0].extend(packageName for packageName, isMain in packages)
+        for prefix, packageNames in excludedPrefixes.iteritems():
+            node = self.__node(prefix)
+            node[self.__PACKAGES][1].extend(packageNames)
+            
+    def __node(self, prefix):
+        node = self.__root
+        for char in prefix:
+            if char not in node:
+                node[char] = {self.__PACKAGES: ([], [])}
+            node = node[char]
+        return node
+        
+    def packagesOf(self, name):
+        """
+        Packages of a routine, global (^DPT) or file array (^DPT() 
+        """
+        if name.startswith("^"):
+            name = name[1:]
+        node = self.__root
+        packages = []
+        for char in name:
+            if char not in node:
+                break
+            node = node[char]
+            included, excluded = node[self.__PACKAGES]
+            if included:
+                packages = included
+            if excluded and packages:
+                packages = [packageName for packageName in packages if packageName not in excluded]
+        return list(packages)
+        
+    def assign(self, names):
+        """
+        {name: [package names]} for many names (routines of all builds, say)
+        in the order given
+        """
+        return OrderedDict((name, self.packagesOf(name)) for name in names)
+        
 # ######################## Module Demo ##########################
                        
 def demo():
@@ -23,6 +23,7 @@ import cgi
 from datetime import datetime 
 from vistaPackages import VistaPackages
 from vdmU import HTMLREPORTHEAD, HTMLREPORTTAIL, WARNING_BLURB
+from copies.runProfile import PROFILE
 
 __all__ = ['VistaPackagesComparer']
 __version__ = ".3"
@@ -50,6 +51,7 @@ class VistaPackagesComparer(object):
             except:
                 raise Exception("Bad location for Comparison Reports: %s ... exiting" % reportsLocation)
         
+    @PROFILE.timed("compare.packages")
     def compare(self, format="HTML"):
     
         if format == "HTML":
@@ -166,6 +168,7 @@ class VPHTMLReportBuilder:
     def endCommon(self):
         self.__commonItems.append("</table></div>")
                                        
+    @PROFILE.timed("report.flush")
     def flush(self):
     
         reportHead = (HTMLREPORTHEAD % ("Package Comparison Report << VOLDEMORT", " VOLDEMORT Package Comparison Report"))
@@ -0,0 +1,210 @@
+#
+## VOLDEMORT (VDM) VistA Comparer
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+Compact records for the meta data VDM indexes - schema files and fields, builds,
+their files and installs.
+
+FMQL replies are dictionaries and VDM used to keep them as is. A dictionary per
+field and per build adds up - GOLD and RPMS loaded together took hundreds of MB.
+These records keep the properties VDM knows about in __slots__ and any others
+in a small overflow dictionary. They behave like the dictionaries they replace
+(record["name"], "deprecated" in record, record.get("type") etc.) so the
+accessors of VistaSchema and VistaBuilds still return what they always did.
+
+Values shared across VistAs (names, types ...) are interned by the Cacher's
+symbol table (SYMBOLS) as replies are decoded.
+"""
+
+import re
+import sys
+
+__all__ = ['VistaRecord', 'FileRecord', 'FieldRecord', 'BuildRecord', 'BuildFileRecord', 'InstallRecord']
+
+def _slotName(property):
+    # FMQL/VDM names like "vse:ien" aren't identifiers
+    return "_" + re.sub(r'[^A-Za-z0-9_]', '_', property)
+
+def _slots(properties):
+    return tuple(_slotName(property) for property in properties)
+
+def _slotsByProperty(properties):
+    return dict((property, _slotName(property)) for property in properties)
+
+class VistaRecord(object):
+    """
+    Dictionary-like record. Subclasses name their PROPERTIES and set
+    __slots__ and SLOTS from them.
+    """
+    __slots__ = ("_extras",)
+    PROPERTIES = ()
+    SLOTS = {}
+
+    def __init__(self, about):
+        self._extras = None
+        for property, value in about.iteritems():
+            self[property] = value
+
+    def __getitem__(self, property):
+        slot = self.SLOTS.get(property)
+        if slot:
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                raise KeyError(property)
+        if self._extras and property in self._extras:
+            return self._extras[property]
+        raise KeyError(property)
+
+    def __setitem__(self, property, value):
+        slot = self.SLOTS.get(property)
+        if slot:
+            setattr(self, slot, value)
+            return
+        if self._extras is None:
+            self._extras = {}
+        self._extras[property] = value
+
+    def __delitem__(self, property):
+        slot = self.SLOTS.get(property)
+        try:
+            if slot:
+                delattr(self, slot)
+            else:
+                del self._extras[property]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(property)
+
+    def __contains__(self, property):
+        slot = self.SLOTS.get(property)
+        if slot:
+            return hasattr(self, slot)
+        return True if self._extras and property in self._extras else False
+
+    def get(self, property, default=None):
+        try:
+            return self[property]
+        except KeyError:
+            return default
+
+    def keys(self):
+        properties = [property for property in self.PROPERTIES if hasattr(self, self.SLOTS[property])]
+        if self._extras:
+            properties.extend(self._extras.keys())
+        return properties
+
+    def values(self):
+        return [self[property] for property in self.keys()]
+
+    def items(self):
+        return [(property, self[property]) for property in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (VistaRecord, dict)):
+            return dict(self.items()) == dict(other.items())
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class FileRecord(VistaRecord):
+    """
+    Schema of a file (DESCRIBE TYPE) along with what VistaSchema notes about it
+    ("class3", "parents", "package" ...)
+    """
+    PROPERTIES = ("number", "name", "location", "parent", "parents", "count", "fields", "description", "corruption", "corruptFields", "deprecated", "class3", "package", "version", "vpackage", "fmql")
+    __slots__ = _slots(PROPERTIES)
+    SLOTS = _slotsByProperty(PROPERTIES)
+
+class FieldRecord(VistaRecord):
+    """
+    Field of a file's schema
+    """
+    PROPERTIES = ("number", "name", "type", "flags", "location", "index", "inputTransform", "computation", "computation001", "details", "description", "hidden", "corruption", "deprecated", "class3")
+    __slots__ = _slots(PROPERTIES)
+    SLOTS = _slotsByProperty(PROPERTIES)
+
+class BuildRecord(VistaRecord):
+    """
+    Flattened (cstopped) Build (9.6) along with what VistaBuilds notes about it (vse:)
+    """
+    PROPERTIES = ("uri", "name", "type", "track_package_nationally", "date_distributed", "package_file_link", "description_of_enhancements", "vse:ien", "vse:package", "vse:package_name", "vse:status", "vse:last_install_effect")
+    __slots__ = _slots(PROPERTIES)
+    SLOTS = _slotsByProperty(PROPERTIES)
+
+class BuildFileRecord(VistaRecord):
+    """
+    File (9.64) cnode of a Build
+    """
+    PROPERTIES = ("file", "vse:file_id", "vse:file_number", "vse:container", "send_full_or_partial_dd", "update_the_data_dictionary", "data_comes_with_file", "sites_data", "dd_number")
+    __slots__ = _slots(PROPERTIES)
+    SLOTS = _slotsByProperty(PROPERTIES)
+
+class InstallRecord(VistaRecord):
+    """
+    Flattened (cstopped) Install (9.7)
+    """
+    PROPERTIES = ("uri", "name", "status", "install_start_time", "install_complete_time", "package_file_link", "date_loaded", "distribution_date")
+    __slots__ = _slots(PROPERTIES)
+    SLOTS = _slotsByProperty(PROPERTIES)
+
+def approximateSize(obj, seen=None):
+    """
+    Rough, recursive size in bytes of records, dictionaries, lists and their
+    contents. For comparing representations, not for accounting.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, VistaRecord):
+        size += sum(approximateSize(value, seen) for value in obj.values())
+        if obj._extras is not None:
+            size += sys.getsizeof(obj._extras)
+    elif isinstance(obj, dict):
+        size += sum(approximateSize(key, seen) + approximateSize(value, seen) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximateSize(item, seen) for item in obj)
+    return size
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    Compare the size of GOLD's schema as FMQL dictionaries and as records
+    """
+    import logging
+    import json
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    from copies.fmqlCacher import FMQLCacher
+    cacher = FMQLCacher("Caches")
+    cacher.setVista("GOLD")
+    asDicts = []
+    asRecords = []
+    for schema in cacher.describeSchemaTypes():
+        asDicts.append(schema)
+        record = FileRecord(schema)
+        if "fields" in record:
+            record["fields"] = [FieldRecord(field) for field in record["fields"]]
+        asRecords.append(record)
+    print "GOLD schema as dictionaries: %d bytes, as records: %d bytes" % (approximateSize(asDicts), approximateSize(asRecords))
+
+if __name__ == "__main__":
+    demo()
@@ -0,0 +1,242 @@
+#
+## VOLDEMORT (VDM) VistA Comparer
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+The static resources VDM ships (resources/) - VA station namespaces, OSEHRA's
+package to file assignments and FOIA's institutions - loaded once per process.
+
+VistaSchema used to reread and reparse the CSVs for every schema it made and a
+schema report makes four. Now each resource is parsed into its lookup the
+first time it's asked for and shared. The parsed form is also pickled beside
+the CSV ("Namespaces.csv.pickle") so later processes skip the parse. A sidecar
+older than its CSV is ignored and rewritten; if resources/ isn't writeable, it
+just isn't written.
+
+TODO:
+- fix to use pkg_resources: http://peak.telecommunity.com/DevCenter/PythonEggs#accessing-package-resources
+"""
+
+import os
+import csv
+import cPickle
+import logging
+import threading
+from bisect import bisect_right
+
+__all__ = ['VistaResources', 'RESOURCES', 'NamespaceRangeIndex']
+
+class VistaResources(object):
+    """
+    Lazily built, shared lookups over the CSVs in a resources directory
+    """
+
+    # Bump if the parsed form changes - older sidecars are then ignored
+    VERSION = 2
+
+    def __init__(self, location=None):
+        self.__location = location if location else os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
+        self.__resources = {}
+        self.__lock = threading.Lock()
+
+    def __str__(self):
+        return "Resources in %s" % self.__location
+
+    def namespaces(self):
+        """
+        VA station numbers to station names ie/ {"463": "ALASKA" ...}. MSC's
+        214 isn't in Namespaces.csv so is added.
+        """
+        return self.__resource("Namespaces.csv")["namespaces"]
+
+    def namespaceRanges(self):
+        """
+        File number ranges assigned to stations, in LOW order ie/
+        [(363000, 363999, "363", "ALASKA") ...]. Only stations with a LOW
+        and HIGH in Namespaces.csv.
+        """
+        return self.__resource("Namespaces.csv")["ranges"]
+
+    def namespaceIndex(self):
+        """
+        NamespaceRangeIndex over namespaceRanges() and the ranges of stations
+        without a LOW/HIGH (number*1000 to number*1000 + 999)
+        """
+        resource = self.__resource("Namespaces.csv")
+        if "index" not in resource:
+            resource["index"] = NamespaceRangeIndex.fromNamespaces(resource["namespaces"], resource["ranges"])
+        return resource["index"]
+
+    def filePackages(self):
+        """
+        File numbers to package names ie/ {"2": "REGISTRATION" ...} from OSEHRA's
+        Packages.csv
+
+        TODO: Strange - COUNTY (5.1) in ONCOLOGY but this matches OSEHRA
+        """
+        return self.__resource("Packages.csv")["filePackages"]
+
+    def institutionsByStation(self):
+        """
+        Station numbers to the FOIA institutions (rows of FOIAInstitutions.csv)
+        with them ie/ {"050": [{...}]}
+        """
+        return self.__resource("FOIAInstitutions.csv")["byStation"]
+
+    def __resource(self, csvName):
+        try:
+            return self.__resources[csvName]
+        except KeyError:
+            pass
+        with self.__lock:
+            if csvName not in self.__resources:
+                self.__resources[csvName] = self.__load(csvName)
+        return self.__resources[csvName]
+
+    def __load(self, csvName):
+        """
+        From the pickled sidecar if it's current, otherwise parse the CSV and
+        (try to) write the sidecar
+        """
+        csvFile = os.path.join(self.__location, csvName)
+        sidecar = csvFile + ".pickle"
+        stamp = (VistaResources.VERSION, os.path.getmtime(csvFile), os.path.getsize(csvFile))
+        if os.path.isfile(sidecar):
+            try:
+                with open(sidecar, "rb") as sidecarFile:
+                    sidecarStamp, parsed = cPickle.load(sidecarFile)
+                if sidecarStamp == stamp:
+                    return parsed
+            except Exception as e:
+                logging.info("Resources: ignoring unreadable %s - %s" % (sidecar, e))
+        with open(csvFile, "rb") as csvf:
+            parsed = self.__PARSERS[csvName](self, csvf)
+        try:
+            tmpSidecar = sidecar + ".tmp"
+            with open(tmpSidecar, "wb") as sidecarFile:
+                cPickle.dump((stamp, parsed), sidecarFile, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpSidecar, sidecar)
+        except (IOError, OSError) as e:
+            logging.info("Resources: can't write %s - %s" % (sidecar, e))
+        return parsed
+
+    def __parseNamespaces(self, csvf):
+        namespaces = {}
+        ranges = []
+        for row in csv.DictReader(csvf, delimiter='\t'):
+            namespaces[row["NUMBER"]] = row["NAME"]
+            if row.get("LOW") and row.get("HIGH"):
+                ranges.append((int(row["LOW"]), int(row["HIGH"]), row["NUMBER"], row["NAME"]))
+        namespaces["214"] = "MEDSPHERE"
+        ranges.sort()
+        return {"namespaces": namespaces, "ranges": ranges}
+
+    def __parsePackages(self, csvf):
+        packageName = ""
+        filePackages = {}
+        for row in csv.DictReader(csvf):
+            # Despite name either single file id or nothing
+            if not row["File Numbers"]:
+                continue
+            packageName = row["Package Name"] if row["Package Name"] else packageName
+            filePackages[row["File Numbers"]] = packageName
+        return {"filePackages": filePackages}
+
+    def __parseInstitutions(self, csvf):
+        byStation = {}
+        for row in csv.DictReader(csvf):
+            if row["station number"]:
+                byStation.setdefault(row["station number"], []).append(row)
+        return {"byStation": byStation}
+
+    __PARSERS = {
+        "Namespaces.csv": __parseNamespaces,
+        "Packages.csv": __parsePackages,
+        "FOIAInstitutions.csv": __parseInstitutions
+    }
+
+class NamespaceRangeIndex(object):
+    """
+    File number ranges of stations, sorted by start, for bisect lookup of the
+    station of a (class 3) number.
+    
+    Station ranges come from Namespaces.csv's LOW/HIGH where given - note that
+    ALASKA (463) has 363000-363999. Otherwise a three digit station has
+    number*1000 to number*1000 + 999. MSC (214) also has five digit stations
+    (214XX) so 21400000-21499999 too.
+    """
+    
+    MSC_RANGE = (21400000, 21499999)
+    
+    def __init__(self, ranges):
+        """
+        ranges: [(low, high, station number, station name)] that don't overlap
+        """
+        ranges = sorted(ranges)
+        self.__lows = [r[0] for r in ranges]
+        self.__highs = [r[1] for r in ranges]
+        self.__stations = [(r[2], r[3]) for r in ranges]
+        
+    @staticmethod
+    def fromNamespaces(namespaces, explicitRanges):
+        ranges = list(explicitRanges)
+        explicit = set(r[2] for r in explicitRanges)
+        claimed = NamespaceRangeIndex(explicitRanges)
+        for number, name in namespaces.iteritems():
+            if number in explicit or not (len(number) == 3 and number.isdigit()):
+                continue
+            low = int(number) * 1000
+            # an explicit range wins over the one derived from a number
+            if claimed.station(low) or claimed.station(low + 999):
+                continue
+            ranges.append((low, low + 999, number, name))
+        if "214" in namespaces:
+            ranges.append(NamespaceRangeIndex.MSC_RANGE + ("214", namespaces["214"]))
+        return NamespaceRangeIndex(ranges)
+        
+    def __len__(self):
+        return len(self.__lows)
+        
+    def station(self, number):
+        """
+        (station number, station name) of a whole (int) file or field number
+        or None if it's in no station's range
+        """
+        i = bisect_right(self.__lows, number) - 1
+        if i >= 0 and number <= self.__highs[i]:
+            return self.__stations[i]
+        return None
+        
+    def stations(self, numbers):
+        """
+        {number: (station number, station name)} for the numbers in a station's
+        range. One pass over numbers, sorted, alongside the sorted ranges.
+        """
+        found = {}
+        i = 0
+        noRanges = len(self.__lows)
+        for number in sorted(numbers):
+            while i < noRanges and self.__highs[i] < number:
+                i += 1
+            if i == noRanges:
+                break
+            if self.__lows[i] <= number:
+                found[number] = self.__stations[i]
+        return found
+
+# The process's resources - use this rather than making another
+RESOURCES = VistaResources()
+
+# ######################## Module Demo ##########################
+
+def demo():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    print "%d station namespaces, %d with file ranges" % (len(RESOURCES.namespaces()), len(RESOURCES.namespaceRanges()))
+    print "%d files assigned to packages - 2 is in %s" % (len(RESOURCES.filePackages()), RESOURCES.filePackages()["2"])
+    print "%d station numbers in FOIA's institutions - 050 is %s" % (len(RESOURCES.institutionsByStation()), RESOURCES.institutionsByStation()["050"][0]["name"])
+
+if __name__ == "__main__":
+    demo()
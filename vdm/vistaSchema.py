@@ -26,7 +26,6 @@ TODO:
 
 import os
 import re
-import csv
 import urllib
 import urllib2
 import json
@@ -34,6 +33,10 @@ import sys
 from collections import defaultdict
 from datetime import timedelta, datetime 
 import logging
+from copies.fmqlCacher import SYMBOLS, FMQLFileId
+from vistaRecords import FileRecord, FieldRecord
+from vistaResources import RESOURCES, NamespaceRangeIndex
+from copies.runProfile import PROFILE
 
 __all__ = ['VistaSchema']
 
@@ -45,47 +48,30 @@ class VistaSchema(object):
     def __init__(self, vistaLabel, fmqlCacher):
         self.vistaLabel = vistaLabel
         self.__fmqlCacher = fmqlCacher
-        self.__loadNamespaces()
-        self.__loadPackages()
+        # Namespaces.csv and Packages.csv - parsed once per process
+        self.namespaces = RESOURCES.namespaces()
+        self.__filePackages = RESOURCES.filePackages()
         self.__makeSchemas() 
-
-    def __loadNamespaces(self):
-        # TODO: look at high/low
-        # TODO: fix to use pkg_resources: http://peak.telecommunity.com/DevCenter/PythonEggs#accessing-package-resources
-        reader = csv.DictReader(open(os.path.join(os.path.dirname(__file__), "resources/Namespaces.csv")), delimiter='\t')
-        self.namespaces = {}
-        for row in reader:
-            self.namespaces[row["NUMBER"]] = row["NAME"]
-        self.namespaces["214"] = "MEDSPHERE"
-        
-    def __loadPackages(self):
-        """
-        TODO: Strange - COUNTY (5.1) in ONCOLOGY but this matches OSEHRA
-        """
-        reader = csv.DictReader(open(os.path.join(os.path.dirname(__file__), "resources/Packages.csv")))
-        packageName = ""
-        self.__filePackages = {}
-        for row in reader:
-            # Despite name either single file id or nothing
-            if not row["File Numbers"]:
-                continue
-            packageName = row["Package Name"] if row["Package Name"] else packageName
-            self.__filePackages[row["File Numbers"]] = packageName    
         
     def __str__(self):
         return "Schema of %s" % self.vistaLabel
                 
-    def datapoints(self):
-        cnt = 0
-        for fl in self.__schemas:
-            flInfo = self.__schemas[fl]
-            cnt += len(flInfo.keys())
-            if "corruption" in flInfo:
-                continue
-            cnt = cnt - 1 # take away one for fields list
-            # rem: this doesn't count 'multiple' fields as nix'ed. Counted as files
-            cnt += sum([len(fldInfo.keys()) for fldInfo in flInfo["fields"]])
-        return cnt
+    def datapoints(self, file=None):
+        """
+        Number of data points in the schema or, if 'file' is given, in the 
+        schema of that file. Counted once, on first indexing, and then kept in
+        the Cache.
+        """
+        if file:
+            flDatapoints = self.__datapoints[file]
+            return flDatapoints["file"] + sum(flDatapoints["fields"].values())
+        return self.__noDatapoints
+        
+    def datapointsDigest(self):
+        """
+        Data points by file and field ie/ {"2": {"file": 12, "fields": {".01": 9 ...}}}
+        """
+        return self.__datapoints
         
     def package(self, file):
         return self.__schemas[file]["package"] if file in self.__schemas and "package" in self.__schemas[file] else ""
@@ -96,6 +82,19 @@ class VistaSchema(object):
             return self.filesWithoutAttr("corruption", self.filesWithoutAttr("parent"))
         return self.filesWithoutAttr("corruption")
         
+    def fileId(self, file):
+        """
+        Parsed id (FMQLFileId) of a file - dotted and FMQL forms, sort key
+        """
+        return self.__fileIds[file]
+        
+    def sortFiles(self, files):
+        """
+        Files in file number order
+        """
+        fileIds = self.__fileIds
+        return sorted(files, key=lambda fl: fileIds[fl].sortKey)
+        
     def countFiles(self, topOnly=False):
         return len(self.files(topOnly))
         
@@ -198,16 +197,20 @@ class VistaSchema(object):
         """
         pass
                 
+    @PROFILE.timed("index.schema")
     def __makeSchemas(self):
         """
         Index schema - will force caching if not already in cache
         """
         logging.info("%s: Schema - building Schema Index ..." % self.vistaLabel)
         self.__schemas = {}
+        self.__fileIds = {}
         start = datetime.now()
         for i, dtResult in enumerate(self.__fmqlCacher.describeSchemaTypes()):
-            fileId = dtResult["number"] if "number" in dtResult else re.sub('\_', '.', dtResult["fmql"]["TYPE"]) # account for error
+            fileId = dtResult["number"] if "number" in dtResult else SYMBOLS.intern(re.sub('\_', '.', dtResult["fmql"]["TYPE"])) # account for error
+            dtResult = FileRecord(dtResult)
             self.__schemas[fileId] = dtResult
+            self.__fileIds[fileId] = FMQLFileId.of(fileId)
             if "error" in dtResult:
                 dtResult["corruption"] = dtResult["error"] # just to make symmetric with fieldInfo
                 del dtResult["error"]
@@ -215,24 +218,42 @@ class VistaSchema(object):
             if re.match(r'\*', dtResult["name"]):
                 dtResult["deprecated"] = True
             # Nix Multiple fields. Sub files will refer up!
-            dtResult["fields"] = [field for field in dtResult["fields"] if not ("type" in field and field["type"] == "9")]
+            dtResult["fields"] = [FieldRecord(field) for field in dtResult["fields"] if not ("type" in field and field["type"] == "9")]
             for field in dtResult["fields"]:
                 if "corruption" in field:
                     dtResult["corruptFields"] = True
                     continue
-                if self.__isClass3Number(field["number"]):
-                    field["class3"] = self.__vaStationId(field["number"])
                 if re.match(r'\*', field["name"]):
                     field["deprecated"] = True
                 if "computation" in field and field["number"] == ".001":
                     field["computation001"] = field["computation"]
                     del field["computation"] # want to differentiate
+        self.__noteClass3()
         # Note parents once all schemas gathered
         for sch in self.__schemas.values():
             if "corruption" not in sch:
                 self.__noteFileDetails(sch)
+        self.__countDatapoints()
         logging.info("%s: ... building (with caching) took %s" % (self.vistaLabel, datetime.now()-start))
         
+    def __countDatapoints(self):
+        """
+        Datapoints of indexed schemas. Kept in the Cache as counting walks
+        every field of every file.
+        """
+        self.__datapoints = self.__fmqlCacher.cachedDigest("DATAPOINTS SCHEMA")
+        if self.__datapoints is None:
+            self.__datapoints = {}
+            for fl, flInfo in self.__schemas.items():
+                if "corruption" in flInfo:
+                    self.__datapoints[fl] = {"file": len(flInfo), "fields": {}}
+                    continue
+                # take away one for fields list
+                # rem: this doesn't count 'multiple' fields as nix'ed. Counted as files
+                self.__datapoints[fl] = {"file": len(flInfo) - 1, "fields": dict((fldInfo["number"], len(fldInfo)) for fldInfo in flInfo["fields"])}
+            self.__fmqlCacher.cacheDigest("DATAPOINTS SCHEMA", self.__datapoints)
+        self.__noDatapoints = sum(flDatapoints["file"] + sum(flDatapoints["fields"].values()) for flDatapoints in self.__datapoints.values())
+        
     def __noteFileDetails(self, sch):
         if "parent" in sch:
             parents = []
@@ -245,35 +266,50 @@ class VistaSchema(object):
                     sch["corruption"] = "Invalid Parent: " + psch["parent"]
                     break
             sch["parents"] = parents
-            if self.__isClass3Number(parents[0]):
-                sch["class3"] = self.__vaStationId(parents[0])
+            if parents[0] in self.__class3:
+                sch["class3"] = self.__class3[parents[0]]
             sch["count"] = "-" # may revisit. For ease of iteration.
             if parents[0] in self.__filePackages:
                 sch["package"] = self.__filePackages[parents[0]]
         else:
-            if self.__isClass3Number(sch["number"]):
-                sch["class3"] = self.__vaStationId(sch["number"])
+            if sch["number"] in self.__class3:
+                sch["class3"] = self.__class3[sch["number"]]
             # Do safe counting
             sch["count"] = "-" if "count" not in sch or sch["count"] == "" or sch["count"] == "0" else sch["count"]
             if sch["number"] in self.__filePackages:
                 sch["package"] = self.__filePackages[sch["number"]]
             
+    def __noteClass3(self):
+        """
+        Class 3 file and field numbers with their station ie/ {id: (id, station
+        name)} or {id: None} if no station's range has it. Numbers repeat 
+        across files so each distinct one is looked up once, all together.
+        """
+        ids = set(fileId for fileId, sch in self.__schemas.iteritems() if "corruption" not in sch)
+        for sch in self.__schemas.itervalues():
+            if "corruption" in sch:
+                continue
+            ids.update(field["number"] for field in sch["fields"] if "corruption" not in field)
+        class3Ids = [id for id in ids if self.__isClass3Number(id)]
+        stations = RESOURCES.namespaceIndex().stations(set(FMQLFileId.of(id).whole for id in class3Ids))
+        self.__class3 = {}
+        for id in class3Ids:
+            station = stations.get(FMQLFileId.of(id).whole)
+            self.__class3[id] = (id, station[1]) if station else None
+        for sch in self.__schemas.itervalues():
+            if "corruption" in sch:
+                continue
+            for field in sch["fields"]:
+                if "corruption" not in field and field["number"] in self.__class3:
+                    field["class3"] = self.__class3[field["number"]]
+            
     def __isClass3Number(self, id):
         """
         TODO: review - may not be true that all in this range are Class 3
         """
-        prefix = re.split(r'[\.\_]', id)[0]
-        return True if len(prefix) == 6 and int(prefix) > 101000 else False
-        
-    def __vaStationId(self, id):
-        # TODO: add MSC etc which is five long - 214XX 
-        idInt = id.split(".")[0]
-        if len(idInt) != 6:
-            return None
-        vaStationId = re.match(r'(\d{3})', id).group(1)
-        if vaStationId in self.namespaces:
-            return (id, self.namespaces[vaStationId])
-        return None
+        # ie/ six digit whole part over 101000 or an MSC (214XX) number
+        whole = FMQLFileId.of(id).whole
+        return True if (101000 < whole <= 999999) or (NamespaceRangeIndex.MSC_RANGE[0] <= whole <= NamespaceRangeIndex.MSC_RANGE[1]) else False
 
 # ######################## Module Demo ##########################
                        
@@ -32,7 +32,9 @@ import os
 from datetime import datetime 
 from collections import defaultdict
 from vistaSchema import VistaSchema
+from copies.fmqlCacher import fileIdSortKey
 from vdmU import HTMLREPORTHEAD, HTMLREPORTTAIL, WARNING_BLURB
+from copies.runProfile import PROFILE
 
 __all__ = ['VistaSchemaComparer']
 
@@ -61,6 +63,7 @@ class VistaSchemaComparer(object):
             except:
                 raise Exception("Bad location for Comparison Reports: %s ... exiting" % reportsLocation)
         
+    @PROFILE.timed("compare.schema")
     def compare(self, format="HTML"):
     
         if format == "HTML":
@@ -72,10 +75,10 @@ class VistaSchemaComparer(object):
         raise ValueError("Unknown report format %s" % format)
         
     def __sortFiles(self, fileSet):
-        return sorted(fileSet, key=lambda item: float(item))
+        return sorted(fileSet, key=fileIdSortKey)
         
     def __sortFields(self, fieldSet):
-        return sorted(fieldSet, key=lambda item: float(item["number"]))
+        return sorted(fieldSet, key=lambda item: fileIdSortKey(item["number"]))
                 
     def __buildReport(self, reportBuilder):
     
@@ -462,6 +465,7 @@ class VSHTMLReportBuilder:
         ]
         self.__countsETCMU = "<div class='report' id='counts'><h2>Schema Counts</h2><dl>" + self.__muDTD(items) + "</dl></div>"
                                 
+    @PROFILE.timed("report.flush")
     def flush(self):
     
         reportHead = (HTMLREPORTHEAD % ("Schema Comparison Report << VOLDEMORT", " VOLDEMORT Schema Comparison Report"))
@@ -0,0 +1,487 @@
+#
+## VOLDEMORT (VDM) VistA Comparer
+#
+# (c) 2012 Caregraf, Ray Group Intl
+# For license information, see LICENSE.TXT
+#
+
+"""
+Schema drift across a fleet of VistAs - for every file and field, which sites
+have it, rename it, deprecate it or corrupt it.
+
+VistaSchemaComparer compares one pair. Here each site's schema is read once
+and folded into one index: every file and field has a bitset per attribute
+with one bit per site (bit 0 is the first site added). A query over sites is
+then a mask and one integer comparison per file or field, however many sites
+there are, and no site is compared against another one by one.
+
+Per file and field:
+- has: sites with it (corrupt or not)
+- deprecated: sites whose name for it starts with '*'
+- corrupt: sites where FMQL found it corrupt
+- renamed: sites whose name isn't the fleet's name for it. The fleet's name
+is the baseline's (GOLD) if the baseline has it, otherwise the name most
+sites use. A '*' of deprecation doesn't count as a rename.
+
+A field of a file that is corrupt in a site is neither present nor absent
+there - FileMan gave no fields for it.
+
+  fleet = fleetOfCaches("Caches")
+  fleet.filesWhere(absent=["GOLD"], present=["SITE1", "SITE2"])
+  fleet.fieldsWhere(renamed=["SITE3"])
+  fleet.save("Reports/schemaFleet.json") # VistaSchemaFleet.load(...) later
+  fleet.report("Reports") # Reports/schemaFleet.html
+
+Like the Comparer, multiples aren't fields here - they're (sub)files.
+
+TODO:
+- Lab (63*) files are customized everywhere - may skip as the Comparer does
+- fold in builds (which sites installed what) the same way
+"""
+
+import os
+import json
+import logging
+from datetime import datetime
+from collections import OrderedDict
+from vistaSchema import VistaSchema
+from copies.fmqlCacher import FMQLCacher, fileIdSortKey
+from vdmU import HTMLREPORTHEAD, HTMLREPORTTAIL, WARNING_BLURB
+from copies.runProfile import PROFILE
+
+__all__ = ['VistaSchemaFleet', 'fleetOfCaches', 'cachedVistas']
+
+class FleetEntry(object):
+    """
+    Site bitsets of one file or field and its names by site ie/ {name: bits}
+    """
+    ATTRIBUTES = ("has", "deprecated", "corrupt", "renamed")
+    __slots__ = ATTRIBUTES + ("names", "name")
+
+    def __init__(self):
+        self.has = 0
+        self.deprecated = 0
+        self.corrupt = 0
+        self.renamed = 0
+        self.names = {}
+        self.name = ""
+
+class VistaSchemaFleet(object):
+    """
+    Index of the schemas of many VistAs. See the module description.
+    """
+
+    def __init__(self, baselineLabel="GOLD"):
+        self.baselineLabel = baselineLabel
+        self.sites = []
+        self.__files = {}
+        self.__fields = {} # {file id: {field number: FleetEntry}}
+        self.__settled = True
+
+    def __str__(self):
+        return "Schema fleet of %d VistAs, %d files" % (len(self.sites), len(self.__files))
+
+    @PROFILE.timed("index.fleet")
+    def addSchema(self, vistaSchema):
+        """
+        Fold a site's schema into the index. Sites are numbered (their bit)
+        in the order added. The schema isn't kept.
+        """
+        if vistaSchema.vistaLabel in self.sites:
+            raise Exception("%s is already in the fleet" % vistaSchema.vistaLabel)
+        bit = 1 << len(self.sites)
+        self.sites.append(vistaSchema.vistaLabel)
+        self.__settled = False
+        for fileId in vistaSchema.files() + vistaSchema.filesWithAttr("corruption"):
+            sch = vistaSchema.getSchema(fileId)
+            entry = self.__files.get(fileId)
+            if entry is None:
+                entry = self.__files[fileId] = FleetEntry()
+            self.__note(entry, bit, sch)
+            if "corruption" in sch:
+                continue
+            fieldEntries = self.__fields.get(fileId)
+            if fieldEntries is None:
+                fieldEntries = self.__fields[fileId] = {}
+            for field in sch["fields"]:
+                fieldEntry = fieldEntries.get(field["number"])
+                if fieldEntry is None:
+                    fieldEntry = fieldEntries[field["number"]] = FleetEntry()
+                self.__note(fieldEntry, bit, field)
+        logging.info("Fleet: added %s as site %d" % (vistaSchema.vistaLabel, len(self.sites)))
+
+    def __note(self, entry, bit, about):
+        entry.has |= bit
+        if "corruption" in about:
+            entry.corrupt |= bit
+            return
+        if "deprecated" in about:
+            entry.deprecated |= bit
+        name = about["name"].lstrip("*")
+        entry.names[name] = entry.names.get(name, 0) | bit
+
+    def __settle(self):
+        """
+        Fleet name and renamed sites of every entry - redone after sites are
+        added as the most used name may change
+        """
+        if self.__settled:
+            return
+        baselineBit = self.siteBits([self.baselineLabel]) if self.baselineLabel in self.sites else 0
+        for entry in self.__allEntries():
+            if not entry.names:
+                continue
+            name = None
+            if baselineBit:
+                for candidate, bits in entry.names.iteritems():
+                    if bits & baselineBit:
+                        name = candidate
+                        break
+            if name is None:
+                # most sites, ties to the lowest site ie/ first added
+                name = max(entry.names, key=lambda candidate: (_countBits(entry.names[candidate]), -_lowestBit(entry.names[candidate])))
+            entry.name = name
+            entry.renamed = 0
+            for candidate, bits in entry.names.iteritems():
+                if candidate != name:
+                    entry.renamed |= bits
+        self.__settled = True
+
+    def __allEntries(self):
+        for entry in self.__files.itervalues():
+            yield entry
+        for fieldEntries in self.__fields.itervalues():
+            for entry in fieldEntries.itervalues():
+                yield entry
+
+    def siteBits(self, labels):
+        """
+        Mask of sites ie/ ["GOLD", "SITE2"] -> 0b101 if they're sites 1 and 3
+        """
+        bits = 0
+        for label in labels:
+            if label not in self.sites:
+                raise Exception("%s isn't in the fleet" % label)
+            bits |= 1 << self.sites.index(label)
+        return bits
+
+    def sitesOf(self, bits):
+        return [label for i, label in enumerate(self.sites) if bits >> i & 1]
+
+    @property
+    def allBits(self):
+        return (1 << len(self.sites)) - 1
+
+    def files(self):
+        return sorted(self.__files, key=fileIdSortKey)
+
+    def fields(self, fileId):
+        return sorted(self.__fields.get(fileId, {}), key=fileIdSortKey)
+
+    def describeFile(self, fileId):
+        """
+        Sites of a file by attribute ie/ {"name": fleet name, "has": [...],
+        "absent": [...], "deprecated": [...], "corrupt": [...], "renamed":
+        [(site, its name)]}
+        """
+        self.__settle()
+        return self.__describe(self.__files[fileId], self.allBits)
+
+    def describeField(self, fileId, fieldNumber):
+        """
+        As describeFile. Sites where the field's file is corrupt or absent
+        are "unknown".
+        """
+        self.__settle()
+        known = self.__knownBits(fileId)
+        description = self.__describe(self.__fields[fileId][fieldNumber], known)
+        description["unknown"] = self.sitesOf(self.allBits & ~known)
+        return description
+
+    def __describe(self, entry, known):
+        renamed = []
+        for name, bits in entry.names.iteritems():
+            if name != entry.name:
+                renamed.extend((label, name) for label in self.sitesOf(bits))
+        return {"name": entry.name, "has": self.sitesOf(entry.has), "absent": self.sitesOf(known & ~entry.has), "deprecated": self.sitesOf(entry.deprecated), "corrupt": self.sitesOf(entry.corrupt), "renamed": sorted(renamed, key=lambda x: self.sites.index(x[0]))}
+
+    def __knownBits(self, fileId):
+        """
+        Sites whose fields of a file are known - they have it, uncorrupted
+        """
+        fileEntry = self.__files[fileId]
+        return fileEntry.has & ~fileEntry.corrupt
+
+    def filesWhere(self, present=None, absent=None, deprecated=None, corrupt=None, renamed=None):
+        """
+        Files that all the sites listed for each attribute have that
+        attribute ex/ filesWhere(present=["SITE1"], absent=["GOLD"]) are
+        files SITE1 has but GOLD doesn't. In file number order.
+        """
+        self.__settle()
+        tests = self.__tests(present, absent, deprecated, corrupt, renamed)
+        return [fileId for fileId in self.files() if self.__passes(self.__files[fileId], self.allBits, tests)]
+
+    def fieldsWhere(self, present=None, absent=None, deprecated=None, corrupt=None, renamed=None, files=None):
+        """
+        As filesWhere for fields, across all files or those given. Returns
+        "file:field" ids as VistaSchema.allFieldsWithAttr does. A site is
+        only absent a field if it has the field's file uncorrupted.
+        """
+        self.__settle()
+        tests = self.__tests(present, absent, deprecated, corrupt, renamed)
+        fields = []
+        for fileId in (files if files else self.files()):
+            if fileId not in self.__fields:
+                continue
+            known = self.__knownBits(fileId)
+            fieldEntries = self.__fields[fileId]
+            fields.extend(fileId + ":" + fieldNumber for fieldNumber in self.fields(fileId) if self.__passes(fieldEntries[fieldNumber], known, tests))
+        return fields
+
+    def __tests(self, present, absent, deprecated, corrupt, renamed):
+        return [(attribute, self.siteBits(labels)) for attribute, labels in [("has", present), ("absent", absent), ("deprecated", deprecated), ("corrupt", corrupt), ("renamed", renamed)] if labels]
+
+    def __passes(self, entry, known, tests):
+        for attribute, mask in tests:
+            bits = known & ~entry.has if attribute == "absent" else getattr(entry, attribute)
+            if bits & mask != mask:
+                return False
+        return True
+
+    def drifts(self, fileId, fieldNumber=None):
+        """
+        Does a file (or field) differ across the sites that could have it -
+        absent, renamed, corrupt or deprecated in some but not all
+        """
+        self.__settle()
+        if fieldNumber is None:
+            entry, known = self.__files[fileId], self.allBits
+        else:
+            entry, known = self.__fields[fileId][fieldNumber], self.__knownBits(fileId)
+        return bool(entry.has != known or entry.renamed or entry.corrupt or (entry.deprecated and entry.deprecated != entry.has))
+
+    def siteCounts(self):
+        """
+        Per site ie/ {site: {"files": n, "fields": n, "uniqueFiles": n,
+        "missingFiles": n, "renamedFiles": n ...}}. Unique is in it alone,
+        missing is in every site but it.
+        """
+        self.__settle()
+        names = ["files", "fields", "uniqueFiles", "missingFiles", "uniqueFields", "missingFields", "renamedFiles", "renamedFields", "deprecatedFiles", "deprecatedFields", "corruptFiles", "corruptFields"]
+        counts = OrderedDict((label, OrderedDict((name, 0) for name in names)) for label in self.sites)
+        def countBits(bits, name):
+            for site in self.sitesOf(bits):
+                counts[site][name] += 1
+        def countEntry(entry, known, kind):
+            countBits(entry.has, kind + "s")
+            if _countBits(known) > 1:
+                if _countBits(entry.has) == 1:
+                    countBits(entry.has, "unique" + kind.title() + "s")
+                missing = known & ~entry.has
+                if _countBits(missing) == 1:
+                    countBits(missing, "missing" + kind.title() + "s")
+            countBits(entry.renamed, "renamed" + kind.title() + "s")
+            countBits(entry.deprecated, "deprecated" + kind.title() + "s")
+            countBits(entry.corrupt, "corrupt" + kind.title() + "s")
+        for fileId, entry in self.__files.iteritems():
+            countEntry(entry, self.allBits, "file")
+            known = self.__knownBits(fileId)
+            for fieldEntry in self.__fields.get(fileId, {}).itervalues():
+                countEntry(fieldEntry, known, "field")
+        return counts
+
+    def save(self, indexFile):
+        """
+        Write the index as JSON - bitsets as hex strings as a fleet may have
+        more sites than JSON numbers have bits
+        """
+        self.__settle()
+        def entryJSON(entry):
+            about = dict((attribute, "%x" % getattr(entry, attribute)) for attribute in FleetEntry.ATTRIBUTES)
+            about["name"] = entry.name
+            about["names"] = dict((name, "%x" % bits) for name, bits in entry.names.iteritems())
+            return about
+        index = {"sites": self.sites, "baseline": self.baselineLabel, "files": {}, "fields": {}}
+        for fileId, entry in self.__files.iteritems():
+            index["files"][fileId] = entryJSON(entry)
+        for fileId, fieldEntries in self.__fields.iteritems():
+            index["fields"][fileId] = dict((fieldNumber, entryJSON(entry)) for fieldNumber, entry in fieldEntries.iteritems())
+        with open(indexFile, "w") as indexOut:
+            json.dump(index, indexOut)
+        return indexFile
+
+    @staticmethod
+    def load(indexFile):
+        """
+        Index written by save - queries without reading any site's cache
+        """
+        index = json.load(open(indexFile))
+        fleet = VistaSchemaFleet(index["baseline"])
+        fleet.sites = index["sites"]
+        def entryOf(about):
+            entry = FleetEntry()
+            for attribute in FleetEntry.ATTRIBUTES:
+                setattr(entry, attribute, int(about[attribute], 16))
+            entry.name = about["name"]
+            entry.names = dict((name, int(bits, 16)) for name, bits in about["names"].iteritems())
+            return entry
+        for fileId, about in index["files"].iteritems():
+            fleet.__files[fileId] = entryOf(about)
+        for fileId, fieldAbouts in index["fields"].iteritems():
+            fleet.__fields[fileId] = dict((fieldNumber, entryOf(about)) for fieldNumber, about in fieldAbouts.iteritems())
+        return fleet
+
+    @PROFILE.timed("compare.fleet")
+    def report(self, reportsLocation="Reports"):
+        """
+        Write the fleet matrix (HTML) - files and fields that drift, by site
+        """
+        if not os.path.exists(reportsLocation):
+            try:
+                os.mkdir(reportsLocation)
+            except:
+                raise Exception("Bad location for Fleet Reports: %s ... exiting" % reportsLocation)
+        self.__settle()
+        rb = VSFleetHTMLReportBuilder(self, reportsLocation)
+        rb.counts(self.siteCounts(), len(self.__files), len(self.filesWhere(present=self.sites)), sum(len(fieldEntries) for fieldEntries in self.__fields.itervalues()))
+        rb.startFiles()
+        for fileId in self.files():
+            if self.drifts(fileId):
+                rb.row(fileId, self.__files[fileId], self.allBits)
+        rb.endFiles()
+        rb.startFields()
+        for fileId in self.files():
+            if fileId not in self.__fields:
+                continue
+            known = self.__knownBits(fileId)
+            for fieldNumber in self.fields(fileId):
+                if self.drifts(fileId, fieldNumber):
+                    rb.row(fileId + ":" + fieldNumber, self.__fields[fileId][fieldNumber], known)
+        rb.endFields()
+        return rb.flush()
+
+def _countBits(bits):
+    return bin(bits).count("1")
+
+def _lowestBit(bits):
+    return (bits & -bits).bit_length()
+
+class VSFleetHTMLReportBuilder:
+
+    def __init__(self, fleet, reportLocation):
+        self.__fleet = fleet
+        self.__reportLocation = reportLocation
+
+    def counts(self, siteCounts, noFiles, noFilesInAll, noFields):
+        items = [self.__muTable(["Site", "Files", "Unique", "Missing", "Renamed", "Deprecated", "Corrupt", "Fields", "Unique", "Missing", "Renamed", "Deprecated", "Corrupt"])]
+        for label, counts in siteCounts.iteritems():
+            items.append(self.__muTR([label] + [counts[kind + "s" if not attr else attr + kind.title() + "s"] for kind in ["file", "field"] for attr in ["", "unique", "missing", "renamed", "deprecated", "corrupt"]]))
+        items.append("</table>")
+        self.__countsMU = "<div class='report' id='counts'><h2>Fleet Counts</h2><p>%d sites, %d files of which %d are in every site, %d fields. Unique files and fields are in one site alone, missing ones are in every site but one.</p>%s</div>" % (len(siteCounts), noFiles, noFilesInAll, noFields, "".join(items))
+
+    def startFiles(self):
+        self.__items = ["<div class='report' id='files'><h2>Files that Drift</h2><p>Files absent, renamed, deprecated or corrupt in some sites. Each cell is a site: + has the file, blank doesn't, R renamed it (hover for its name), D deprecates it and C has it corrupt.</p>", self.__muTable(["ID", "Name", "Sites"] + self.__fleet.sites)]
+        self.__noRows = 0
+
+    def row(self, id, entry, known):
+        cells = []
+        for i in range(len(self.__fleet.sites)):
+            bit = 1 << i
+            if not (known & bit) and not (entry.has & bit):
+                cells.append("<td>?</td>")
+            elif not (entry.has & bit):
+                cells.append("<td class='highlight'/>")
+            elif entry.corrupt & bit:
+                cells.append("<td class='highlight'>C</td>")
+            elif entry.renamed & bit:
+                otherName = [name for name, bits in entry.names.iteritems() if bits & bit][0]
+                cells.append("<td class='highlight' title='%s'>R</td>" % _escape(otherName))
+            elif entry.deprecated & bit:
+                cells.append("<td>D</td>")
+            else:
+                cells.append("<td>+</td>")
+        self.__noRows += 1
+        self.__items.append("<tr id='%s'><td>%s</td><td>%s</td><td>%d/%d</td>%s</tr>" % (id, id, _escape(entry.name), _countBits(entry.has), _countBits(known), "".join(cells)))
+
+    def endFiles(self):
+        self.__items.append("</table><p>%d files drift.</p></div>" % self.__noRows)
+        self.__filesItems = self.__items
+
+    def startFields(self):
+        self.__items = ["<div class='report' id='fields'><h2>Fields that Drift</h2><p>Fields as files above. ? marks a site whose file is corrupt or missing so the field can't be known there. The Sites column only counts sites that could have the field.</p>", self.__muTable(["ID", "Name", "Sites"] + self.__fleet.sites)]
+        self.__noRows = 0
+
+    def endFields(self):
+        self.__items.append("</table><p>%d fields drift.</p></div>" % self.__noRows)
+        self.__fieldsItems = self.__items
+
+    @PROFILE.timed("report.flush")
+    def flush(self):
+        reportHead = (HTMLREPORTHEAD % ("Schema Fleet Report << VOLDEMORT", " VOLDEMORT Schema Fleet Report"))
+        blurb = "<p>Schema of %d VistAs, %s, side by side. The fleet's name for a file or field is %s's if it has it, otherwise the name most sites use.</p>" % (len(self.__fleet.sites), ", ".join(self.__fleet.sites), self.__fleet.baselineLabel)
+        warning = "<p><strong>Warning:</strong> %s</p>" % WARNING_BLURB if WARNING_BLURB else ""
+        nav = "<p>Jump to: <a href='#counts'>Counts</a> | <a href='#files' class='highlight'>Files</a> | <a href='#fields' class='highlight'>Fields</a></p>"
+        reportTail = HTMLREPORTTAIL % datetime.now().strftime("%b %d %Y %I:%M%p")
+        reportItems = [reportHead, blurb, warning, nav, self.__countsMU]
+        reportItems.extend(self.__filesItems)
+        reportItems.extend(self.__fieldsItems)
+        reportItems.append(reportTail)
+        reportFileName = self.__reportLocation + "/" + "schemaFleet.html"
+        with open(reportFileName, "w") as reportFile:
+            for reportItem in reportItems:
+                reportFile.write(reportItem.encode("utf-8") if isinstance(reportItem, unicode) else reportItem)
+        return reportFileName
+
+    def __muTable(self, colNames):
+        return "<table>" + self.__muTR(colNames, td="th")
+
+    def __muTR(self, items, id="", td="td"):
+        return ("<tr id='%s'>" % id if id else "<tr>") + "".join("<%s>" % td + str(item) + "</%s>" % td for item in items) + "</tr>"
+
+def _escape(name):
+    return name.replace("&", "&amp;").replace("<", "&lt;").replace("'", "&#39;")
+
+def cachedVistas(cachesLocation="Caches"):
+    """
+    Labels of VistAs whose schema is in the caches (sorted)
+    """
+    return sorted(vistaDir for vistaDir in os.listdir(cachesLocation) if os.path.isfile(os.path.join(cachesLocation, vistaDir, "SELECT TYPES BADTOO.json")))
+
+def fleetOfCaches(cachesLocation="Caches", vistaLabels=None, baselineLabel="GOLD"):
+    """
+    Fleet of the cached VistAs (or those named), baseline first. Each site's
+    schema is indexed in turn and let go before the next.
+    """
+    vistaLabels = vistaLabels if vistaLabels else cachedVistas(cachesLocation)
+    if baselineLabel in vistaLabels:
+        vistaLabels = [baselineLabel] + [label for label in vistaLabels if label != baselineLabel]
+    fleet = VistaSchemaFleet(baselineLabel)
+    for vistaLabel in vistaLabels:
+        cacher = FMQLCacher(cachesLocation)
+        cacher.setVista(vistaLabel)
+        fleet.addSchema(VistaSchema(vistaLabel, cacher))
+    return fleet
+
+# ######################## Module Demo ##########################
+
+def demo():
+    """
+    Fleet of every VistA in Caches
+
+    $ python vistaSchemaFleet.py
+    ...
+    Fleet report written to Reports/schemaFleet.html
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    fleet = fleetOfCaches("Caches")
+    print str(fleet)
+    print "Files in every site: %d" % len(fleet.filesWhere(present=fleet.sites))
+    if "GOLD" in fleet.sites:
+        for label in fleet.sites[1:]:
+            print "%s: %d files not in GOLD, %d fields renamed" % (label, len(fleet.filesWhere(present=[label], absent=["GOLD"])), len(fleet.fieldsWhere(renamed=[label])))
+    print "Fleet report written to %s" % fleet.report("Reports")
+    print "Fleet index written to %s" % fleet.save("Reports/schemaFleet.json")
+
+if __name__ == "__main__":
+    demo()